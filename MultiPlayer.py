@@ -1,7 +1,11 @@
 import logging
-from mainapp import run_app
+import multiprocessing
 
 if __name__ == '__main__':
+    # I worker dell'analisi sono processi 'spawn': reimportano questo modulo,
+    # quindi Qt e la UI vanno importati solo nel processo principale.
+    multiprocessing.freeze_support()
+    from mainapp import run_app
     logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     app, main_app = run_app()
     app.exec_()
@@ -9,11 +9,18 @@ block_cipher = None
 
 # Tutti i moduli locali del progetto, elencati esplicitamente
 local_modules = [
+    'analysis',
+    'analysis_cache',
+    'analysis_service',
+    'mp3probe',
+    'gain_tags',
     'constants',
+    'decoders',
     'grid_manager',
     'mainapp',
     'mp3file',
     'mp3widget',
+    'pcm_cache',
     'project_manager',
     'waveform',
     'waveform_service',
@@ -0,0 +1,1229 @@
+"""Analisi audio: un solo passaggio di decode produce tutto ciò che serve
+all'app (piramide dell'envelope, peak, RMS, durata) in un AnalysisResult
+cachato su disco.
+
+Nessuna dipendenza Qt: il modulo viene importato dai processi worker dello
+scheduler (`analysis_service.AnalysisScheduler`), che non hanno una
+QApplication. Le funzioni di analisi accettano un callback opzionale
+`progress(frazione, partial=None)`; `run_job` lo collega alla coda di
+progress e all'evento di cancellazione del job. `partial` è un risultato
+intermedio (per `analyze`, l'anteprima dell'envelope) da mostrare mentre
+il decode prosegue.
+"""
+import functools
+import hashlib
+import io
+import logging
+import math
+import multiprocessing
+import os
+import tempfile
+import time
+from concurrent.futures import FIRST_EXCEPTION, ProcessPoolExecutor, wait
+from dataclasses import dataclass
+from queue import Empty
+import sqlite3
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+import soundfile as sf
+import decoders
+import mp3probe
+from analysis_cache import AnalysisCache
+from constants import (ANALYSIS_CACHE_MAX_MB, ANALYSIS_LEVEL_DTYPE, ANALYSIS_SEGMENT_MIN_S,
+                       ANALYSIS_SEGMENT_WORKERS, NORMALIZE_CEILING_DBTP, NORMALIZE_MODE,
+                       NORMALIZE_TARGET_LUFS, PCM_CACHE_DTYPE, PCM_CACHE_MAX_MB)
+from pcm_cache import PcmCache, PcmEntry
+
+logger = logging.getLogger(__name__)
+
+_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'mp3player_waveforms')
+_PCM_DIR = os.path.join(tempfile.gettempdir(), 'mp3player_pcm')
+
+# Scala della quantizzazione int8 dei livelli in cache: ±1.0 ↔ ±127.
+_INT8_SCALE = 127
+
+# Byte letti per ciascuno dei tre blocchi del fingerprint del contenuto.
+_FINGERPRINT_BLOCK = 64 * 1024
+
+# Piramide dell'envelope: il livello 0 ha una colonna ogni _PYRAMID_BASE_BIN
+# campioni, ogni livello successivo dimezza le colonne. Ci si ferma quando
+# il livello successivo scenderebbe sotto _PYRAMID_MIN_COLS colonne.
+_PYRAMID_BASE_BIN = 256
+_PYRAMID_MIN_COLS = 256
+
+# Piramide per canale (min, max, RMS di ogni canale, per la vista stereo
+# separata): solo per i file con al più _CHANNEL_LEVELS_MAX canali (i
+# multicanale restano col solo downmix), e senza il livello base, cioè da
+# bin di 2×_PYRAMID_BASE_BIN campioni: metà dello spazio in cache, con
+# ancora ~86 colonne per secondo di audio a 44.1 kHz.
+_CHANNEL_LEVELS_MAX = 2
+
+# Anteprima progressiva dell'envelope durante il decode: colonne sull'intera
+# durata stimata del file (~32 KB per invio, indipendente dalla durata) e
+# intervallo minimo tra due invii. La prima anteprima parte dopo il primo
+# blocco decodificato.
+_PREVIEW_COLUMNS = 4096
+_PREVIEW_INTERVAL_S = 0.25
+
+# Analisi a segmenti (`_analyze_segments`): segmenti per processo, perché un
+# segmento più lento degli altri (più dettaglio da decodificare) non lasci
+# fermi i processi che hanno finito, e frame di ogni giuntura confrontati
+# tra i due segmenti vicini (almeno un frame mp3).
+_SEGMENTS_PER_WORKER = 2
+_SEGMENT_SEAM_FRAMES = 1152
+
+# Anteprima sparsa (sparse_preview): numero di finestre campionate e loro
+# lunghezza. Per gli mp3 ogni finestra è una breve sequenza di frame letta
+# direttamente dal file, preceduta da frame di pre-roll che servono solo a
+# riempire il bit reservoir del decoder (fino a 511 byte all'indietro) e
+# vengono scartati: mpg123 emette silenzio finché non ha ~840 byte di frame
+# precedenti, anche per i VBR a 32 kbps.
+_SPARSE_PROBES = 64
+_SPARSE_MP3_PREROLL_BYTES = 1024
+_SPARSE_MP3_FRAMES = 3
+_SPARSE_WINDOW_FRAMES = 4096
+_MP3_MAX_FRAME_BYTES = 1441
+
+# Filtro di interpolazione 4× per il true peak, ITU-R BS.1770-4 Annex 2:
+# 48 tap in 4 fasi da 12, una per ciascuna posizione inter-campione.
+_TRUE_PEAK_TAPS = np.array([
+    [0.0017089843750, 0.0109863281250, -0.0196533203125, 0.0332031250000,
+     -0.0594482421875, 0.1373291015625, 0.9721679687500, -0.1022949218750,
+     0.0476074218750, -0.0266113281250, 0.0148925781250, -0.0083007812500],
+    [-0.0291748046875, 0.0292968750000, -0.0517578125000, 0.0891113281250,
+     -0.1665039062500, 0.4650878906250, 0.7797851562500, -0.2003173828125,
+     0.1015625000000, -0.0582275390625, 0.0330810546875, -0.0189208984375],
+    [-0.0189208984375, 0.0330810546875, -0.0582275390625, 0.1015625000000,
+     -0.2003173828125, 0.7797851562500, 0.4650878906250, -0.1665039062500,
+     0.0891113281250, -0.0517578125000, 0.0292968750000, -0.0291748046875],
+    [-0.0083007812500, 0.0148925781250, -0.0266113281250, 0.0476074218750,
+     -0.1022949218750, 0.9721679687500, 0.1373291015625, -0.0594482421875,
+     0.0332031250000, -0.0196533203125, 0.0109863281250, 0.0017089843750],
+], dtype=np.float32)
+_TRUE_PEAK_HISTORY = _TRUE_PEAK_TAPS.shape[1] - 1
+
+# Loudness integrata, ITU-R BS.1770-4 / EBU R128. K-weighting: parametri
+# analogici dello shelving (guadagno dB, Q, frequenza) e del passa-alto RLB
+# (Q, frequenza), da cui si ricavano per bilineare i biquad della norma
+# (tabulati a 48 kHz) a qualsiasi samplerate.
+_K_SHELF = (3.99984385397, 0.7071752369554193, 1681.974450955533)
+_K_HIGHPASS = (0.5003270373253953, 38.13547087613982)
+# Risposta all'impulso del K-weighting troncata a 100 ms: la coda residua
+# è sotto 1e-10 del picco, il FIR equivale all'IIR in float32.
+_K_IMPULSE_S = 0.1
+# Sub-blocchi da 100 ms; un blocco di gating sono 4 sub-blocchi (400 ms,
+# overlap 75%).
+_LOUDNESS_HOP_S = 0.1
+_LOUDNESS_GATE_HOPS = 4
+_LOUDNESS_ABSOLUTE_GATE = -70.0
+_LOUDNESS_RELATIVE_GATE = -10.0
+_LOUDNESS_SURROUND_WEIGHT = 1.41
+
+# Misure opzionali di un'analisi (nome del campo di AnalysisResult e della
+# chiave nei metadati in cache) e quelle che servono a ciascuna modalità di
+# normalizzazione.
+TRUE_PEAK = 'true_peak'
+LOUDNESS = 'loudness'
+NORMALIZE_MODES = ('peak', 'true_peak', 'lufs', 'lufs_tp')
+_MODE_MEASURES = {
+    'peak': (),
+    'true_peak': (TRUE_PEAK,),
+    'lufs': (LOUDNESS,),
+    'lufs_tp': (LOUDNESS, TRUE_PEAK),
+}
+
+
+class AnalysisCancelled(Exception):
+    """Sollevata dal callback di progress quando il job è stato cancellato:
+    interrompe il decode al blocco successivo."""
+
+
+@dataclass
+class AnalysisResult:
+    """Esito di un passaggio di decode. `levels` è la piramide
+    [(min, max), ...] del downmix mono, dal livello più fine al più grezzo
+    (letta dalla cache: viste in sola lettura nel dtype di
+    ANALYSIS_LEVEL_DTYPE, vedi `dequantize`); `rms_levels` l'RMS del
+    downmix sulle stesse colonne, un array per livello (None per le voci in
+    cache di versioni precedenti); `channel_levels`, per i file
+    stereo, la piramide per canale: un array (colonne, canali, 3) per
+    livello con min, max e RMS di ogni canale interleaved (None per i file
+    mono o multicanale e per le voci in cache di versioni precedenti);
+    `peak` e `rms` sono calcolati
+    su tutti i canali (non sul downmix); `true_peak` (picco inter-campione,
+    BS.1770) e `loudness` (loudness integrata in LUFS, BS.1770 / R128) sono
+    None se l'analisi non li ha calcolati (vedi `required_measures`)."""
+
+    levels: list[tuple[np.ndarray, np.ndarray]]
+    peak: float
+    rms: float
+    frames: int
+    sample_rate: int
+    channels: int
+    true_peak: float | None = None
+    loudness: float | None = None
+    channel_levels: list[np.ndarray] | None = None
+    rms_levels: list[np.ndarray] | None = None
+
+    @property
+    def duration(self) -> float:
+        """Durata esatta in secondi (frame realmente decodificati)."""
+        return self.frames / self.sample_rate if self.sample_rate else 0.0
+
+    def peak_gain(self, true_peak: bool = False) -> float:
+        """Gain che porta il picco del file a 1.0; con `true_peak` il picco
+        inter-campione, se calcolato."""
+        peak = self.true_peak if true_peak and self.true_peak is not None else self.peak
+        if peak < 1e-9:
+            return 1.0
+        return 1.0 / peak
+
+    def normalize_gain(self, mode: str) -> float:
+        """Gain di normalizzazione per `mode` (vedi `gain_for`)."""
+        return gain_for(mode, self.peak, self.true_peak, self.loudness)
+
+
+def gain_for(mode: str, peak: float, true_peak: float | None = None,
+             loudness: float | None = None) -> float:
+    """Gain di normalizzazione per `mode` (vedi NORMALIZE_MODES):
+    'peak'/'true_peak' portano il picco a 1.0, 'lufs' porta la loudness a
+    NORMALIZE_TARGET_LUFS, 'lufs_tp' come 'lufs' ma senza superare
+    NORMALIZE_CEILING_DBTP di true peak. Un file silenzioso (loudness al
+    gate assoluto) resta a 1.0; le modalità LUFS senza loudness ripiegano
+    sul picco, quelle con true peak senza true peak sul sample peak."""
+    if mode in ('lufs', 'lufs_tp') and loudness is not None:
+        if loudness <= _LOUDNESS_ABSOLUTE_GATE:
+            return 1.0
+        gain = 10 ** ((NORMALIZE_TARGET_LUFS - loudness) / 20)
+        if mode == 'lufs_tp' and true_peak is not None and true_peak >= 1e-9:
+            gain = min(gain, 10 ** (NORMALIZE_CEILING_DBTP / 20) / true_peak)
+        return gain
+    if mode in ('true_peak', 'lufs_tp') and true_peak is not None:
+        peak = true_peak
+    if peak < 1e-9:
+        return 1.0
+    return 1.0 / peak
+
+
+_normalize_mode = NORMALIZE_MODE
+
+
+def normalize_mode() -> str:
+    """Modalità di normalizzazione attuale (all'avvio NORMALIZE_MODE)."""
+    return _normalize_mode
+
+
+def set_normalize_mode(mode: str) -> None:
+    """Cambia la modalità di normalizzazione di questo processo. I worker
+    non la vedono: ricevono le misure da calcolare come argomento di
+    `analyze` (vedi `required_measures`)."""
+    global _normalize_mode
+    if mode not in NORMALIZE_MODES:
+        raise ValueError(f"unknown normalize mode: {mode}")
+    _normalize_mode = mode
+
+
+def required_measures(mode: str | None = None) -> tuple[str, ...]:
+    """Misure opzionali (TRUE_PEAK, LOUDNESS) che servono alla modalità
+    `mode`, default quella attuale. La tupla ha un ordine fisso, così due
+    job dello scheduler con le stesse misure si deduplicano."""
+    return _MODE_MEASURES[mode or _normalize_mode]
+
+
+def fingerprint(file_name: str, size: int | None = None) -> str:
+    """Fingerprint del contenuto: hash della dimensione e di tre blocchi da
+    _FINGERPRINT_BLOCK byte (inizio, metà, fine); i file piccoli vengono
+    letti interi. Non dipende da path né da mtime, quindi sopravvive a
+    spostamenti, rinomine e sync su un'altra macchina, e file identici in
+    cartelle diverse condividono le voci di cache. Due file della stessa
+    dimensione che differiscono solo fuori dai blocchi campionati
+    collidono: per dei file audio (tag e header in testa, frame ovunque)
+    è un caso che si può ignorare."""
+    if size is None:
+        size = os.path.getsize(file_name)
+    digest = hashlib.blake2b(str(size).encode(), digest_size=16)
+    with open(file_name, 'rb') as fh:
+        if size <= 3 * _FINGERPRINT_BLOCK:
+            digest.update(fh.read())
+        else:
+            for offset in (0, (size - _FINGERPRINT_BLOCK) // 2, size - _FINGERPRINT_BLOCK):
+                fh.seek(offset)
+                digest.update(fh.read(_FINGERPRINT_BLOCK))
+    return digest.hexdigest()
+
+
+def file_key(file_name: str, known_only: bool = False) -> str | None:
+    """Identità del contenuto di file_name per le cache (vedi `fingerprint`).
+    Il fingerprint viene ricordato per path nell'indice della cache: finché
+    mtime e size non cambiano costa una stat e una query. Se il file non è
+    leggibile ritorna una chiave derivata dal path.
+
+    Con `known_only` (main thread) solo la stat e la query: None se il
+    fingerprint non è ancora noto, senza leggere il file né scrivere
+    nell'indice; lo calcola il primo job che analizza il file."""
+    path = os.path.abspath(file_name)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return hashlib.md5(f"{path}|missing".encode()).hexdigest()
+    try:
+        known = cache().lookup_fingerprint(path, st.st_mtime_ns, st.st_size)
+    except sqlite3.Error as exc:
+        logger.debug(f"fingerprint index unavailable: {exc}")
+        known = None
+    if known is not None or known_only:
+        return known
+    try:
+        key = fingerprint(path, st.st_size)
+    except OSError:
+        return hashlib.md5(f"{path}|{st.st_mtime_ns}_{st.st_size}".encode()).hexdigest()
+    try:
+        cache().store_fingerprint(path, st.st_mtime_ns, st.st_size, key)
+    except sqlite3.Error as exc:
+        logger.debug(f"fingerprint index unavailable: {exc}")
+    return key
+
+
+_cache: AnalysisCache | None = None
+
+
+def cache() -> AnalysisCache:
+    """Cache disco delle analisi, una connessione all'indice per processo."""
+    global _cache
+    if _cache is None:
+        _cache = AnalysisCache(_CACHE_DIR, ANALYSIS_CACHE_MAX_MB * 1024 * 1024)
+    return _cache
+
+
+_pcm: PcmCache | None = None
+
+
+def pcm_cache() -> PcmCache | None:
+    """Cache disco del PCM decodificato, None se disattivata
+    (PCM_CACHE_MAX_MB = 0)."""
+    global _pcm
+    if _pcm is None and PCM_CACHE_MAX_MB > 0:
+        _pcm = PcmCache(_PCM_DIR, PCM_CACHE_MAX_MB * 1024 * 1024, PCM_CACHE_DTYPE)
+    return _pcm
+
+
+def load_pcm(file_name: str) -> PcmEntry | None:
+    """PCM decodificato di file_name dalla cache del PCM, mappato senza
+    copie: `samples` (frame, canali) int16 o float16, da convertire a fette
+    con `pcm_cache.as_float32`. None se la cache è disattivata o non ha il
+    file (lo riempie il primo `analyze` che lo decodifica)."""
+    store = pcm_cache()
+    if store is None:
+        return None
+    try:
+        return store.get(file_key(file_name))
+    except OSError:
+        return None
+
+
+def _cache_key(file_name: str, known_only: bool = False) -> str | None:
+    content_key = file_key(file_name, known_only)
+    return _entry_key(content_key) if content_key is not None else None
+
+
+def _entry_key(content_key: str) -> str:
+    return f"{content_key}_an"
+
+
+def _pyramid_from_base(mins: np.ndarray, maxs: np.ndarray) -> list[tuple[np.ndarray, np.ndarray]]:
+    """Costruisce i livelli della piramide dimezzando le colonne del livello
+    base (coppie adiacenti → min/max), finché restano almeno
+    2×_PYRAMID_MIN_COLS colonne. Nessun decode: costa una frazione di ms."""
+    if len(mins) == 0:
+        zero = np.zeros(1, dtype=np.float32)
+        return [(zero, zero)]
+    levels = [(mins, maxs)]
+    while len(levels[-1][0]) >= 2 * _PYRAMID_MIN_COLS:
+        lo, hi = levels[-1]
+        idx = np.arange(0, len(lo), 2)
+        levels.append((np.minimum.reduceat(lo, idx), np.maximum.reduceat(hi, idx)))
+    return levels
+
+
+def _row_sum_squares(rows: np.ndarray) -> np.ndarray:
+    """Somma dei quadrati di ogni riga di `rows` (bin, campioni), float32:
+    np.vecdot (numpy >= 2.0) costa meno della metà di einsum sui bin del
+    livello base; su numpy 1.x einsum, comunque senza temporanei."""
+    if hasattr(np, 'vecdot'):
+        return np.vecdot(rows, rows)
+    return np.einsum('bi,bi->b', rows, rows)
+
+
+def _rms_pyramid_from_base(squares: np.ndarray, count: int) -> list[np.ndarray]:
+    """RMS del downmix sulle colonne dei `count` livelli di
+    `_pyramid_from_base`, dalle medie dei quadrati del livello base: medie
+    a coppie come in `_channel_pyramid_from_base`, radice alla fine."""
+    if len(squares) == 0:
+        return [np.zeros(1, dtype=np.float32)]
+    levels = [squares]
+    while len(levels) < count:
+        level = levels[-1]
+        idx = np.arange(0, len(level), 2)
+        counts = np.diff(np.append(idx, len(level)))
+        levels.append((np.add.reduceat(level, idx) / counts).astype(np.float32))
+    return [np.sqrt(level) for level in levels]
+
+
+def _channel_pyramid_from_base(base: np.ndarray) -> list[np.ndarray]:
+    """Piramide per canale dal livello base (colonne, canali, 3) con min,
+    max e media dei quadrati: stesse colonne di `_pyramid_from_base`, le
+    medie dei quadrati mediate a coppie (l'ultimo bin parziale pesa come
+    gli altri) e convertite in RMS alla fine. Il livello base si scarta
+    (vedi _CHANNEL_LEVELS_MAX) se ce ne sono altri."""
+    levels = [base]
+    while len(levels[-1]) >= 2 * _PYRAMID_MIN_COLS:
+        level = levels[-1]
+        idx = np.arange(0, len(level), 2)
+        counts = np.diff(np.append(idx, len(level)))
+        coarse = np.empty((len(idx), *level.shape[1:]), np.float32)
+        coarse[:, :, 0] = np.minimum.reduceat(level[:, :, 0], idx, axis=0)
+        coarse[:, :, 1] = np.maximum.reduceat(level[:, :, 1], idx, axis=0)
+        coarse[:, :, 2] = np.add.reduceat(level[:, :, 2], idx, axis=0) / counts[:, None]
+        levels.append(coarse)
+    if len(levels) > 1:
+        levels = levels[1:]
+    for level in levels:
+        np.sqrt(level[:, :, 2], out=level[:, :, 2])
+    return levels
+
+
+def _k_weighting_biquads(sample_rate: int) -> list[tuple[np.ndarray, np.ndarray]]:
+    """(b, a) dei due biquad del K-weighting al samplerate dato: a 48 kHz
+    sono i coefficienti tabulati in BS.1770-4."""
+    gain_db, q, fc = _K_SHELF
+    k = np.tan(np.pi * fc / sample_rate)
+    vh = 10 ** (gain_db / 20)
+    vb = vh ** 0.4996667741545416
+    a0 = 1 + k / q + k * k
+    shelf = (np.array([(vh + vb * k / q + k * k) / a0, 2 * (k * k - vh) / a0, (vh - vb * k / q + k * k) / a0]),
+             np.array([1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0]))
+    q, fc = _K_HIGHPASS
+    k = np.tan(np.pi * fc / sample_rate)
+    a0 = 1 + k / q + k * k
+    highpass = (np.array([1.0, -2.0, 1.0]),
+                np.array([1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0]))
+    return [shelf, highpass]
+
+
+@functools.lru_cache(maxsize=None)
+def _k_weighting(sample_rate: int) -> tuple[int, int, np.ndarray]:
+    """Il K-weighting come FIR: (tap, dimensione della FFT, spettro della
+    risposta all'impulso). La risposta si calcola una volta per samplerate
+    facendo passare un impulso nei due biquad (~15 ms)."""
+    taps = max(2, round(sample_rate * _K_IMPULSE_S))
+    response = [1.0] + [0.0] * (taps - 1)
+    for b, a in _k_weighting_biquads(sample_rate):
+        b0, b1, b2 = (float(v) for v in b)
+        _, a1, a2 = (float(v) for v in a)
+        x1 = x2 = y1 = y2 = 0.0
+        for i, x in enumerate(response):
+            y = b0 * x + b1 * x1 + b2 * x2 - a1 * y1 - a2 * y2
+            x2, x1, y2, y1 = x1, x, y1, y
+            response[i] = y
+    nfft = 1 << (2 * taps).bit_length()
+    return taps, nfft, np.fft.rfft(np.array(response, np.float32), nfft)
+
+
+def _k_filter(x: np.ndarray, sample_rate: int) -> np.ndarray:
+    """K-weighting di `x` (canali, tap-1 campioni di storia + n campioni)
+    per overlap-save: finestre di nfft campioni sovrapposte di tap-1,
+    trasformate tutte insieme da una sola FFT batch. Ritorna (canali, n)
+    float32."""
+    taps, nfft, spectrum = _k_weighting(sample_rate)
+    n = x.shape[1] - taps + 1
+    step = nfft - taps + 1
+    windows = -(-n // step)
+    padded = np.zeros((x.shape[0], windows * step + taps - 1), np.float32)
+    padded[:, :x.shape[1]] = x
+    frames = sliding_window_view(padded, nfft, axis=1)[:, ::step]
+    y = np.fft.irfft(np.fft.rfft(frames, axis=-1) * spectrum, nfft, axis=-1)[..., taps - 1:]
+    return y.reshape(x.shape[0], -1)[:, :n]
+
+
+def _loudness_weights(channels: int) -> np.ndarray:
+    """Pesi dei canali in BS.1770: 1.0 per i frontali, 1.41 per i surround
+    dei layout 5.0 e 5.1 (L R C [LFE] Ls Rs), LFE escluso."""
+    if channels == 5:
+        return np.array([1.0, 1.0, 1.0, _LOUDNESS_SURROUND_WEIGHT, _LOUDNESS_SURROUND_WEIGHT])
+    if channels == 6:
+        return np.array([1.0, 1.0, 1.0, 0.0, _LOUDNESS_SURROUND_WEIGHT, _LOUDNESS_SURROUND_WEIGHT])
+    return np.ones(channels)
+
+
+def _integrated_loudness(energy: np.ndarray, hop: int) -> float:
+    """Loudness integrata in LUFS dalle somme dei quadrati K-pesati per
+    canale e sub-blocco da 100 ms (`energy`, (canali, sub-blocchi)):
+    blocchi di gating da 400 ms, gate assoluto a -70 LUFS e relativo a
+    -10 LU. Ritorna il gate assoluto se nessun blocco lo supera (silenzio
+    o file più corto di un blocco)."""
+    if energy.shape[1] < _LOUDNESS_GATE_HOPS:
+        return _LOUDNESS_ABSOLUTE_GATE
+    blocks = sliding_window_view(energy, _LOUDNESS_GATE_HOPS, axis=1).sum(axis=-1)
+    power = _loudness_weights(len(energy)) @ blocks / (_LOUDNESS_GATE_HOPS * hop)
+    with np.errstate(divide='ignore'):
+        block_loudness = -0.691 + 10 * np.log10(power)
+    gated = block_loudness > _LOUDNESS_ABSOLUTE_GATE
+    if not gated.any():
+        return _LOUDNESS_ABSOLUTE_GATE
+    relative = -0.691 + 10 * np.log10(power[gated].mean()) + _LOUDNESS_RELATIVE_GATE
+    gated &= block_loudness > relative
+    return max(_LOUDNESS_ABSOLUTE_GATE, float(-0.691 + 10 * np.log10(power[gated].mean())))
+
+
+class _Accumulator:
+    """Tutte le riduzioni di un passaggio di decode, alimentate blocco per
+    blocco: nessuna conserva il PCM, la memoria è proporzionale al solo
+    livello base della piramide.
+
+    Il livello base è a bin fissi di `_PYRAMID_BASE_BIN` campioni del
+    downmix: i campioni che non completano un bin passano al blocco
+    successivo, così i bordi dei bin non dipendono dalla dimensione dei
+    blocchi letti; l'ultimo bin può essere parziale (la coda non si perde).
+    Ogni bin ha min, max e somma dei quadrati (vedi `_feed_base`).
+    """
+
+    def __init__(self, sample_rate: int, channels: int, measures: tuple[str, ...] = ()):
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.frames = 0
+        self._peak = 0.0
+        # Ultimi campioni del blocco precedente per il filtro del true peak
+        # (zeri all'inizio, come da BS.1770); None se non richiesto.
+        self._tp_history = (np.zeros((_TRUE_PEAK_HISTORY, channels), np.float32)
+                            if TRUE_PEAK in measures else None)
+        self._true_peak = 0.0
+        # Loudness: storia del K-weighting (canali, tap-1; None se non
+        # richiesta), campioni filtrati che non completano un sub-blocco e
+        # somme dei quadrati per canale dei sub-blocchi completi.
+        self._kw_hop = max(1, round(sample_rate * _LOUDNESS_HOP_S))
+        self._kw_history = (np.zeros((channels, _k_weighting(sample_rate)[0] - 1), np.float32)
+                            if LOUDNESS in measures else None)
+        self._kw_carry = np.empty((channels, 0), np.float32)
+        self._kw_energy: list[np.ndarray] = []
+        self._sum_squares = 0.0
+        self._carry = np.empty(0, dtype=np.float32)
+        self._base_min: list[np.ndarray] = []
+        self._base_max: list[np.ndarray] = []
+        self._base_squares: list[np.ndarray] = []
+        # Livello base per canale (vedi `_feed_channels`); None per i file
+        # mono o multicanale.
+        self._channel_carry = (np.empty((channels, 0), np.float32)
+                               if 1 < channels <= _CHANNEL_LEVELS_MAX else None)
+        self._base_channels: list[np.ndarray] = []
+
+    def feed(self, block: np.ndarray) -> None:
+        """`block`: float32 (frame, canali)."""
+        if len(block) == 0:
+            return
+        self.frames += len(block)
+        self._peak = max(self._peak, float(block.max()), -float(block.min()))
+        flat = block.ravel()
+        self._sum_squares += float(np.dot(flat, flat))
+        if self._tp_history is not None:
+            self._feed_true_peak(block)
+        if self._kw_history is not None:
+            self._feed_loudness(block)
+        if self._channel_carry is not None:
+            self._feed_channels(block)
+
+        mono = block.mean(axis=1) if block.shape[1] > 1 else block[:, 0]
+        if len(self._carry):
+            mono = np.concatenate((self._carry, mono))
+        full = len(mono) - len(mono) % _PYRAMID_BASE_BIN
+        if full:
+            self._feed_base(mono[:full].reshape(-1, _PYRAMID_BASE_BIN))
+        self._carry = mono[full:]
+
+    def _feed_base(self, cols: np.ndarray) -> None:
+        """Bin completi del downmix (bin, _PYRAMID_BASE_BIN): min, max e
+        somma dei quadrati sulla stessa vista, già contigua lungo i bin. La
+        somma (`_row_sum_squares`) diventa media solo in `result`: qui,
+        per blocco, ogni operazione in più pesa sul costo dell'RMS
+        (misurato da bench_envelope.py)."""
+        self._base_min.append(cols.min(axis=1))
+        self._base_max.append(cols.max(axis=1))
+        self._base_squares.append(_row_sum_squares(cols))
+
+    def prime(self, block: np.ndarray) -> None:
+        """Campioni che precedono il primo blocco (un segmento che non parte
+        dall'inizio del file): entrano solo nella storia dei filtri del true
+        peak e del K-weighting, non nelle misure."""
+        if self._tp_history is not None:
+            self._tp_history = np.concatenate((self._tp_history, block))[-_TRUE_PEAK_HISTORY:].copy()
+        if self._kw_history is not None:
+            taps = self._kw_history.shape[1]
+            self._kw_history = np.concatenate((self._kw_history, block.T), axis=1)[:, -taps:].copy()
+
+    @classmethod
+    def merged(cls, parts: list['_Accumulator']) -> '_Accumulator':
+        """L'accumulatore di un solo passaggio sui segmenti consecutivi
+        `parts`, ognuno alimentato con `prime` dei campioni che lo precedono.
+        Tutti i segmenti tranne l'ultimo devono finire su un bordo di bin del
+        livello base e di sub-blocco della loudness (nessun carry), così bin
+        e sub-blocchi sono gli stessi del passaggio unico. L'ultimo segmento,
+        con il suo carry e le storie dei filtri, diventa quello unito."""
+        acc = parts[-1]
+        acc.frames = sum(part.frames for part in parts)
+        acc._peak = max(part._peak for part in parts)
+        acc._true_peak = max(part._true_peak for part in parts)
+        acc._sum_squares = sum(part._sum_squares for part in parts)
+        acc._kw_energy = [energy for part in parts for energy in part._kw_energy]
+        acc._base_min = [values for part in parts for values in part._base_min]
+        acc._base_max = [values for part in parts for values in part._base_max]
+        acc._base_squares = [values for part in parts for values in part._base_squares]
+        acc._base_channels = [values for part in parts for values in part._base_channels]
+        return acc
+
+    def _feed_channels(self, block: np.ndarray) -> None:
+        """Min, max e media dei quadrati di ogni canale negli stessi bin del
+        downmix, con un proprio carry: colonne (bin, canali, 3). Le
+        riduzioni lavorano sul blocco trasposto (canali, campioni), contiguo
+        lungo i bin: ridurre l'asse dei campioni con i canali interleaved è
+        ~15× più lento."""
+        x = np.concatenate((self._channel_carry, block.T), axis=1)
+        full = x.shape[1] - x.shape[1] % _PYRAMID_BASE_BIN
+        if full:
+            bins = x[:, :full].reshape(self.channels, -1, _PYRAMID_BASE_BIN)
+            cols = np.empty((bins.shape[1], self.channels, 3), np.float32)
+            cols[:, :, 0] = bins.min(axis=2).T
+            cols[:, :, 1] = bins.max(axis=2).T
+            cols[:, :, 2] = np.einsum('cbi,cbi->cb', bins, bins).T * (1 / _PYRAMID_BASE_BIN)
+            self._base_channels.append(cols)
+        self._channel_carry = x[:, full:]
+
+    def _feed_true_peak(self, block: np.ndarray) -> None:
+        """Picco del blocco sovracampionato 4×: per ogni fase del filtro una
+        somma di 12 prodotti su viste sfalsate del blocco, accumulata in
+        due buffer della dimensione del blocco (memoria costante)."""
+        x = np.concatenate((self._tp_history, block))
+        n = len(block)
+        acc = np.empty((n, self.channels), np.float32)
+        tmp = np.empty_like(acc)
+        for phase in _TRUE_PEAK_TAPS:
+            np.multiply(x[_TRUE_PEAK_HISTORY:], phase[0], out=acc)
+            for k in range(1, len(phase)):
+                np.multiply(x[_TRUE_PEAK_HISTORY - k:len(x) - k], phase[k], out=tmp)
+                acc += tmp
+            self._true_peak = max(self._true_peak, float(acc.max()), -float(acc.min()))
+        self._tp_history = x[-_TRUE_PEAK_HISTORY:].copy()
+
+    def _feed_loudness(self, block: np.ndarray) -> None:
+        """K-weighting del blocco (vedi `_k_filter`) ridotto a somme dei
+        quadrati per sub-blocco da 100 ms; come per il livello base, il
+        carry rende i sub-blocchi indipendenti dalla dimensione dei blocchi."""
+        x = np.concatenate((self._kw_history, block.T), axis=1)
+        self._kw_history = x[:, x.shape[1] - self._kw_history.shape[1]:].copy()
+        y = _k_filter(x, self.sample_rate)
+        if self._kw_carry.shape[1]:
+            y = np.concatenate((self._kw_carry, y), axis=1)
+        full = y.shape[1] - y.shape[1] % self._kw_hop
+        if full:
+            hops = y[:, :full].reshape(self.channels, -1, self._kw_hop)
+            self._kw_energy.append(np.einsum('chi,chi->ch', hops, hops).astype(np.float64))
+        self._kw_carry = y[:, full:].copy()
+
+    def preview(self, total_frames: int,
+                columns: int = _PREVIEW_COLUMNS) -> tuple[np.ndarray, np.ndarray, int]:
+        """Envelope parziale (min, max, colonne valide) a `columns` colonne
+        sull'intera durata attesa (`total_frames`): le prime colonne, già
+        decodificate, sono piene, le altre a zero, così la waveform si
+        riempie da sinistra a destra alla scala definitiva."""
+        base_min = np.concatenate(self._base_min) if self._base_min else np.empty(0, np.float32)
+        base_max = np.concatenate(self._base_max) if self._base_max else np.empty(0, np.float32)
+        expected = max(len(base_min), -(-total_frames // _PYRAMID_BASE_BIN), 1)
+        columns = min(columns, expected)
+        idx = (np.arange(columns, dtype=np.int64) * expected) // columns
+        filled = int(np.searchsorted(idx, len(base_min)))
+        lo = np.zeros(columns, dtype=np.float32)
+        hi = np.zeros(columns, dtype=np.float32)
+        if filled:
+            lo[:filled] = np.minimum.reduceat(base_min, idx[:filled])
+            hi[:filled] = np.maximum.reduceat(base_max, idx[:filled])
+        return lo, hi, filled
+
+    def result(self) -> AnalysisResult:
+        if self._tp_history is not None and self.frames:
+            # Coda del filtro: le uscite oltre l'ultimo campione.
+            self._feed_true_peak(np.zeros_like(self._tp_history))
+        base_min, base_max = list(self._base_min), list(self._base_max)
+        base_squares = ([np.concatenate(self._base_squares) * np.float32(1 / _PYRAMID_BASE_BIN)]
+                        if self._base_squares else [])
+        if len(self._carry):
+            base_min.append(self._carry.min(keepdims=True))
+            base_max.append(self._carry.max(keepdims=True))
+            base_squares.append(np.array([np.dot(self._carry, self._carry) / len(self._carry)],
+                                         np.float32))
+        if base_min:
+            levels = _pyramid_from_base(np.concatenate(base_min), np.concatenate(base_max))
+            rms_levels = _rms_pyramid_from_base(np.concatenate(base_squares), len(levels))
+        else:
+            levels = _pyramid_from_base(np.empty(0, np.float32), np.empty(0, np.float32))
+            rms_levels = _rms_pyramid_from_base(np.empty(0, np.float32), len(levels))
+        channel_levels = None
+        if self._channel_carry is not None:
+            base = list(self._base_channels)
+            tail = self._channel_carry
+            if tail.shape[1]:
+                base.append(np.stack((tail.min(axis=1), tail.max(axis=1),
+                                      np.einsum('ci,ci->c', tail, tail) / tail.shape[1]), axis=1)[None])
+            if base:
+                channel_levels = _channel_pyramid_from_base(np.concatenate(base))
+        n = self.frames * self.channels
+        loudness = None
+        if self._kw_history is not None:
+            energy = (np.concatenate(self._kw_energy, axis=1) if self._kw_energy
+                      else np.empty((self.channels, 0)))
+            loudness = _integrated_loudness(energy, self._kw_hop)
+        return AnalysisResult(
+            levels=levels,
+            peak=self._peak,
+            rms=float(np.sqrt(self._sum_squares / n)) if n else 0.0,
+            frames=self.frames,
+            sample_rate=self.sample_rate,
+            channels=self.channels,
+            true_peak=self._true_peak if self._tp_history is not None else None,
+            loudness=loudness,
+            channel_levels=channel_levels,
+            rms_levels=rms_levels,
+        )
+
+
+def _sparse_windows_mp3(file_name: str, probes: int):
+    """Finestre PCM equispaziate di un mp3, senza passare dal seek di
+    libsndfile: su un VBR senza indice il primo seek scandisce tutto il file
+    (~200 ms per un'ora di audio). La posizione è proporzionale ai byte
+    (esatta per i CBR, approssimata per i VBR); ogni finestra è una sequenza
+    di frame interi decodificata a parte da memoria. Yield di un array
+    (frame, canali) o None dove non si trova una sequenza valida."""
+    read_size = _SPARSE_MP3_PREROLL_BYTES + (_SPARSE_MP3_FRAMES + 3) * _MP3_MAX_FRAME_BYTES
+    with open(file_name, 'rb') as fh:
+        start = mp3probe.id3v2_size(fh.read(10))
+        span = max(0, os.fstat(fh.fileno()).st_size - start)
+        for k in range(probes):
+            fh.seek(start + (2 * k + 1) * span // (2 * probes))
+            data = fh.read(read_size)
+            pos = mp3probe.find_frame(data)
+            header = mp3probe.parse_frame_header(data, pos) if pos >= 0 else None
+            if header is None:
+                yield None
+                continue
+            window, preroll = pos, 0
+            while window - pos < _SPARSE_MP3_PREROLL_BYTES:
+                window = mp3probe.frame_run_end(data, window, 1)
+                if window < 0:
+                    break
+                preroll += 1
+            end = mp3probe.frame_run_end(data, window, _SPARSE_MP3_FRAMES) if window >= 0 else -1
+            if end < 0:
+                yield None
+                continue
+            try:
+                pcm, _ = sf.read(io.BytesIO(data[pos:end]), dtype='float32', always_2d=True)
+            except RuntimeError:
+                yield None
+                continue
+            yield pcm[preroll * header.samples:]
+
+
+def _sparse_windows_seek(file_name: str, probes: int):
+    """Finestre PCM equispaziate via seek di soundfile: per WAV/FLAC/OGG il
+    seek è diretto e costa pochissimo."""
+    with sf.SoundFile(file_name) as f:
+        total = len(f)
+        for k in range(probes):
+            f.seek(min(total, (2 * k + 1) * total // (2 * probes)))
+            yield f.read(_SPARSE_WINDOW_FRAMES, dtype='float32', always_2d=True)
+
+
+def sparse_preview(file_name: str, progress=None,
+                   probes: int = _SPARSE_PROBES) -> tuple[np.ndarray, np.ndarray, int]:
+    """Anteprima approssimata dell'envelope in poche decine di ms anche
+    per file di ore: `probes` colonne, ciascuna min/max del downmix mono di
+    una breve finestra campionata al centro della colonna. Sottostima i
+    picchi (vede una frazione del segnale); va sostituita dall'envelope
+    esatto di `analyze`. Nessuna cache. Stesso formato di
+    `_Accumulator.preview`: (min, max, colonne valide)."""
+    lo = np.zeros(probes, dtype=np.float32)
+    hi = np.zeros(probes, dtype=np.float32)
+    windows = None
+    if file_name.lower().endswith('.mp3'):
+        windows = list(_sparse_windows_mp3(file_name, probes))
+        if not any(w is not None and len(w) for w in windows):
+            windows = None  # non è un mp3 Layer III leggibile: prova con soundfile
+    if windows is None:
+        windows = _sparse_windows_seek(file_name, probes)
+    for k, window in enumerate(windows):
+        if window is not None and len(window):
+            mono = window.mean(axis=1)
+            lo[k], hi[k] = mono.min(), mono.max()
+        if progress is not None and k % 16 == 15:
+            progress((k + 1) / probes)
+    return lo, hi, probes
+
+
+def _open_stream(name: str, file_name: str):
+    """Apre file_name con il decoder `name` (vedi `decoders`). Con la cache
+    del PCM attiva, `decoders.PCM_CACHE` legge la voce del file e ogni altro
+    decoder la riempie mentre decodifica (solo per i formati compressi, vedi
+    `decoders.worth_caching`)."""
+    if name == decoders.PCM_CACHE:
+        entry = load_pcm(file_name)
+        if entry is None:
+            raise FileNotFoundError(f"no cached PCM for {file_name}")
+        return decoders.open_pcm(entry)
+    stream = decoders.open_decoder(name, file_name)
+    store = pcm_cache()
+    if store is None or not decoders.worth_caching(file_name):
+        return stream
+    try:
+        writer = store.writer(file_key(file_name), stream.sample_rate, stream.channels)
+    except OSError as exc:
+        logger.warning(f"PCM cache unavailable: {exc}")
+        return stream
+    return decoders.tee_to_cache(stream, writer)
+
+
+def _decoders_for(file_name: str) -> list[str]:
+    """I decoder da provare per file_name, in ordine: la cache del PCM se ha
+    il file, poi `decoders.ranked`."""
+    names = decoders.ranked(file_name)
+    if load_pcm(file_name) is not None:
+        names.insert(0, decoders.PCM_CACHE)
+    return names
+
+
+def _analyze_stream(stream, progress=None, measures: tuple[str, ...] = ()) -> AnalysisResult:
+    """Analisi dei blocchi di un decoder aperto (vedi `_analyze_streaming`)."""
+    acc = _Accumulator(stream.sample_rate, stream.channels, measures)
+    total = max(1, stream.frames)
+    last_preview = None
+    for block in stream:
+        acc.feed(block)
+        if progress is None:
+            continue
+        fraction = min(1.0, stream.position / total)
+        now = time.monotonic()
+        if fraction < 1.0 and (last_preview is None or now - last_preview >= _PREVIEW_INTERVAL_S):
+            last_preview = now
+            progress(fraction, acc.preview(total))
+        else:
+            progress(fraction)
+    return acc.result()
+
+
+def _analyze_streaming(file_name: str, progress=None,
+                       measures: tuple[str, ...] = (), decoder: str | None = None) -> AnalysisResult:
+    """Decode a blocchi con il decoder `decoder` (vedi `decoders`; None = il
+    più veloce per il formato), a memoria costante rispetto al PCM per i
+    decoder in streaming.
+    `measures`: misure opzionali da calcolare nello stesso passaggio
+    (TRUE_PEAK, LOUDNESS; ognuna rallenta l'analisi).
+    `progress(frazione)` viene chiamato dopo ogni blocco, con l'anteprima
+    dell'envelope (`_Accumulator.preview`) come `partial` dopo il primo
+    blocco e poi al più ogni `_PREVIEW_INTERVAL_S`; un'eccezione sollevata
+    dal callback interrompe il decode (cancellazione).
+    Solleva eccezione se il decoder non apre il file (il chiamante ripiega)."""
+    name = decoder or decoders.ranked(file_name)[0]
+    with _open_stream(name, file_name) as stream:
+        result = _analyze_stream(stream, progress, measures)
+    decoders.record(file_name, name, stream)
+    return result
+
+
+# Stato del processo worker dell'analisi a segmenti (`_init_segment_worker`).
+_segment_queue = None
+_segment_cancel = None
+
+
+def _init_segment_worker(queue, cancel) -> None:
+    global _segment_queue, _segment_cancel
+    _segment_queue, _segment_cancel = queue, cancel
+
+
+def _segment_bounds(total: int, sample_rate: int, segments: int) -> list[int]:
+    """Bordi di `segments` segmenti circa uguali di `total` frame, su
+    multipli comuni del bin del livello base e del sub-blocco della loudness
+    (vedi `_Accumulator.merged`)."""
+    quantum = math.lcm(_PYRAMID_BASE_BIN, max(1, round(sample_rate * _LOUDNESS_HOP_S)))
+    inner = {round(total * k / segments / quantum) * quantum for k in range(1, segments)}
+    return [0] + sorted(b for b in inner if 0 < b < total) + [total]
+
+
+def _analyze_segment(file_name: str, name: str, start: int, stop: int | None,
+                     measures: tuple[str, ...], preroll: int,
+                     span: mp3probe.FrameSpan | None = None):
+    """Nel processo worker: i frame [start, stop) di file_name (stop None =
+    fino alla fine) decodificati con `name` partendo `preroll` frame prima
+    di start, che preparano i filtri (`_Accumulator.prime`). Ritorna
+    l'accumulatore senza `result`, i frame di preroll e gli ultimi
+    `preroll` frame del segmento: il chiamante li confronta con quelli dei
+    segmenti vicini per verificare le giunture. Solleva ValueError se il
+    decode finisce prima di `stop`."""
+    begin = max(0, start - preroll)
+    if name == decoders.PCM_CACHE:
+        entry = load_pcm(file_name)
+        if entry is None:
+            raise FileNotFoundError(f"no cached PCM for {file_name}")
+        stream = decoders.open_pcm(entry, begin)
+    else:
+        stream = decoders.open_at(name, file_name, begin, span)
+    with stream:
+        acc = _Accumulator(stream.sample_rate, stream.channels, measures)
+        head = [np.empty((0, stream.channels), np.float32)]
+        tail = head[0]
+        position = begin
+        for block in stream:
+            if stop is not None:
+                block = block[:stop - position]
+            lead = min(max(start - position, 0), len(block))
+            if lead:
+                head.append(block[:lead])
+                acc.prime(block[:lead])
+            body = block[lead:]
+            acc.feed(body)
+            tail = body[-preroll:] if len(body) >= preroll else np.concatenate((tail, body))[-preroll:]
+            position += len(block)
+            if _segment_cancel is not None and _segment_cancel.is_set():
+                raise AnalysisCancelled()
+            if _segment_queue is not None:
+                _segment_queue.put(len(body))
+            if stop is not None and position >= stop:
+                break
+    if stop is not None and position < stop:
+        raise ValueError(f"decode of {os.path.basename(file_name)} ended at {position}, expected {stop}")
+    return acc, np.concatenate(head), tail
+
+
+def _analyze_segments(file_name: str, name: str, measures: tuple[str, ...], workers: int,
+                      progress=None) -> AnalysisResult | None:
+    """Analisi di un file lungo divisa in segmenti decodificati in parallelo
+    da `workers` processi, con lo stesso risultato del passaggio unico: i
+    segmenti tagliano su bordi comuni di bin e sub-blocchi
+    (`_segment_bounds`), ciascuno parte con i campioni precedenti nei filtri
+    (`_Accumulator.prime`) e gli accumulatori si uniscono in ordine
+    (`_Accumulator.merged`).
+
+    Richiede un decoder che parta da un campione qualsiasi con gli stessi
+    campioni del decode dall'inizio (`decoders.open_at`, la cache del PCM);
+    per gli mp3 solo con tag Xing/Info. Ritorna None, e il chiamante fa il
+    passaggio unico, per i file più corti di `ANALYSIS_SEGMENT_MIN_S`, che
+    non si possono dividere, o se un segmento fallisce o le giunture tra
+    segmenti non coincidono. `progress(frazione)` ad ogni intervallo, senza
+    anteprima dell'envelope; un'eccezione del callback ferma i worker."""
+    span_index = None
+    try:
+        if name == decoders.PCM_CACHE:
+            entry = load_pcm(file_name)
+            if entry is None:
+                return None
+            total, sample_rate = entry.frames, entry.sample_rate
+        elif file_name.lower().endswith('.mp3'):
+            if name != 'soundfile':
+                return None
+            span_index = mp3probe.frame_index(file_name)
+            if span_index is None or not len(span_index):
+                return None
+            with decoders.open_decoder(name, file_name) as stream:
+                total, sample_rate = stream.frames, stream.sample_rate
+        else:
+            with decoders.open_at(name, file_name, 0) as stream:
+                total, sample_rate = stream.frames, stream.sample_rate
+    except (OSError, ValueError, RuntimeError) as exc:
+        logger.debug(f"{file_name} not split into segments: {exc}")
+        return None
+    if total < ANALYSIS_SEGMENT_MIN_S * sample_rate:
+        return None
+
+    bounds = _segment_bounds(total, sample_rate, workers * _SEGMENTS_PER_WORKER)
+    preroll = max(_TRUE_PEAK_HISTORY, _k_weighting(sample_rate)[0] - 1, _SEGMENT_SEAM_FRAMES)
+    t0 = time.perf_counter()
+    ctx = multiprocessing.get_context('spawn')
+    queue, cancel = ctx.Queue(), ctx.Event()
+    executor = ProcessPoolExecutor(workers, mp_context=ctx, initializer=_init_segment_worker,
+                                   initargs=(queue, cancel))
+    try:
+        futures = []
+        for k, (start, stop) in enumerate(zip(bounds, bounds[1:])):
+            if span_index is None and k == len(bounds) - 2:
+                stop = None  # l'ultimo segmento legge fino alla fine, come il passaggio unico
+            span = decoders.mp3_span(span_index, max(0, start - preroll)) if span_index else None
+            futures.append(executor.submit(_analyze_segment, file_name, name, start, stop,
+                                           measures, preroll, span))
+        done = 0
+        pending = set(futures)
+        while pending:
+            finished, pending = wait(pending, timeout=_PREVIEW_INTERVAL_S,
+                                     return_when=FIRST_EXCEPTION)
+            if any(future.exception() is not None for future in finished):
+                break
+            try:
+                while True:
+                    done += queue.get_nowait()
+            except Empty:
+                pass
+            if progress is not None:
+                progress(min(1.0, done / max(1, total)))
+        error = next((future.exception() for future in futures
+                      if future.done() and future.exception() is not None), None)
+        if error is not None:
+            logger.warning(f"segmented analysis of {file_name} failed ({error}); analyzing serially")
+            return None
+        parts = [future.result() for future in futures]
+    finally:
+        cancel.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    for (_, _, tail), (_, head, _) in zip(parts, parts[1:]):
+        if not np.array_equal(tail, head):
+            logger.warning(f"segment seams of {file_name} do not match; analyzing serially")
+            return None
+    result = _Accumulator.merged([acc for acc, _, _ in parts]).result()
+    logger.info(f"analyzed {os.path.basename(file_name)} in {len(parts)} segments "
+                f"with {workers} processes: {time.perf_counter() - t0:.2f} s")
+    return result
+
+
+def _segment_workers(workers: int | None) -> int:
+    """Processi dell'analisi a segmenti: `workers`, o `ANALYSIS_SEGMENT_WORKERS`
+    se None (a sua volta None = un processo per core)."""
+    if workers is None:
+        workers = ANALYSIS_SEGMENT_WORKERS
+    if workers is None:
+        workers = os.cpu_count() or 1
+    return max(1, workers)
+
+
+def _quantize(values: np.ndarray) -> np.ndarray:
+    """Livello della piramide nel dtype della cache (ANALYSIS_LEVEL_DTYPE)."""
+    dtype = np.dtype(ANALYSIS_LEVEL_DTYPE)
+    if dtype == np.int8:
+        return np.round(np.clip(values, -1.0, 1.0) * _INT8_SCALE).astype(np.int8)
+    return values.astype(dtype)
+
+
+def dequantize(values: np.ndarray) -> np.ndarray:
+    """Valori di un livello (o di un envelope ricavato da un livello) come
+    float32: i livelli letti dalla cache sono float16 o int8 a seconda di
+    ANALYSIS_LEVEL_DTYPE. Da applicare dopo la riduzione a poche colonne,
+    così la conversione non tocca l'intero livello."""
+    if values.dtype == np.int8:
+        return values * np.float32(1 / _INT8_SCALE)
+    return values.astype(np.float32, copy=False)
+
+
+def level_arrays(result: AnalysisResult) -> list[np.ndarray]:
+    """I livelli di `result` come lista piatta di array, nell'ordine della
+    voce di cache: min0, max0, min1, max1, ... del downmix, poi l'RMS del
+    downmix per livello e un array per livello della piramide per canale.
+    Vedi `levels_from_arrays`."""
+    arrays = [values for level in result.levels for values in level]
+    return arrays + list(result.rms_levels or ()) + list(result.channel_levels or ())
+
+
+def levels_from_arrays(arrays: list[np.ndarray], channel_levels: int, channels: int,
+                       rms_levels: int = 0):
+    """(levels, rms_levels, channel_levels) di un AnalysisResult dagli
+    array di `level_arrays` (anche appiattiti, come li rilegge la cache),
+    con `rms_levels` livelli RMS e `channel_levels` livelli per canale in
+    coda."""
+    split = max(0, len(arrays) - channel_levels)
+    mono = max(0, split - rms_levels)
+    levels = list(zip(arrays[0:mono:2], arrays[1:mono:2]))
+    per_channel = [values.reshape(-1, channels, 3) for values in arrays[split:]]
+    return levels, list(arrays[mono:split]) or None, per_channel or None
+
+
+def _record(result: AnalysisResult) -> tuple[list[np.ndarray], dict]:
+    """(array, metadati) della voce di cache (vedi `level_arrays`)."""
+    return [_quantize(values) for values in level_arrays(result)], _meta(result)
+
+
+def _meta(result: AnalysisResult) -> dict:
+    return {
+        'channel_levels': len(result.channel_levels or ()),
+        'rms_levels': len(result.rms_levels or ()),
+        'peak': result.peak,
+        'rms': result.rms,
+        'frames': result.frames,
+        'sample_rate': result.sample_rate,
+        'channels': result.channels,
+        'true_peak': result.true_peak,
+        'loudness': result.loudness,
+    }
+
+
+def _from_record(meta: dict, arrays: list[np.ndarray]) -> AnalysisResult:
+    levels, rms_levels, channel_levels = levels_from_arrays(
+        arrays, meta.get('channel_levels', 0), meta['channels'], meta.get('rms_levels', 0))
+    return AnalysisResult(
+        levels=levels,
+        rms_levels=rms_levels,
+        channel_levels=channel_levels,
+        peak=meta['peak'],
+        rms=meta['rms'],
+        frames=meta['frames'],
+        sample_rate=meta['sample_rate'],
+        channels=meta['channels'],
+        true_peak=meta.get('true_peak'),
+        loudness=meta.get('loudness'),
+    )
+
+
+def _complete(meta: dict, measures: tuple[str, ...]) -> bool:
+    """True se la voce ha tutte le `measures`: una voce salvata senza true
+    peak o loudness va ricalcolata quando servono. Lo stesso (una volta)
+    per le voci di file stereo salvate prima della piramide per canale."""
+    if 'channel_levels' not in meta and 1 < meta.get('channels', 1) <= _CHANNEL_LEVELS_MAX:
+        return False
+    return all(meta.get(measure) is not None for measure in measures)
+
+
+def _measures_of(result: AnalysisResult) -> tuple[str, ...]:
+    return tuple(m for m in (LOUDNESS, TRUE_PEAK) if getattr(result, m) is not None)
+
+
+def is_cached(file_name: str, measures: tuple[str, ...] | None = None) -> bool:
+    """True se l'analisi del file è già in cache con le `measures` (default:
+    quelle della modalità di normalizzazione attuale). Una stat e una query
+    sull'indice, nessuna lettura della voce né del file: un file mai
+    analizzato da questo path (fingerprint non noto) risulta non in cache."""
+    if measures is None:
+        measures = required_measures()
+    try:
+        key = _cache_key(file_name, known_only=True)
+        meta = cache().meta(key) if key is not None else None
+        return meta is not None and _complete(meta, measures)
+    except sqlite3.Error as exc:
+        logger.debug(f"cache index unavailable: {exc}")
+        return False
+
+
+def load_cached(file_name: str, with_levels: bool = True,
+                measures: tuple[str, ...] | None = None,
+                known_only: bool = False) -> AnalysisResult | None:
+    """AnalysisResult dalla cache disco, o None se assente/illeggibile o
+    senza le `measures` (default: quelle della modalità di normalizzazione
+    attuale; () se basta l'envelope). Nessun decode né copia: i livelli
+    sono viste sul file dati mappato, e la lettura dell'indice non aspetta
+    le scritture degli altri processi (vedi `AnalysisCache.get`). Solo una
+    voce illeggibile viene scartata, con una scrittura nell'indice.
+    Dal main thread va chiamata con `known_only` (vedi `file_key`): None se
+    il fingerprint del file non è ancora noto."""
+    if measures is None:
+        measures = required_measures()
+    key = _cache_key(file_name, known_only)
+    if key is None:
+        return None
+    try:
+        entry = cache().get(key, with_arrays=with_levels)
+    except sqlite3.Error as exc:
+        logger.debug(f"cache index unavailable: {exc}")
+        return None
+    except (OSError, ValueError) as exc:
+        logger.debug(f"cache read failed: {exc}")
+        cache().discard(key)
+        return None
+    if entry is None or not _complete(entry[0], measures):
+        return None
+    return _from_record(*entry)
+
+
+def analyze(file_name: str, measures: tuple[str, ...] = (), progress=None,
+            workers: int | None = None) -> AnalysisResult:
+    """Analisi completa del file in un solo passaggio di decode, cachata su
+    disco: piramide dell'envelope, peak, RMS, durata, samplerate, canali,
+    più le `measures` opzionali (TRUE_PEAK, LOUDNESS; vedi
+    `required_measures`). Una voce in cache senza le misure richieste viene
+    ricalcolata e sostituita.
+
+    Il decode è in streaming (memoria costante anche su file di ore) con il
+    decoder più veloce per il formato (`decoders.ranked`); se non apre il
+    file si passa al successivo, fino al decode completo di librosa per i
+    formati che nessun decoder leggero gestisce. Con la cache del PCM
+    attiva un file già decodificato viene riletto da lì, senza decoder.
+    Con `workers` > 1 (None = `ANALYSIS_SEGMENT_WORKERS`) un file lungo
+    viene diviso in segmenti analizzati in parallelo da altrettanti processi
+    (`_analyze_segments`), con lo stesso risultato.
+    `progress`: vedi `_analyze_streaming`.
+    """
+    cached = load_cached(file_name, measures=measures)
+    if cached is not None:
+        return cached
+
+    names = _decoders_for(file_name)
+    workers = _segment_workers(workers)
+    result = None
+    if workers > 1:
+        result = _analyze_segments(file_name, names[0], measures, workers, progress)
+    if result is None:
+        for name in names:
+            try:
+                result = _analyze_streaming(file_name, progress, measures, name)
+                break
+            except AnalysisCancelled:
+                raise
+            except Exception as exc:
+                if name == names[-1]:
+                    raise
+                logger.debug(f"{name} decode failed ({exc}); trying the next decoder")
+
+    # Stessi livelli quantizzati che si rileggeranno dalla cache: il primo
+    # render è identico a quelli successivi.
+    arrays, meta = _record(result)
+    try:
+        cache().put(_cache_key(file_name), arrays, meta)
+    except (OSError, sqlite3.Error) as exc:
+        logger.warning(f"cache write failed: {exc}")
+    return _from_record(meta, arrays)
+
+
+def seed_cache(file_name: str, content_key: str, result: AnalysisResult) -> bool:
+    """Mette in cache un'analisi calcolata altrove (es. il bundle di un
+    progetto), solo se `content_key` corrisponde al contenuto attuale di
+    file_name (vedi `file_key`). I livelli vengono salvati così come sono,
+    già quantizzati; una voce già in cache con tutte le misure del
+    risultato resta com'è. True se l'analisi del file è ora in cache."""
+    if file_key(file_name) != content_key:
+        return False
+    key = _entry_key(content_key)
+    try:
+        existing = cache().meta(key)
+        if existing is None or not _complete(existing, _measures_of(result)):
+            cache().put(key, level_arrays(result), _meta(result))
+    except (OSError, ValueError, sqlite3.Error) as exc:
+        logger.warning(f"cache seed failed for {file_name}: {exc}")
+        return False
+    return True
+
+
+def compute_peak_gain(file_path: str, progress=None) -> float:
+    """Calcola il gain necessario per portare il picco massimo del file a 1.0."""
+    return analyze(file_path, progress=progress).peak_gain()
+
+
+def compute_normalize_gain(file_path: str, mode: str, progress=None) -> float:
+    """Gain di normalizzazione del file per `mode` (vedi
+    `AnalysisResult.normalize_gain`)."""
+    return analyze(file_path, required_measures(mode), progress).normalize_gain(mode)
+
+
+def run_job(fn, args: tuple, job_id: int, progress_queue, cancel_event):
+    """Entry point nel processo worker: esegue `fn(*args, progress=...)`.
+
+    Il callback inoltra la frazione completata e l'eventuale risultato
+    parziale sulla coda condivisa (`(job_id, frazione, partial)`) e solleva
+    AnalysisCancelled appena l'evento di cancellazione del job è settato.
+    """
+    def progress(fraction: float, partial=None) -> None:
+        if cancel_event.is_set():
+            raise AnalysisCancelled()
+        progress_queue.put((job_id, fraction, partial))
+
+    if cancel_event.is_set():
+        raise AnalysisCancelled()
+    return fn(*args, progress=progress)
@@ -0,0 +1,482 @@
+"""Cache su disco delle analisi, limitata in dimensione e condivisa tra
+processi (worker dello scheduler, più istanze dell'app).
+
+Tutte le voci stanno in un unico file dati (`data-<generazione>.bin`)
+letto con `numpy.memmap`: una voce è una sequenza di array 1-D dello
+stesso dtype, contigui nel file, e la lettura ritorna viste sulla mappa,
+senza aprire file, fare parse o copiare. Un indice sqlite3 nella stessa
+directory tiene per ogni chiave offset, dtype, lunghezze degli array,
+metadati (JSON) e ultimo accesso, più i contatori di hit/miss e l'indice
+laterale path → fingerprint del contenuto (vedi `analysis.file_key`).
+sqlite serializza le scritture tra processi, quindi non serve altro
+locking:
+
+- scrittura: dentro la transazione dell'indice i dati vengono accodati al
+  file dati e sincronizzati su disco, poi la riga viene pubblicata al
+  commit; chi legge vede solo voci complete. I byte di una voce non
+  vengono mai sovrascritti, quindi le viste già ritornate restano valide;
+- lettura: una snapshot WAL dell'indice, senza mai aspettare il lock di
+  scrittura (la lettura avviene anche sul main thread). Ultimo accesso e
+  contatori si accumulano in memoria e vanno nell'indice con la prossima
+  scrittura, o al più ogni _ACCESS_FLUSH_S se il lock è libero;
+- oltre il limite di dimensione si tolgono dall'indice le voci usate meno
+  di recente; quando lo spazio morto nel file supera quello vivo, le voci
+  vive vengono ricopiate in un file di generazione successiva, fuori dal
+  lock di scrittura, che si prende solo per il passaggio di generazione;
+- i file che l'indice non usa (generazioni vecchie, scritture interrotte,
+  cache `.npz` delle versioni precedenti) vengono rimossi da una pulizia
+  periodica.
+
+Nessuna dipendenza Qt.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+_INDEX_NAME = 'index.sqlite'
+# Versione dello schema dell'indice (PRAGMA user_version): se non
+# corrisponde le voci vengono scartate, i file li rimuove il vacuum.
+_SCHEMA_VERSION = 2
+# Allineamento degli offset delle voci nel file dati.
+_ALIGN = 64
+# Spazio morto minimo nel file dati prima di compattarlo.
+_COMPACT_MIN_DEAD_BYTES = 8 * 1024 * 1024
+# Un file non usato dall'indice più giovane di così può essere una
+# compattazione in corso in un altro processo.
+_ORPHAN_GRACE_S = 600
+_VACUUM_INTERVAL_S = 24 * 3600
+# Intervallo minimo tra due tentativi (non bloccanti) di scrivere
+# nell'indice gli accessi accumulati da get().
+_ACCESS_FLUSH_S = 30.0
+# Attesa massima del lock di scrittura (solo scritture: le letture non lo
+# prendono).
+_BUSY_TIMEOUT_S = 30
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    offset INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    dtype TEXT NOT NULL,
+    lengths TEXT NOT NULL,
+    meta TEXT NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS fingerprints (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    fingerprint TEXT NOT NULL
+);
+"""
+
+
+@contextmanager
+def _transaction(db: sqlite3.Connection):
+    """Transazione IMMEDIATE: prende subito il lock di scrittura, così due
+    processi non si incrociano tra lettura e aggiornamento dell'indice."""
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        yield db
+    except BaseException:
+        db.execute('ROLLBACK')
+        raise
+    db.execute('COMMIT')
+
+
+@contextmanager
+def _snapshot(db: sqlite3.Connection):
+    """Transazione di sola lettura (DEFERRED): in WAL una snapshot coerente
+    dell'indice, che non aspetta gli scrittori e non li blocca."""
+    db.execute('BEGIN')
+    try:
+        yield db
+    finally:
+        db.execute('COMMIT')
+
+
+class AnalysisCache:
+    """Cache di voci (array 1-D + metadati JSON) indicizzata per chiave
+    stringa (es. `analysis.file_key` più un suffisso di formato).
+    `max_bytes`: limite dei dati vivi oltre il quale scatta l'eviction LRU."""
+
+    def __init__(self, directory: str, max_bytes: int):
+        self._dir = directory
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._db: sqlite3.Connection | None = None
+        self._map: np.memmap | None = None
+        self._map_generation = -1
+        # Accessi di get() non ancora scritti nell'indice (vedi _flush_access).
+        self._accessed: dict[str, float] = {}
+        self._counts = {'hits': 0, 'misses': 0}
+        self._flushed_at = time.monotonic()
+
+    # --- API -----------------------------------------------------------------
+
+    def get(self, key: str, with_arrays: bool = True) -> tuple[dict, list[np.ndarray]] | None:
+        """(metadati, array) della voce se presente, aggiornandone l'ultimo
+        accesso, o None. Conta un hit o un miss. Gli array sono viste in
+        sola lettura sul file dati mappato; con `with_arrays=False` la
+        lista è vuota e il file dati non viene toccato. Solleva OSError o
+        ValueError se il file dati non contiene la voce (rimosso da fuori):
+        chi legge la tratta come illeggibile e chiama `discard`.
+
+        Non aspetta mai il lock di scrittura: riga e generazione vengono da
+        un solo SELECT (una snapshot WAL). Se nel frattempo una compattazione
+        ha sostituito il file dati della snapshot, la riga si rilegge una
+        volta con la generazione nuova. Una volta mappate, le viste restano
+        valide anche se il vecchio file viene poi rimosso."""
+        with self._lock:
+            db = self._connect()
+            for retry in (False, True):
+                row = db.execute(
+                    "SELECT offset, size, dtype, lengths, meta, "
+                    "(SELECT value FROM meta WHERE name = 'generation') "
+                    "FROM entries WHERE key = ?", (key,)).fetchone()
+                if row is None or not with_arrays:
+                    break
+                offset, size, dtype, lengths, meta, generation = row
+                try:
+                    data = self._mapped(int(generation or 0), offset + size)
+                except (OSError, ValueError):
+                    if retry:
+                        raise
+                    continue
+                break
+            self._record_access(db, key if row is not None else None)
+            if row is None:
+                return None
+            arrays = []
+            if with_arrays:
+                flat = data[offset:offset + size].view(dtype)
+                pos = 0
+                for length in json.loads(lengths):
+                    arrays.append(flat[pos:pos + length])
+                    pos += length
+        return json.loads(row[4]), arrays
+
+    def contains(self, key: str) -> bool:
+        """Come `get` ma senza toccare ultimo accesso e contatori."""
+        with self._lock:
+            row = self._connect().execute('SELECT 1 FROM entries WHERE key = ?', (key,)).fetchone()
+        return row is not None
+
+    def meta(self, key: str) -> dict | None:
+        """Solo i metadati della voce, senza toccare ultimo accesso,
+        contatori e file dati; None se assente."""
+        with self._lock:
+            row = self._connect().execute('SELECT meta FROM entries WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def put(self, key: str, arrays: list[np.ndarray], meta: dict) -> None:
+        """Accoda la voce al file dati e la pubblica nell'indice, poi applica
+        il limite di dimensione e, se è il momento, la pulizia dei file non
+        usati. Gli array devono avere tutti lo stesso dtype; `meta`
+        dev'essere serializzabile in JSON."""
+        arrays = [np.ascontiguousarray(a).ravel() for a in arrays]
+        dtype = arrays[0].dtype if arrays else np.dtype(np.float32)
+        if any(a.dtype != dtype for a in arrays):
+            raise ValueError('all arrays of an entry must share one dtype')
+        size = sum(a.nbytes for a in arrays)
+        with self._lock:
+            db = self._connect()
+            with _transaction(db):
+                self._flush_access(db)
+                generation, end = self._data_state(db)
+                path = self._data_path(generation)
+                try:
+                    intact = os.path.getsize(path) >= end
+                except OSError:
+                    intact = False
+                if not intact:
+                    # File dati rimosso o troncato da fuori: le voci sono perse.
+                    db.execute('DELETE FROM entries')
+                    self._set(db, 'dead_bytes', 0)
+                    end = 0
+                offset = -(-end // _ALIGN) * _ALIGN
+                with open(path, 'ab'):
+                    pass  # crea il file se manca, senza troncarlo
+                with open(path, 'r+b') as fh:
+                    fh.seek(offset)
+                    for a in arrays:
+                        fh.write(memoryview(a).cast('B'))
+                    fh.flush()
+                    os.fsync(fh.fileno())
+                old = db.execute('SELECT size FROM entries WHERE key = ?', (key,)).fetchone()
+                db.execute('INSERT OR REPLACE INTO entries (key, offset, size, dtype, lengths, meta, last_access) '
+                           'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                           (key, offset, size, dtype.str, json.dumps([len(a) for a in arrays]),
+                            json.dumps(meta), time.time()))
+                victims = self._select_victims(db)
+                db.executemany('DELETE FROM entries WHERE key = ?', [(k,) for k, _ in victims])
+                self._bump(db, 'evictions', len(victims))
+                self._bump(db, 'dead_bytes', (old[0] if old else 0) + sum(s for _, s in victims) + offset - end)
+                self._set(db, 'data_end', offset + size)
+            self._compact_if_due(db)
+            self._vacuum_if_due(db)
+
+    def discard(self, key: str) -> None:
+        """Rimuove una voce (es. illeggibile)."""
+        with self._lock:
+            with _transaction(self._connect()) as db:
+                row = db.execute('SELECT size FROM entries WHERE key = ?', (key,)).fetchone()
+                if row is not None:
+                    db.execute('DELETE FROM entries WHERE key = ?', (key,))
+                    self._bump(db, 'dead_bytes', row[0])
+
+    def lookup_fingerprint(self, path: str, mtime_ns: int, size: int) -> str | None:
+        """Fingerprint già calcolato per `path`, se il file non è cambiato
+        (stessi mtime e size) da quando è stato registrato."""
+        with self._lock:
+            row = self._connect().execute(
+                'SELECT fingerprint FROM fingerprints WHERE path = ? AND mtime_ns = ? AND size = ?',
+                (path, mtime_ns, size)).fetchone()
+        return row[0] if row is not None else None
+
+    def store_fingerprint(self, path: str, mtime_ns: int, size: int, fingerprint: str) -> None:
+        with self._lock:
+            self._connect().execute(
+                'INSERT OR REPLACE INTO fingerprints (path, mtime_ns, size, fingerprint) VALUES (?, ?, ?, ?)',
+                (path, mtime_ns, size, fingerprint))
+
+    def stats(self) -> dict:
+        """Contatori cumulativi (tutti i processi) e occupazione attuale:
+        `bytes` sono i dati vivi, `file_bytes` la dimensione del file dati
+        (vivi + spazio morto in attesa di compattazione)."""
+        with self._lock:
+            db = self._connect()
+            with _snapshot(db):
+                entries, used = db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+                counters = dict(db.execute('SELECT name, value FROM meta').fetchall())
+            hits = int(counters.get('hits', 0)) + self._counts['hits']
+            misses = int(counters.get('misses', 0)) + self._counts['misses']
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / (hits + misses) if hits + misses else 0.0,
+            'evictions': int(counters.get('evictions', 0)),
+            'entries': entries,
+            'bytes': used,
+            'file_bytes': int(counters.get('data_end', 0)),
+            'max_bytes': self._max_bytes,
+        }
+
+    # --- interni -------------------------------------------------------------
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            os.makedirs(self._dir, exist_ok=True)
+            db = sqlite3.connect(os.path.join(self._dir, _INDEX_NAME), timeout=_BUSY_TIMEOUT_S,
+                                 isolation_level=None, check_same_thread=False)
+            db.execute('PRAGMA journal_mode=WAL')
+            # In WAL basta per non corrompere l'indice; i dati vengono
+            # comunque sincronizzati da put() prima del commit.
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._migrate(db)
+            db.executescript(_SCHEMA)
+            self._db = db
+        return self._db
+
+    def _record_access(self, db: sqlite3.Connection, key: str | None) -> None:
+        """Registra in memoria un hit su `key` (o un miss se None); ogni
+        _ACCESS_FLUSH_S prova a scrivere gli accessi accumulati, ma solo se
+        il lock di scrittura è libero: altrimenti li porta la prossima
+        scrittura (vedi `put`)."""
+        if key is not None:
+            self._accessed[key] = time.time()
+        self._counts['hits' if key is not None else 'misses'] += 1
+        if time.monotonic() - self._flushed_at < _ACCESS_FLUSH_S:
+            return
+        self._flushed_at = time.monotonic()
+        db.execute('PRAGMA busy_timeout = 0')
+        try:
+            with _transaction(db):
+                self._flush_access(db)
+        except sqlite3.OperationalError:
+            pass  # lock occupato: riprova al prossimo intervallo
+        finally:
+            db.execute(f'PRAGMA busy_timeout = {_BUSY_TIMEOUT_S * 1000}')
+
+    def _flush_access(self, db: sqlite3.Connection) -> None:
+        """Scrive gli accessi accumulati da get(); dentro una transazione
+        IMMEDIATE già aperta."""
+        if self._accessed:
+            db.executemany('UPDATE entries SET last_access = MAX(last_access, ?) WHERE key = ?',
+                           [(t, k) for k, t in self._accessed.items()])
+        for name, count in self._counts.items():
+            self._bump(db, name, count)
+        self._accessed.clear()
+        self._counts = {'hits': 0, 'misses': 0}
+
+    @staticmethod
+    def _migrate(db: sqlite3.Connection) -> None:
+        (version,) = db.execute('PRAGMA user_version').fetchone()
+        if version == _SCHEMA_VERSION:
+            return
+        with _transaction(db):
+            (version,) = db.execute('PRAGMA user_version').fetchone()
+            if version != _SCHEMA_VERSION:
+                db.execute('DROP TABLE IF EXISTS entries')
+                db.execute(f'PRAGMA user_version = {_SCHEMA_VERSION}')
+
+    def _data_path(self, generation: int) -> str:
+        return os.path.join(self._dir, f'data-{generation}.bin')
+
+    @staticmethod
+    def _data_state(db: sqlite3.Connection) -> tuple[int, int]:
+        """(generazione, fine dei dati scritti) del file dati corrente."""
+        state = dict(db.execute(
+            "SELECT name, value FROM meta WHERE name IN ('generation', 'data_end')").fetchall())
+        return int(state.get('generation', 0)), int(state.get('data_end', 0))
+
+    def _mapped(self, generation: int, needed: int) -> np.memmap:
+        """Mappa del file dati della generazione, rifatta se il file è
+        cresciuto oltre la mappa attuale. Le viste sulle mappe precedenti
+        le tengono in vita finché servono."""
+        if self._map_generation != generation or len(self._map) < needed:
+            self._map = np.memmap(self._data_path(generation), dtype=np.uint8, mode='r')
+            self._map_generation = generation
+            if len(self._map) < needed:
+                raise ValueError(f'entry beyond the end of {self._data_path(generation)}')
+        return self._map
+
+    @staticmethod
+    def _set(db: sqlite3.Connection, name: str, value: float) -> None:
+        db.execute('INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)', (name, value))
+
+    @staticmethod
+    def _bump(db: sqlite3.Connection, name: str, amount: int = 1) -> None:
+        if amount:
+            db.execute('INSERT INTO meta (name, value) VALUES (?, ?) '
+                       'ON CONFLICT(name) DO UPDATE SET value = value + excluded.value', (name, amount))
+
+    def _select_victims(self, db: sqlite3.Connection) -> list[tuple[str, int]]:
+        (used,) = db.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()
+        victims = []
+        if used <= self._max_bytes:
+            return victims
+        for key, size in db.execute('SELECT key, size FROM entries ORDER BY last_access').fetchall():
+            victims.append((key, size))
+            used -= size
+            if used <= self._max_bytes:
+                break
+        return victims
+
+    @staticmethod
+    def _wants_compaction(db: sqlite3.Connection) -> bool:
+        row = db.execute("SELECT value FROM meta WHERE name = 'dead_bytes'").fetchone()
+        dead = row[0] if row is not None else 0
+        (live,) = db.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()
+        return dead > _COMPACT_MIN_DEAD_BYTES and dead > live
+
+    def _compact_if_due(self, db: sqlite3.Connection) -> None:
+        """Ricopia le voci vive in un nuovo file dati e rimuove il vecchio.
+        La copia (fino a max_bytes, con fsync) parte da una snapshot
+        dell'indice e gira fuori dal lock di scrittura; il lock si prende
+        solo alla fine, per ricopiare le voci scritte nel frattempo e
+        passare alla generazione nuova. Se un altro processo ha compattato
+        prima, la copia si butta. Chi ha ancora viste sul vecchio file
+        continua a leggerlo (su Windows la rimozione fallisce finché è
+        mappato: ci pensa il vacuum)."""
+        with _snapshot(db):
+            if not self._wants_compaction(db):
+                return
+            generation, _ = self._data_state(db)
+            rows = db.execute('SELECT key, offset, size FROM entries ORDER BY offset').fetchall()
+        source = self._data_path(generation)
+        tmp = os.path.join(self._dir, f'data-{generation + 1}.{os.getpid()}.tmp')
+        moved: dict[tuple[str, int], tuple[int, int]] = {}
+        try:
+            with open(source, 'rb') as src, open(tmp, 'wb') as dst:
+                end = self._copy_entries(src, dst, rows, 0, moved)
+                dst.flush()
+                os.fsync(dst.fileno())
+            with _transaction(db):
+                if self._data_state(db)[0] != generation:
+                    return  # compattato da un altro processo nel frattempo
+                current = db.execute('SELECT key, offset, size FROM entries ORDER BY offset').fetchall()
+                late = [row for row in current if row[:2] not in moved]
+                if late:
+                    with open(source, 'rb') as src, open(tmp, 'r+b') as dst:
+                        end = self._copy_entries(src, dst, late, end, moved)
+                        dst.flush()
+                        os.fsync(dst.fileno())
+                db.executemany('UPDATE entries SET offset = ? WHERE key = ?',
+                               [(moved[(key, offset)][0], key) for key, offset, _ in current])
+                live = {(key, offset) for key, offset, _ in current}
+                os.replace(tmp, self._data_path(generation + 1))
+                self._set(db, 'generation', generation + 1)
+                self._set(db, 'data_end', end)
+                self._set(db, 'dead_bytes', sum(size for k, (_, size) in moved.items() if k not in live))
+        finally:
+            self._unlink(tmp)
+        self._unlink(source)
+        logger.info(f"Analysis cache: compacted {len(current)} entries into {self._data_path(generation + 1)}")
+
+    @staticmethod
+    def _copy_entries(src, dst, rows: list, end: int, moved: dict) -> int:
+        """Copia le voci `rows` (key, offset, size) da `src` in `dst` a
+        partire da `end`, allineate; registra in `moved` (key, offset) →
+        (nuovo offset, size). Ritorna la nuova fine dei dati."""
+        for key, offset, size in rows:
+            target = -(-end // _ALIGN) * _ALIGN
+            src.seek(offset)
+            dst.seek(target)
+            dst.write(src.read(size))
+            moved[(key, offset)] = (target, size)
+            end = target + size
+        return end
+
+    def _vacuum_if_due(self, db: sqlite3.Connection) -> None:
+        """Rimuove i file che l'indice non usa e le righe path → fingerprint
+        di file che non esistono più, al più una volta ogni
+        _VACUUM_INTERVAL_S tra tutti i processi. Gira da `put`, cioè nei
+        worker: mai alla prima connessione del main thread."""
+        now = time.time()
+        row = db.execute("SELECT value FROM meta WHERE name = 'last_vacuum'").fetchone()
+        if row is not None and now - row[0] < _VACUUM_INTERVAL_S:
+            return
+        with _transaction(db):
+            row = db.execute("SELECT value FROM meta WHERE name = 'last_vacuum'").fetchone()
+            if row is not None and now - row[0] < _VACUUM_INTERVAL_S:
+                return
+            self._set(db, 'last_vacuum', now)
+            generation, _ = self._data_state(db)
+            paths = [path for (path,) in db.execute('SELECT path FROM fingerprints')]
+        gone = [(path,) for path in paths if not os.path.exists(path)]
+        if gone:
+            db.executemany('DELETE FROM fingerprints WHERE path = ?', gone)
+        current = os.path.basename(self._data_path(generation))
+        removed = 0
+        for entry in os.scandir(self._dir):
+            if not entry.is_file() or entry.name.startswith(_INDEX_NAME) or entry.name == current:
+                continue
+            try:
+                if now - entry.stat().st_mtime < _ORPHAN_GRACE_S:
+                    continue
+            except OSError:
+                continue
+            self._unlink(entry.path)
+            removed += 1
+        if removed:
+            logger.info(f"Analysis cache: removed {removed} unused files from {self._dir}")
+
+    @staticmethod
+    def _unlink(path: str) -> None:
+        try:
+            os.remove(path)
+        except OSError:
+            pass  # già rimosso da un altro processo, o mappato (Windows): ci pensa il vacuum
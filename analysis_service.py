@@ -0,0 +1,268 @@
+import itertools
+import logging
+import multiprocessing
+import os
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from PyQt5.QtCore import QObject, pyqtSignal
+import analysis
+from constants import ANALYSIS_MAX_WORKERS
+
+logger = logging.getLogger(__name__)
+
+
+class AnalysisJob(QObject):
+    """Handle di un job sottomesso ad AnalysisScheduler. I segnali arrivano
+    sempre sul main thread; dopo `cancel()` non ne arriva più nessuno."""
+
+    progress = pyqtSignal(float)   # frazione 0..1 del decode
+    partial = pyqtSignal(object)   # risultato intermedio (es. anteprima envelope)
+    done = pyqtSignal(object)      # risultato di fn(*args)
+    failed = pyqtSignal(str)
+
+    def __init__(self, task: '_Task', scheduler: 'AnalysisScheduler'):
+        super().__init__()
+        self.fn = task.fn
+        self.args = task.args
+        self.cancelled = False
+        self._task = task
+        self._scheduler = scheduler
+
+    @property
+    def job_id(self) -> int:
+        return self._task.task_id
+
+    def cancel(self) -> None:
+        self._scheduler.cancel(self)
+
+
+class _Task:
+    """Un'esecuzione di fn(*args) nel pool, condivisa da tutti gli handle
+    che l'hanno richiesta mentre era in coda o in esecuzione."""
+
+    def __init__(self, task_id: int, fn, args: tuple):
+        self.task_id = task_id
+        self.fn = fn
+        self.args = args
+        self.key = (fn.__module__, fn.__qualname__, args)
+        self.handles: list[AnalysisJob] = []
+
+
+class AnalysisScheduler(QObject):
+    """Coda unica per tutte le analisi pesanti (decode + envelope, peak).
+
+    I job girano in un pool di processi limitato (`ANALYSIS_MAX_WORKERS`):
+    il decode non contende il GIL con la UI e con 20 widget restano al più
+    N decode contemporanei invece di 40 thread che si litigano disco e CPU.
+    La coda è nostra, non quella dell'executor: un job ancora in coda si
+    cancella togliendolo dalla coda, uno in esecuzione tramite un evento
+    condiviso che il worker controlla ad ogni blocco decodificato.
+
+    Richieste identiche (stessa fn, stessi args) mentre la prima è ancora
+    in coda o in esecuzione non rifanno il decode: si agganciano allo stesso
+    task e ricevono lo stesso risultato. Il task si cancella solo quando
+    tutti i suoi handle sono stati cancellati.
+
+    I risultati tornano dai thread dell'executor e del listener di progress
+    come segnali interni, quindi vengono consegnati sul main thread.
+    """
+
+    _job_progress = pyqtSignal(int, float)
+    _job_partial = pyqtSignal(int, object)
+    _job_finished = pyqtSignal(int, object)
+    _job_failed = pyqtSignal(int, str)
+
+    def __init__(self, max_workers: int | None = ANALYSIS_MAX_WORKERS, parent=None):
+        super().__init__(parent)
+        self._max_workers = max_workers or max(1, (os.cpu_count() or 2) - 1)
+        self._ids = itertools.count(1)
+        self._pending: deque[_Task] = deque()
+        self._running: dict[int, tuple[_Task, object]] = {}  # id → (task, cancel_event)
+        self._active: dict[tuple, _Task] = {}  # chiave → task in coda o in esecuzione
+        self._ctx = multiprocessing.get_context('spawn')  # mai fork con Qt attivo
+        self._executor: ProcessPoolExecutor | None = None
+        self._manager = None
+        self._progress_queue = None
+        self._listener: threading.Thread | None = None
+        self._closed = False
+        self._job_progress.connect(self._on_job_progress)
+        self._job_partial.connect(self._on_job_partial)
+        self._job_finished.connect(self._on_job_finished)
+        self._job_failed.connect(self._on_job_failed)
+
+    def submit(self, fn, *args, urgent: bool = False) -> AnalysisJob:
+        """Accoda `fn(*args, progress=...)`. `fn` dev'essere una funzione
+        top-level di un modulo senza Qt (viene importata nel worker).
+        `urgent`: il job passa in testa alla coda (per lavori brevi il cui
+        risultato serve subito, es. anteprime); non interrompe quelli già
+        in esecuzione."""
+        key = (fn.__module__, fn.__qualname__, args)
+        task = self._active.get(key)
+        if task is None:
+            task = _Task(next(self._ids), fn, args)
+        job = AnalysisJob(task, self)
+        if self._closed:
+            job.cancelled = True
+            return job
+        task.handles.append(job)
+        if key not in self._active:
+            self._active[key] = task
+            if urgent:
+                self._pending.appendleft(task)
+            else:
+                self._pending.append(task)
+            self._dispatch()
+        elif urgent and task in self._pending:
+            self._pending.remove(task)
+            self._pending.appendleft(task)
+        return job
+
+    def cancel(self, job: AnalysisJob) -> None:
+        if job.cancelled:
+            return
+        job.cancelled = True
+        task = job._task
+        try:
+            task.handles.remove(job)
+        except ValueError:
+            return
+        if task.handles:
+            return  # altri handle aspettano ancora il risultato
+        if self._active.get(task.key) is task:
+            del self._active[task.key]
+        try:
+            self._pending.remove(task)
+            return
+        except ValueError:
+            pass
+        entry = self._running.get(task.task_id)
+        if entry is not None:
+            entry[1].set()  # il worker abbandona il decode al prossimo blocco
+
+    def pending_count(self) -> int:
+        return len(self._pending) + len(self._running)
+
+    def shutdown(self) -> None:
+        """Cancella tutto senza attendere i worker. Idempotente."""
+        if self._closed:
+            return
+        self._closed = True
+        tasks = list(self._pending) + [t for t, _ in self._running.values()]
+        for task in tasks:
+            for job in list(task.handles):
+                self.cancel(job)
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+        if self._manager is not None:
+            try:
+                self._progress_queue.put(None)  # sblocca il listener
+            except (EOFError, OSError):
+                pass
+            self._manager.shutdown()
+
+    def _ensure_pool(self) -> None:
+        if self._manager is None:
+            self._manager = self._ctx.Manager()
+            self._progress_queue = self._manager.Queue()
+            self._listener = threading.Thread(target=self._listen, name='analysis-progress', daemon=True)
+            self._listener.start()
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(self._max_workers, mp_context=self._ctx)
+
+    def _dispatch(self) -> None:
+        while self._pending and len(self._running) < self._max_workers and not self._closed:
+            task = self._pending.popleft()
+            self._ensure_pool()
+            cancel_event = self._manager.Event()
+            try:
+                future = self._executor.submit(analysis.run_job, task.fn, task.args, task.task_id,
+                                               self._progress_queue, cancel_event)
+            except BrokenProcessPool:
+                # Un worker è morto (es. crash del decoder nativo): ricrea il pool.
+                self._executor = None
+                self._ensure_pool()
+                future = self._executor.submit(analysis.run_job, task.fn, task.args, task.task_id,
+                                               self._progress_queue, cancel_event)
+            self._running[task.task_id] = (task, cancel_event)
+            future.add_done_callback(lambda f, task_id=task.task_id: self._on_future_done(task_id, f))
+
+    def _on_future_done(self, task_id: int, future) -> None:
+        # Thread dell'executor: solo segnali, la logica gira sul main thread.
+        if future.cancelled():
+            self._job_failed.emit(task_id, 'cancelled')
+            return
+        exc = future.exception()
+        if exc is not None:
+            # BrokenProcessPool: il pool viene ricreato al prossimo submit.
+            self._job_failed.emit(task_id, str(exc) or type(exc).__name__)
+        else:
+            self._job_finished.emit(task_id, future.result())
+
+    def _listen(self) -> None:
+        while True:
+            try:
+                item = self._progress_queue.get()
+            except (EOFError, OSError):
+                return
+            if item is None:
+                return
+            task_id, fraction, partial = item
+            if partial is not None:
+                self._job_partial.emit(task_id, partial)
+            self._job_progress.emit(task_id, fraction)
+
+    def _on_job_progress(self, task_id: int, fraction: float) -> None:
+        entry = self._running.get(task_id)
+        if entry is not None:
+            for job in list(entry[0].handles):
+                job.progress.emit(fraction)
+
+    def _on_job_partial(self, task_id: int, partial) -> None:
+        entry = self._running.get(task_id)
+        if entry is not None:
+            for job in list(entry[0].handles):
+                job.partial.emit(partial)
+
+    def _finish(self, task_id: int) -> list[AnalysisJob]:
+        """Toglie il task dai running e ritorna gli handle ancora attivi."""
+        entry = self._running.pop(task_id, None)
+        if entry is None:
+            return []
+        task = entry[0]
+        if self._active.get(task.key) is task:
+            del self._active[task.key]
+        handles, task.handles = task.handles, []
+        return handles
+
+    def _on_job_finished(self, task_id: int, result) -> None:
+        for job in self._finish(task_id):
+            job.done.emit(result)
+        self._dispatch()
+
+    def _on_job_failed(self, task_id: int, message: str) -> None:
+        handles = self._finish(task_id)
+        if handles:
+            logger.warning(f"Analysis job {handles[0].fn.__name__}{handles[0].args} failed: {message}")
+        for job in handles:
+            job.failed.emit(message)
+        self._dispatch()
+
+
+_scheduler: AnalysisScheduler | None = None
+
+
+def scheduler() -> AnalysisScheduler:
+    """Scheduler di processo, creato al primo uso (serve una QApplication)."""
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = AnalysisScheduler()
+    return _scheduler
+
+
+def shutdown() -> None:
+    """Da chiamare in chiusura dell'app; no-op se lo scheduler non è mai
+    stato usato."""
+    if _scheduler is not None:
+        _scheduler.shutdown()
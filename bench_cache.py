@@ -0,0 +1,193 @@
+"""
+Benchmark del caricamento di un progetto dalla cache delle analisi.
+
+Simula l'apertura di un progetto di PROJECT_TRACKS tracce già analizzate:
+per ogni traccia si legge l'analisi dalla cache e si ricava l'envelope a
+WIDTH colonne (quello che fa WaveformService.generate con la cache calda).
+
+Formati confrontati:
+  npz      un file .npz per traccia, np.load + lettura dei livelli
+           (formato della cache fino alla versione precedente)      [legacy]
+  packed   analysis_cache.AnalysisCache: un solo file dati mappato con
+           numpy.memmap, viste senza copie; livelli in float32, float16
+           e int8
+
+Scenari:
+  cold     nuova istanza della cache e file dati fuori dalla page cache
+           (posix_fadvise DONTNEED, dove disponibile)
+  warm     stessa istanza, dati già in memoria
+
+Le analisi vengono calcolate una volta sui file in audio_test/ e replicate
+sotto chiavi diverse fino a PROJECT_TRACKS voci, in directory temporanee
+separate dalla cache dell'app.
+
+Uso:
+    python bench_cache.py
+"""
+
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+import analysis
+import waveform as wf
+from analysis_cache import AnalysisCache
+
+AUDIO_DIR = Path(__file__).parent / "audio_test"
+PROJECT_TRACKS = 60
+WIDTH = 1500
+RUNS = 5
+BENCH_DIR = os.path.join(tempfile.gettempdir(), "mp3player_bench_cache")
+
+
+# ── formato legacy (solo per benchmark) ──────────────────────────────────────
+
+def _save_npz(path: str, result: analysis.AnalysisResult) -> None:
+    arrays = {
+        'levels': np.int32(len(result.levels)),
+        'peak': np.float64(result.peak),
+        'rms': np.float64(result.rms),
+        'frames': np.int64(result.frames),
+        'sample_rate': np.int32(result.sample_rate),
+        'channels': np.int32(result.channels),
+    }
+    for i, (lo, hi) in enumerate(result.levels):
+        arrays[f'min{i}'] = lo
+        arrays[f'max{i}'] = hi
+    np.savez(path, **arrays)
+
+
+def _load_npz(path: str) -> list:
+    with np.load(path) as data:
+        return [(data[f'min{i}'], data[f'max{i}']) for i in range(int(data['levels']))]
+
+
+# ── utilità ──────────────────────────────────────────────────────────────────
+
+def _drop_page_cache(directory: str) -> bool:
+    """Toglie i file della directory dalla page cache; False se il sistema
+    non lo permette (lo scenario cold misura allora solo l'apertura)."""
+    if not hasattr(os, "posix_fadvise"):
+        return False
+    for entry in os.scandir(directory):
+        fd = os.open(entry.path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+    return True
+
+
+def _project_npz(directory: str) -> None:
+    for i in range(PROJECT_TRACKS):
+        wf.envelope_from_pyramid(_load_npz(os.path.join(directory, f"track{i}.npz")), WIDTH)
+
+
+def _project_packed(cache: AnalysisCache) -> None:
+    for i in range(PROJECT_TRACKS):
+        meta, arrays = cache.get(f"track{i}")
+        wf.envelope_from_pyramid(list(zip(arrays[0::2], arrays[1::2])), WIDTH)
+
+
+def _best(fn, runs: int = RUNS) -> float:
+    times = []
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+# ── benchmark ────────────────────────────────────────────────────────────────
+
+def _build(results: list, level_dtype: str | None) -> str:
+    """Directory con le PROJECT_TRACKS voci nel formato richiesto
+    (None = npz legacy)."""
+    directory = os.path.join(BENCH_DIR, level_dtype or "npz")
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+    if level_dtype is None:
+        for i in range(PROJECT_TRACKS):
+            _save_npz(os.path.join(directory, f"track{i}.npz"), results[i % len(results)])
+        return directory
+    cache = AnalysisCache(directory, 1 << 40)
+    previous, analysis.ANALYSIS_LEVEL_DTYPE = analysis.ANALYSIS_LEVEL_DTYPE, level_dtype
+    try:
+        for i in range(PROJECT_TRACKS):
+            cache.put(f"track{i}", *analysis._record(results[i % len(results)]))
+    finally:
+        analysis.ANALYSIS_LEVEL_DTYPE = previous
+    return directory
+
+
+def _measure(directory: str, packed: bool) -> tuple[float, float, bool]:
+    """(cold, warm, cold reale) in secondi per l'intero progetto."""
+    cold_times = []
+    real_cold = True
+    for _ in range(RUNS):
+        real_cold &= _drop_page_cache(directory)
+        t0 = time.perf_counter()
+        if packed:
+            _project_packed(AnalysisCache(directory, 1 << 40))
+        else:
+            _project_npz(directory)
+        cold_times.append(time.perf_counter() - t0)
+    if packed:
+        cache = AnalysisCache(directory, 1 << 40)
+        _project_packed(cache)
+        warm = _best(lambda: _project_packed(cache))
+    else:
+        _project_npz(directory)
+        warm = _best(lambda: _project_npz(directory))
+    return min(cold_times), warm, real_cold
+
+
+def main():
+    files = sorted(AUDIO_DIR.glob("*.mp3"))
+    if not files:
+        print(f"Nessun file .mp3 trovato in {AUDIO_DIR}")
+        return
+
+    print()
+    print("=" * 78)
+    print("BENCHMARK CARICAMENTO PROGETTO - cache delle analisi")
+    print(f"Tracce: {PROJECT_TRACKS} (da {len(files)} file in {AUDIO_DIR})   |   "
+          f"width: {WIDTH}   |   runs: {RUNS}")
+    print("=" * 78)
+
+    results = [analysis.analyze(str(f)) for f in files]
+
+    formats = [("npz", None), ("packed f32", "float32"), ("packed f16", "float16"), ("packed i8", "int8")]
+    rows = []
+    for label, level_dtype in formats:
+        directory = _build(results, level_dtype)
+        # Solo i dati: l'indice sqlite (e il suo WAL) non dipende dal formato.
+        size = sum(e.stat().st_size for e in os.scandir(directory) if not e.name.startswith("index."))
+        cold, warm, real_cold = _measure(directory, packed=level_dtype is not None)
+        rows.append((label, size, cold, warm, real_cold))
+
+    header = f"{'formato':<12} {'MB dati':>7}  {'cold ms':>9}  {'warm ms':>9}  {'cold x':>7}  {'warm x':>7}"
+    print()
+    print(header)
+    print("-" * len(header))
+    _, _, base_cold, base_warm, _ = rows[0]
+    for label, size, cold, warm, _ in rows:
+        print(f"{label:<12} {size / 1024 / 1024:>7.2f}  {cold * 1000:>9.2f}  {warm * 1000:>9.2f}"
+              f"  {base_cold / cold:>6.2f}x  {base_warm / warm:>6.2f}x")
+    if not all(row[4] for row in rows):
+        print()
+        print("posix_fadvise non disponibile: 'cold' misura solo nuove aperture, "
+              "con i dati ancora in page cache.")
+
+    shutil.rmtree(BENCH_DIR, ignore_errors=True)
+    print()
+    print("=" * 78)
+
+
+if __name__ == "__main__":
+    main()
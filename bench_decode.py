@@ -9,6 +9,8 @@ Metodi:
   sf-stream      soundfile streaming a blocchi + array pre-allocato (stesso decoder,
                  pattern I/O diverso: evita np.concatenate)
   miniaudio      miniaudio.mp3_read_file_f32()  — decoder dr_mp3 (C puro, diverso da mpg123)
+  registry       decoders.ranked(): il decoder scelto dall'app per il formato (per gli mp3
+                 soundfile, perché dr_mp3 satura l'output a ±1)
 
 Uso:
     python bench_decode.py
@@ -23,6 +25,8 @@ import soundfile as sf
 import miniaudio
 import librosa
 
+import decoders
+
 AUDIO_DIR  = Path(__file__).parent / "audio_test"
 BLOCK_SIZE = 262144   # frames per blocco in sf-stream (ottimale da benchmark precedente)
 RUNS       = 5
@@ -65,6 +69,18 @@ def decode_miniaudio(file_path: str) -> np.ndarray:
     return samples
 
 
+def decode_registry(file_path: str) -> np.ndarray:
+    """Decoder scelto dal registro (decoders.ranked), a blocchi come nell'analisi."""
+    with decoders.open_decoder(decoders.ranked(file_path)[0], file_path) as decoder:
+        out = np.empty(max(decoder.frames, 1), dtype=np.float32)
+        for block in decoder:
+            end = decoder.position
+            if end > len(out):
+                out = np.resize(out, end)
+            out[end - len(block):end] = block.mean(axis=1)
+    return out[:decoder.position]
+
+
 def decode_librosa_srNone(file_path: str) -> np.ndarray:
     """librosa: carica e decodifica con resampling opzionale, output float32 mono."""
     samples, _ = librosa.load(file_path, sr=None, mono=True, dtype=np.float32)
@@ -80,6 +96,7 @@ DECODERS = [
     ("sf-fullload", decode_sf_fullload),
     ("sf-stream",   decode_sf_stream),
     ("miniaudio",   decode_miniaudio),
+    ("registry",    decode_registry),
     ("librosa_srNone", decode_librosa_srNone),
     ("librosa_sr11", decode_librosa_sr11),
 ]
@@ -15,11 +15,25 @@ Metodi testati:
   wf.generate_waveform_mem         soundfile + numpy + PIL → bytes         [produzione]
   wf.generate_waveform_librosa     librosa.load (audioread/ffmpeg) → bytes [fallback]
 
+Riduzione dei campioni a colonne (PCM già decodificato, mono, WAVEFORM_WIDTH
+colonne), confrontata su ogni file:
+  _envelope_reshape                step intero + reshape, resto scartato   [legacy]
+  wf._envelope_from_samples        bordi frazionari + reduceat, coda inclusa,
+                                   più l'RMS per colonna
+
+Costo del corpo RMS nel passaggio di analisi: il livello base di
+analysis._Accumulator (`_feed_base`: min, max e somma dei quadrati per
+bin) contro lo stesso senza la somma dei quadrati, sulle stesse viste dei
+blocchi decodificati del file. Il controllo fallisce (exit status 1) se
+per un file l'RMS costa più di RMS_MAX_OVERHEAD del tempo dell'envelope.
+
 Uso:
     python bench_envelope.py
 """
 
+import hashlib
 import os
+import tempfile
 import time
 import traceback
 from pathlib import Path
@@ -31,10 +45,20 @@ import librosa.display
 import matplotlib.pyplot as plt
 from PIL import Image, ImageDraw
 
+import analysis
+import decoders
 import waveform as wf
 
 AUDIO_DIR = Path(__file__).parent / "audio_test"
 RUNS = 3
+# Costo massimo del corpo RMS, in frazione del tempo dell'envelope min/max
+# del livello base, per file. La somma dei quadrati per bin (np.vecdot)
+# misura +9-12% di min e max sulle stesse viste: il "circa 10%" richiesto,
+# con il margine per il rumore della misura; più di così è una regressione.
+RMS_MAX_OVERHEAD = 0.12
+# Le implementazioni legacy scrivono un JPEG: fuori dalla cache delle analisi,
+# che rimuove i file non indicizzati.
+LEGACY_OUTPUT_DIR = os.path.join(tempfile.gettempdir(), "mp3player_bench")
 
 
 # ── utilità ──────────────────────────────────────────────────────────────────
@@ -63,6 +87,12 @@ def _run(fn, *args, runs: int = RUNS):
 
 # ── implementazioni legacy (solo per benchmark) ──────────────────────────────
 
+def _legacy_output_path(file_name: str) -> str:
+    os.makedirs(LEGACY_OUTPUT_DIR, exist_ok=True)
+    h = hashlib.md5(os.path.abspath(file_name).encode()).hexdigest()
+    return os.path.join(LEGACY_OUTPUT_DIR, f"{h}.jpg")
+
+
 def _setup_matplotlib_figure():
     """Helper matplotlib usato dalle implementazioni legacy plot/rosa."""
     plt.style.use('fast')
@@ -83,7 +113,7 @@ def _generate_waveform(file_name, file_duration):
     plt.plot(np.linspace(0, file_duration, len(audio)), audio,
              color='b', linewidth=0.1)
     plt.ylim(-1, 1)
-    path = wf._envelope_cache_path(file_name) + '.jpg'
+    path = _legacy_output_path(file_name)
     plt.savefig(path, format='jpeg', dpi=150)
     plt.close()
     return path
@@ -97,7 +127,7 @@ def _generate_waveform_rosa(file_name, file_duration):
     librosa.display.waveshow(audio, sr=target_sr, axis=None,
                              color='b', linewidth=0.1)
     plt.ylim(-1, 1)
-    path = wf._envelope_cache_path(file_name) + '.jpg'
+    path = _legacy_output_path(file_name)
     plt.savefig(path, format='jpeg', dpi=150)
     plt.close()
     return path
@@ -118,7 +148,7 @@ def _generate_waveform_pillow(file_name, file_duration, width=1500,
         y1 = int(center + min_val * center)
         y2 = int(center + max_val * center)
         draw.line([(x, y1), (x, y2)], fill="blue")
-    path = wf._envelope_cache_path(file_name) + '.jpg'
+    path = _legacy_output_path(file_name)
     img.save(path, 'JPEG')
     return path
 
@@ -126,7 +156,7 @@ def _generate_waveform_pillow(file_name, file_duration, width=1500,
 def _generate_waveform_HS(file_name, file_duration, width=1500,
                           height=75, target_sr=11025):
     """Legacy: soundfile + numpy reshape + PIL canvas, restituisce path."""
-    path = wf._envelope_cache_path(file_name) + '.jpg'
+    path = _legacy_output_path(file_name)
     samples, _ = sf.read(file_name, dtype='float32', always_2d=False)
     if samples.ndim > 1:
         samples = samples.mean(axis=1)
@@ -149,6 +179,14 @@ def _generate_waveform_HS(file_name, file_duration, width=1500,
     return path
 
 
+def _envelope_reshape(samples, width):
+    """Legacy: colonne di len // width campioni, il resto in coda scartato."""
+    n_cols = min(width, len(samples))
+    step = len(samples) // n_cols
+    cols = samples[: step * n_cols].reshape(-1, step)
+    return cols.min(axis=1), cols.max(axis=1)
+
+
 # ── definizione strategie ────────────────────────────────────────────────────
 
 STRATEGIES = [
@@ -161,6 +199,27 @@ STRATEGIES = [
 ]
 
 
+class _MinMaxAccumulator(analysis._Accumulator):
+    """Il livello base senza la somma dei quadrati: il riferimento per il
+    costo del corpo RMS."""
+
+    def _feed_base(self, cols):
+        self._base_min.append(cols.min(axis=1))
+        self._base_max.append(cols.max(axis=1))
+
+
+class _BaseViews(analysis._Accumulator):
+    """Raccoglie le viste (bin, _PYRAMID_BASE_BIN) del downmix che il
+    passaggio di analisi passa a `_feed_base`, senza ridurle."""
+
+    def __init__(self, sample_rate, channels):
+        super().__init__(sample_rate, channels)
+        self.views = []
+
+    def _feed_base(self, cols):
+        self.views.append(cols)
+
+
 # ── benchmark ────────────────────────────────────────────────────────────────
 
 def bench_file(file_path: str) -> dict:
@@ -177,6 +236,58 @@ def bench_file(file_path: str) -> dict:
     }
 
 
+def bench_reducers(files) -> list[tuple[str, float, float]]:
+    """(file, ms reshape, ms reduceat) della sola riduzione a colonne (min e
+    max; con reduceat anche l'RMS), sul PCM mono del file già in memoria
+    (tempo migliore su RUNS * 3 prove)."""
+    rows = []
+    for file_path in files:
+        samples, _ = sf.read(str(file_path), dtype='float32', always_2d=True)
+        samples = np.ascontiguousarray(samples.mean(axis=1))
+        times = []
+        for fn in (_envelope_reshape, wf._envelope_from_samples):
+            best = float('inf')
+            for _ in range(RUNS * 3):
+                t0 = time.perf_counter()
+                fn(samples, wf.WAVEFORM_WIDTH)
+                best = min(best, time.perf_counter() - t0)
+            times.append(best * 1000)
+        rows.append((os.path.basename(file_path), *times))
+    return rows
+
+
+def bench_rms_cost(files) -> list[tuple[str, float, float, float]]:
+    """(file, ms envelope min/max, ms con l'RMS, costo relativo dell'RMS)
+    del livello base di un passaggio di analisi: `_feed_base` con e senza
+    la somma dei quadrati, sulle stesse viste (bin, _PYRAMID_BASE_BIN) che
+    riceve dai blocchi decodificati del file. Le due varianti girano a
+    coppie, una dopo l'altra, per RUNS * 10 prove: tempi e costo sono le
+    mediane, che sulle macchine rumorose reggono meglio del minimo.
+    Decode, downmix e il resto del passaggio, uguali per entrambi, sono
+    esclusi: il confronto è il più sfavorevole all'RMS."""
+    rows = []
+    for file_path in files:
+        with sf.SoundFile(str(file_path)) as f:
+            collector = _BaseViews(f.samplerate, f.channels)
+            for block in f.blocks(decoders._STREAM_BLOCK_FRAMES, dtype='float32', always_2d=True):
+                collector.feed(block)
+        trials = []
+        for _ in range(RUNS * 10):
+            times = []
+            for cls in (_MinMaxAccumulator, analysis._Accumulator):
+                acc = cls(collector.sample_rate, collector.channels)
+                t0 = time.perf_counter()
+                for cols in collector.views:
+                    acc._feed_base(cols)
+                times.append(time.perf_counter() - t0)
+            trials.append(times)
+        minmax_ms = float(np.median([t[0] for t in trials])) * 1000
+        rms_ms = float(np.median([t[1] for t in trials])) * 1000
+        overhead = float(np.median([t[1] / t[0] for t in trials])) - 1
+        rows.append((os.path.basename(file_path), minmax_ms, rms_ms, overhead))
+    return rows
+
+
 # ── report ───────────────────────────────────────────────────────────────────
 
 def _fmt(entry: dict) -> str:
@@ -261,6 +372,23 @@ def main():
         print()
         print(f"Metodo piu veloce: {fastest_label}  ({available[fastest_label]:.3f}s totale)")
 
+    # riduzione a colonne
+    print()
+    print(f"Riduzione a {wf.WAVEFORM_WIDTH} colonne (ms):")
+    print(f"  {'File':<36} {'reshape':>9} {'reduceat':>9} {'rapporto':>9}")
+    for name, reshape_ms, reduceat_ms in bench_reducers(files):
+        print(f"  {name:<36} {reshape_ms:>9.2f} {reduceat_ms:>9.2f} {reduceat_ms / reshape_ms:>8.2f}x")
+
+    # costo del corpo RMS
+    print()
+    print(f"Corpo RMS nel passaggio di analisi (ms, limite +{RMS_MAX_OVERHEAD:.0%}):")
+    print(f"  {'File':<36} {'min/max':>9} {'+RMS':>9} {'costo':>9}")
+    over_limit = []
+    for name, minmax_ms, rms_ms, overhead in bench_rms_cost(files):
+        print(f"  {name:<36} {minmax_ms:>9.2f} {rms_ms:>9.2f} {overhead:>+9.1%}")
+        if overhead > RMS_MAX_OVERHEAD:
+            over_limit.append(f"{name} {overhead:+.1%}")
+
     # errori
     if errors_seen:
         print()
@@ -270,6 +398,8 @@ def main():
 
     print()
     print("=" * 90)
+    if over_limit:
+        raise SystemExit(f"Corpo RMS oltre il limite (max +{RMS_MAX_OVERHEAD:.0%}): {', '.join(over_limit)}")
 
 
 if __name__ == "__main__":
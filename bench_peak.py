@@ -0,0 +1,187 @@
+"""
+Benchmark dell'analisi per la normalizzazione (picco e loudness).
+
+Metodi:
+  legacy     sf.read dell'intero file + mean(axis=1) + np.abs: tre copie
+             complete del PCM in memoria (vecchio compute_peak_gain)   [legacy]
+  stream     analysis._analyze_streaming: riduzione a blocchi, memoria
+             costante (sample peak su tutti i canali)                  [produzione]
+  stream-tp  come stream, più il true peak BS.1770 (oversampling 4× con
+             filtro polifase, modalità 'true_peak')
+  stream-lufs come stream, più la loudness integrata BS.1770 / R128
+             (K-weighting via FFT overlap-save e gating, modalità 'lufs')
+  pcm        come stream, ma rileggendo il PCM dalla cache del PCM
+             (pcm_cache, float16 mappato): nessun decode, solo disco e
+             riduzione. La cache viene riempita prima delle misure; per i
+             WAV l'app non la usa (rileggere il file costa meno).
+
+Per ogni file: tempo, picco di memoria allocata (tracemalloc, che vede
+le allocazioni numpy) e gain risultante. Il legacy misura il picco del
+downmix mono, quindi il suo gain può essere più alto di quello reale.
+
+Oltre ai file in audio_test/ usa un file sintetico di LONG_HOURS ore
+(WAV mono 16 bit, ~650 MB, generato una volta in tempdir): il metodo
+legacy ha bisogno di ~2.5 GB di RAM per leggerlo.
+
+Uso:
+    python bench_peak.py
+"""
+
+import os
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+import soundfile as sf
+
+import analysis
+import decoders
+from pcm_cache import PcmCache
+
+AUDIO_DIR = Path(__file__).parent / "audio_test"
+RUNS = 3
+LONG_HOURS = 2
+LONG_SAMPLE_RATE = 44100
+LONG_FILE = os.path.join(tempfile.gettempdir(), f"mp3player_bench_{LONG_HOURS}h.wav")
+PCM_DIR = os.path.join(tempfile.gettempdir(), "mp3player_bench_pcm")
+
+_pcm: PcmCache | None = None
+
+
+# ── metodi ───────────────────────────────────────────────────────────────────
+
+def _legacy_peak_gain(file_path: str) -> float:
+    """Il vecchio compute_peak_gain, per confronto."""
+    samples, _ = sf.read(file_path, dtype='float32', always_2d=False)
+    if samples.ndim > 1:
+        samples = samples.mean(axis=1)
+    peak = float(np.max(np.abs(samples)))
+    if peak < 1e-9:
+        return 1.0
+    return 1.0 / peak
+
+
+def _stream_peak_gain(file_path: str) -> float:
+    return analysis._analyze_streaming(file_path).normalize_gain('peak')
+
+
+def _stream_true_peak_gain(file_path: str) -> float:
+    return analysis._analyze_streaming(file_path, measures=analysis.required_measures('true_peak')) \
+        .normalize_gain('true_peak')
+
+
+def _stream_lufs_gain(file_path: str) -> float:
+    return analysis._analyze_streaming(file_path, measures=analysis.required_measures('lufs')) \
+        .normalize_gain('lufs')
+
+
+def _pcm_peak_gain(file_path: str) -> float:
+    with decoders.open_pcm(_pcm.get(analysis.file_key(file_path))) as stream:
+        return analysis._analyze_stream(stream).normalize_gain('peak')
+
+
+METHODS = [
+    ("legacy", _legacy_peak_gain),
+    ("stream", _stream_peak_gain),
+    ("stream-tp", _stream_true_peak_gain),
+    ("stream-lufs", _stream_lufs_gain),
+    ("pcm", _pcm_peak_gain),
+]
+
+
+# ── utilità ──────────────────────────────────────────────────────────────────
+
+def _make_long_file() -> str:
+    """Sinusoide a fs/4 sfasata di 45° (campioni a ±0.707 del picco vero)
+    con inviluppo lento e rumore: il true peak supera il sample peak di ~3 dB."""
+    if os.path.exists(LONG_FILE):
+        return LONG_FILE
+    print(f"Generazione di {LONG_FILE} ({LONG_HOURS} h)...")
+    rng = np.random.default_rng(0)
+    chunk = LONG_SAMPLE_RATE * 600
+    total = LONG_SAMPLE_RATE * 3600 * LONG_HOURS
+    tmp = LONG_FILE + ".tmp"
+    with sf.SoundFile(tmp, 'w', LONG_SAMPLE_RATE, 1, 'PCM_16', format='WAV') as f:
+        for start in range(0, total, chunk):
+            n = np.arange(start, min(start + chunk, total))
+            envelope = 0.45 + 0.2 * np.sin(2 * np.pi * n / (LONG_SAMPLE_RATE * 37))
+            tone = np.sin(np.pi / 2 * n + np.pi / 4)
+            f.write((envelope * tone + 0.02 * rng.standard_normal(len(n))).astype(np.float32))
+    os.replace(tmp, LONG_FILE)
+    return LONG_FILE
+
+
+def _fill_pcm(files: list[str]) -> None:
+    """Mette in cache il PCM dei file che non ci sono ancora."""
+    global _pcm
+    _pcm = PcmCache(PCM_DIR, 4096 * 1024 * 1024)
+    for file_path in files:
+        key = analysis.file_key(file_path)
+        if _pcm.get(key) is not None:
+            continue
+        decoder = decoders.open_decoder(decoders.ranked(file_path)[0], file_path)
+        with decoders.tee_to_cache(decoder, _pcm.writer(key, decoder.sample_rate, decoder.channels)) as stream:
+            for _block in stream:
+                pass
+
+
+def _duration(file_path: str) -> float:
+    with sf.SoundFile(file_path) as f:
+        return len(f) / f.samplerate
+
+
+def _measure(fn, file_path: str, runs: int) -> tuple[float, float, float]:
+    """(secondi migliori, MB di picco allocati, gain)."""
+    best = float('inf')
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        gain = fn(file_path)
+        best = min(best, time.perf_counter() - t0)
+    tracemalloc.start()
+    fn(file_path)
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak_bytes / 1024 / 1024, gain
+
+
+# ── benchmark ────────────────────────────────────────────────────────────────
+
+def main():
+    files = [str(f) for f in sorted(AUDIO_DIR.glob("*.mp3"))] + [_make_long_file()]
+    _fill_pcm(files)
+
+    print()
+    print("=" * 100)
+    print("BENCHMARK ANALISI PER LA NORMALIZZAZIONE - picco e loudness")
+    print(f"Directory: {AUDIO_DIR} + file sintetico di {LONG_HOURS} h   |   runs: {RUNS} (1 sul file lungo)")
+    print("=" * 100)
+
+    header = f"{'File':<36} {'dur':>7}" + "".join(
+        f"  {label + ' s':>12} {'MB':>7} {'gain':>6}" for label, _ in METHODS)
+    print()
+    print(header)
+    print("-" * len(header))
+    totals = {label: 0.0 for label, _ in METHODS}
+    for file_path in files:
+        runs = 1 if file_path == LONG_FILE else RUNS
+        line = f"{os.path.basename(file_path)[:36]:<36} {_duration(file_path) / 60:>6.1f}m"
+        for label, fn in METHODS:
+            try:
+                seconds, mb, gain = _measure(fn, file_path, runs)
+            except MemoryError:
+                line += f"  {'OOM':>12} {'':>7} {'':>6}"
+                continue
+            totals[label] += seconds
+            line += f"  {seconds:>12.3f} {mb:>7.1f} {gain:>6.3f}"
+        print(line)
+    print("-" * len(header))
+    print(f"{'TOTALE':<36} {'':>7}" + "".join(f"  {totals[label]:>12.3f} {'':>7} {'':>6}"
+                                              for label, _ in METHODS))
+    print()
+    print("=" * 100)
+
+
+if __name__ == "__main__":
+    main()
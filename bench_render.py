@@ -4,14 +4,17 @@ Benchmark end-to-end di strategie di rendering per la waveform su file MP3 reali
 Ogni strategia misura l'intera pipeline: sf.read → envelope → render → JPEG bytes.
 
 Strategie:
-  current    loop Python per colonne  + PIL JPEG     (generate_waveform_mem attuale)
+  current    loop Python per colonne  + PIL JPEG     (render_envelope storico)
   vec-mask   numpy broadcast (H,W)    + PIL JPEG
   mpl-fill   matplotlib fill_between  + JPEG BytesIO
+  wf         waveform.render_envelope (rasterizer vettoriale + palette PIL)
 
 Il benchmark riporta:
   - tempi end-to-end per file
   - breakdown: I/O+envelope vs solo rendering
   - speedup relativo
+  - solo rasterizzazione: loop per colonne vs waveform.rasterize_envelope a
+    1500x75 e a larghezza 4K, con verifica pixel per pixel e soglia 10x
 
 Uso:
     python bench_render.py
@@ -29,11 +32,16 @@ matplotlib.use("Agg")
 import matplotlib.pyplot as plt
 from PIL import Image
 
+import waveform as wf
+
 AUDIO_DIR = Path(__file__).parent / "audio_test"
 WIDTH  = 1500
 HEIGHT = 75
 RUNS   = 5
 
+RASTER_SIZES   = [(1500, 75), (3840, 75)]   # barra standard e 4K
+RASTER_MIN_SPEEDUP = 10.0
+
 
 # ── pipeline I/O + envelope (identica per tutte) ─────────────────────────────
 
@@ -98,6 +106,12 @@ def _render_mpl_fill(min_v, max_v) -> bytes:
     return buf.getvalue()
 
 
+# ── rendering: strategia 4 — produzione ──────────────────────────────────────
+
+def _render_production(min_v, max_v) -> bytes:
+    return wf.render_envelope(min_v, max_v, HEIGHT)
+
+
 # ── pipeline completa per ogni strategia ─────────────────────────────────────
 
 def pipeline_current(file_path: str) -> bytes:
@@ -109,11 +123,15 @@ def pipeline_vec_mask(file_path: str) -> bytes:
 def pipeline_mpl_fill(file_path: str) -> bytes:
     return _render_mpl_fill(*_load_envelope(file_path))
 
+def pipeline_production(file_path: str) -> bytes:
+    return _render_production(*_load_envelope(file_path))
+
 
 STRATEGIES = [
     ("current",  pipeline_current,  _render_current),
     ("vec-mask", pipeline_vec_mask, _render_vec_mask),
     ("mpl-fill", pipeline_mpl_fill, _render_mpl_fill),
+    ("wf",       pipeline_production, _render_production),
 ]
 
 
@@ -147,6 +165,55 @@ def bench_file(file_path: str) -> dict:
     }
 
 
+# ── solo rasterizzazione: loop per colonne vs vettoriale ─────────────────────
+
+def _rasterize_loop(min_v, max_v, height, gain=1.0) -> np.ndarray:
+    """Rasterizzazione del vecchio render_envelope: un loop Python per
+    colonna sul canvas RGB. Riferimento per velocità e per l'output."""
+    width = len(min_v)
+    canvas = np.ones((height, width, 3), dtype=np.uint8) * 255
+    center = height // 2
+    ys1 = np.clip((center + (min_v * gain * center)).astype(np.int32), 0, height - 1)
+    ys2 = np.clip((center + (max_v * gain * center)).astype(np.int32), 0, height - 1)
+    blue = np.array([0, 0, 255], dtype=np.uint8)
+    for x in range(width):
+        y1, y2 = ys1[x], ys2[x]
+        if y1 <= y2:
+            canvas[y1:y2 + 1, x] = blue
+        else:
+            canvas[y2:y1 + 1, x] = blue
+    return canvas
+
+
+def bench_rasterizer(files) -> bool:
+    """Confronta loop e rasterizer vettoriale sugli envelope reali di ogni
+    file. Ritorna False se l'output differisce o lo speedup complessivo a
+    una delle risoluzioni è sotto RASTER_MIN_SPEEDUP."""
+    ok = True
+    print(f"\n--- Solo rasterizzazione (loop per colonne vs rasterize_envelope) ---\n")
+    hdr = f"{'Risoluzione':<12}  {'loop ms':>9}  {'vec ms':>9}  {'speedup':>8}  {'identico':>8}"
+    print(hdr)
+    _sep(len(hdr))
+    for width, height in RASTER_SIZES:
+        t_loop = t_vec = 0.0
+        identical = True
+        for f in files:
+            min_v, max_v, _ = wf.compute_envelope(str(f), width)
+            for gain in (1.0, 1.8):
+                ref = _rasterize_loop(min_v, max_v, height, gain)
+                identical &= np.array_equal(wf.PALETTE[wf.rasterize_envelope(min_v, max_v, height, gain)], ref)
+                t_loop += _time_fn(_rasterize_loop, min_v, max_v, height, gain)
+                t_vec += _time_fn(wf.rasterize_envelope, min_v, max_v, height, gain, runs=RUNS * 10)
+        n = len(files) * 2
+        speedup = t_loop / t_vec
+        passed = identical and speedup >= RASTER_MIN_SPEEDUP
+        ok &= passed
+        print(f"{f'{width}x{height}':<12}  {t_loop / n * 1000:>9.3f}  {t_vec / n * 1000:>9.3f}"
+              f"  {speedup:>7.1f}x  {'si' if identical else 'NO':>8}{'' if passed else '  <-- FAIL'}")
+    print(f"Soglia: speedup >= {RASTER_MIN_SPEEDUP:.0f}x e output identico pixel per pixel")
+    return ok
+
+
 # ── report ────────────────────────────────────────────────────────────────────
 
 def _sep(width): print("-" * width)
@@ -236,8 +303,12 @@ def main():
         pct   = r_ms / e2e_ms * 100 if e2e_ms else 0
         print(f"  render [{l}]{'':<8}  {r_ms:>7.2f} ms  ({pct:.0f}% del totale end-to-end)")
 
+    raster_ok = bench_rasterizer(files)
+
     print()
     print("=" * 90)
+    if not raster_ok:
+        raise SystemExit(1)
 
 
 if __name__ == "__main__":
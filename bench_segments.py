@@ -0,0 +1,113 @@
+"""
+Benchmark dell'analisi a segmenti in parallelo di un singolo file lungo.
+
+Per ogni file lungo: il passaggio unico (analysis._analyze_streaming) e
+l'analisi a segmenti (analysis._analyze_segments) con 1, 2, 4 e 8
+processi. Per ognuna: tempo, speedup sul passaggio unico e differenze dal
+suo risultato: la piramide dei livelli (min/max e RMS per colonna), il
+sample peak e il true peak devono coincidere esattamente, loudness e RMS
+globale a meno dell'ordine delle somme float (~1e-8).
+
+Con 1 processo si misura il solo costo della divisione (spawn del pool,
+pre-roll dei segmenti); lo speedup dipende dai core della macchina
+(stampati nell'intestazione): su una macchina con meno core dei processi
+richiesti i segmenti si contendono la CPU.
+
+File: il WAV sintetico di bench_peak.py (2 h, generato una volta in
+tempdir) e un mp3 VBR con tag Xing di LONG_MP3_HOURS ore codificato dallo
+stesso segnale (libsndfile con LAME, generato una volta).
+
+Uso:
+    python bench_segments.py [--mode peak|true_peak|lufs|lufs_tp]
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import soundfile as sf
+
+import analysis
+import bench_peak
+
+WORKERS = (1, 2, 4, 8)
+LONG_MP3_HOURS = 1
+LONG_MP3 = os.path.join(tempfile.gettempdir(), f"mp3player_bench_{LONG_MP3_HOURS}h.mp3")
+
+
+# ── utilità ──────────────────────────────────────────────────────────────────
+
+def _make_long_mp3(wav: str) -> str:
+    """Le prime LONG_MP3_HOURS ore del WAV sintetico in mp3 VBR."""
+    if os.path.exists(LONG_MP3):
+        return LONG_MP3
+    print(f"Codifica di {LONG_MP3} ({LONG_MP3_HOURS} h)...")
+    tmp = LONG_MP3 + ".tmp"
+    with sf.SoundFile(wav) as src, \
+            sf.SoundFile(tmp, 'w', src.samplerate, src.channels, 'MPEG_LAYER_III', format='MP3') as dst:
+        limit = src.samplerate * 3600 * LONG_MP3_HOURS
+        for block in src.blocks(src.samplerate * 60, dtype='float32'):
+            dst.write(block[:limit])
+            limit -= len(block)
+            if limit <= 0:
+                break
+    os.replace(tmp, LONG_MP3)
+    return LONG_MP3
+
+
+def _differences(ref: analysis.AnalysisResult, result: analysis.AnalysisResult) -> str:
+    levels = len(ref.levels) == len(result.levels) and all(
+        np.array_equal(a, b) for la, lb in zip(ref.levels, result.levels) for a, b in zip(la, lb))
+    levels = levels and len(ref.rms_levels) == len(result.rms_levels) and all(
+        np.array_equal(a, b) for a, b in zip(ref.rms_levels, result.rms_levels))
+    exact = levels and ref.frames == result.frames and ref.peak == result.peak \
+        and ref.true_peak == result.true_peak
+    line = "esatto" if exact else "DIVERSO"
+    if ref.loudness is not None:
+        line += f" lufs {abs(ref.loudness - result.loudness):.1e}"
+    return line + f" rms {abs(ref.rms - result.rms):.1e}"
+
+
+# ── benchmark ────────────────────────────────────────────────────────────────
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument('--mode', default='peak', choices=analysis.NORMALIZE_MODES)
+    args = parser.parse_args()
+    measures = analysis.required_measures(args.mode)
+
+    wav = bench_peak._make_long_file()
+    files = [wav, _make_long_mp3(wav)]
+
+    print()
+    print("=" * 100)
+    print("BENCHMARK ANALISI A SEGMENTI - un file lungo su più processi")
+    print(f"core: {os.cpu_count()}   |   modalità: {args.mode}   |   processi: {', '.join(map(str, WORKERS))}")
+    print("=" * 100)
+    for file_path in files:
+        name = analysis._decoders_for(file_path)[0]
+        with sf.SoundFile(file_path) as f:
+            minutes = len(f) / f.samplerate / 60
+        print()
+        print(f"{os.path.basename(file_path)}  ({minutes:.0f} min, decoder {name})")
+        t0 = time.perf_counter()
+        ref = analysis._analyze_streaming(file_path, measures=measures, decoder=name)
+        serial = time.perf_counter() - t0
+        print(f"  {'passaggio unico':<18} {serial:>8.2f} s")
+        for workers in WORKERS:
+            t0 = time.perf_counter()
+            result = analysis._analyze_segments(file_path, name, measures, workers)
+            seconds = time.perf_counter() - t0
+            if result is None:
+                print(f"  {workers} processi{'':<8} non divisibile in segmenti")
+                continue
+            print(f"  {workers} processi{'':<8} {seconds:>8.2f} s  {serial / seconds:>5.2f}×  "
+                  + _differences(ref, result))
+    print()
+    print("=" * 100)
+
+
+if __name__ == "__main__":
+    main()
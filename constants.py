@@ -11,7 +11,34 @@ POLL_INTERVAL_MS = 50             # tick del timer globale di poll della UI
 FADE_TICK_MS = 100                # intervallo di step del FadeController
 FADE_STARTUP_DELAY_MS = 100       # delay tra play() e inizio del fade-in
 WAVEFORM_DEBOUNCE_MS = 300        # debounce per refresh waveform su gain
+WAVEFORM_RESIZE_DEBOUNCE_MS = 150 # debounce del re-render waveform al resize della barra
 
 # --- Waveform rendering ---
-WAVEFORM_WIDTH = 1500             # larghezza default del rendering high-res (px)
-WAVEFORM_HEIGHT = 75              # altezza del rendering (px)
+WAVEFORM_WIDTH = 1500             # larghezza del rendering finché la barra non ha una dimensione (px)
+WAVEFORM_HEIGHT = 75              # altezza del rendering finché la barra non ha una dimensione (px)
+WAVEFORM_GAIN_QUANTUM = 0.01      # passo del gain nel rendering (= decimali dello spinbox)
+WAVEFORM_PIXMAP_CACHE_MB = 64     # budget della cache LRU delle pixmap renderizzate
+WAVEFORM_SPARSE_MIN_BYTES = 8 * 1024 * 1024  # file più grandi: anteprima sparsa prima dell'envelope esatto
+WAVEFORM_SPLIT_STEREO = False     # vista stereo separata (L sopra, R sotto) per i widget nuovi; dal menu contestuale della barra
+
+# --- Analisi in background ---
+ANALYSIS_MAX_WORKERS = None       # processi del pool di analisi; None = cpu_count - 1 (min 1)
+ANALYSIS_CACHE_MAX_MB = 512       # limite della cache disco delle analisi (eviction LRU)
+ANALYSIS_LEVEL_DTYPE = 'float16'  # piramide in cache: 'float32', 'float16' o 'int8' (±1 → ±127, clip oltre il fondo scala)
+ANALYSIS_DECODER = None           # decoder forzato: 'soundfile', 'miniaudio' o 'librosa'; None = il più veloce
+                                  # per formato, misurato (decoders.py)
+ANALYSIS_SEGMENT_WORKERS = 1      # processi per l'analisi di un singolo file lungo, diviso in segmenti decodificati
+                                  # in parallelo (stesso risultato): 1 = un solo decode, None = uno per core
+ANALYSIS_SEGMENT_MIN_S = 20 * 60  # durata minima (s) per dividere un file in segmenti
+PCM_CACHE_MAX_MB = 0              # cache disco del PCM decodificato (pcm_cache.py), opt-in: 0 = disattivata.
+                                  # ~10 MB per minuto stereo a 44.1 kHz; rianalizzare un file in cache non lo decodifica
+PCM_CACHE_DTYPE = 'float16'       # 'float16' (rumore ~-66 dB, picchi > 1.0 conservati) o 'int16' (-96 dB, clip oltre il fondo scala)
+
+# --- Normalizzazione ---
+NORMALIZE_MODE = 'peak'           # 'peak' (sample peak a 1.0), 'true_peak' (BS.1770, oversampling 4×: analisi ~2× più lenta),
+                                  # 'lufs' (loudness integrata EBU R128) o 'lufs_tp' (LUFS con tetto di true peak)
+NORMALIZE_TARGET_LUFS = -16.0     # loudness obiettivo delle modalità LUFS
+NORMALIZE_CEILING_DBTP = -1.0     # tetto di true peak (dBTP) della modalità 'lufs_tp'
+NORMALIZE_USE_TAGS = True         # usa i tag ReplayGain / R128 già presenti nei file: gain senza decode
+NORMALIZE_WRITE_GAINS = None      # dopo un'analisi salva le misure: None, 'sidecar' (<file>.gain.json)
+                                  # o 'tags' (ReplayGain nel tag ID3 degli mp3, sidecar per gli altri formati)
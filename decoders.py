@@ -0,0 +1,567 @@
+"""Registro dei decoder usati dall'analisi (`analysis.analyze`).
+
+Ogni decoder apre un file e lo restituisce a blocchi float32 (frame,
+canali), in streaming quando la libreria lo permette:
+
+- soundfile (libsndfile: mpg123 per gli mp3, WAV, FLAC, OGG, ...);
+- miniaudio (dr_flac / dr_wav / stb_vorbis, C puro);
+- librosa (audioread/ffmpeg), decode completo in memoria: solo ripiego per
+  i formati che nessun decoder leggero apre (AAC/M4A, WMA, ...), perché il
+  suo import da solo costa ~1 s.
+
+`ranked(file_name)` ordina i decoder disponibili per il formato del file
+(l'estensione) dal più veloce: la velocità di ciascuno, in secondi di audio
+per secondo di decode, sta in un file JSON accanto alla cache delle
+analisi, condiviso tra processi e sessioni. Quando per un formato manca la
+misura di un candidato, un micro-benchmark la ricava decodificando i primi
+secondi del file in esame con ognuno; ogni decode completo poi la aggiorna
+(`record`). Scelta e throughput finiscono nel log.
+
+`open_at` apre un file da un campione qualsiasi con gli stessi campioni
+del decode dall'inizio, per l'analisi a segmenti in parallelo: per gli mp3
+solo con tag Xing/Info, tramite un indice dei frame (`mp3_span`).
+
+Con la cache del PCM attiva (`pcm_cache`), `tee_to_cache` copia in cache
+quello che un decoder produce e `open_pcm` rilegge una voce con la stessa
+interfaccia di un decoder.
+
+Nessuna dipendenza Qt.
+"""
+import importlib.util
+import itertools
+import json
+import logging
+import math
+import os
+import tempfile
+import time
+from abc import ABC, abstractmethod
+import numpy as np
+import mp3probe
+import pcm_cache
+from constants import ANALYSIS_DECODER
+
+logger = logging.getLogger(__name__)
+
+# In una cartella propria: quella della cache delle analisi viene ripulita
+# dal vacuum di AnalysisCache, che rimuove ogni file non suo.
+_STATS_FILE = os.path.join(tempfile.gettempdir(), 'mp3player_decoders', 'decoders.json')
+
+# Frame per blocco nel decode in streaming: ~64k frame stereo float32 = 512 KB,
+# più il downmix mono. La memoria di picco non dipende dalla durata del file.
+# Multiplo di 1152 (frame MPEG-1 layer III) e di 576 (MPEG-2/2.5): vedi
+# _mp3_first_read.
+_STREAM_BLOCK_FRAMES = 1152 * 56
+
+# Ritardo del decoder mpg123 che si somma all'encoder delay del tag LAME
+# quando il decode è gapless.
+_MPG123_DECODER_DELAY = 529
+
+# Micro-benchmark: secondi di audio decodificati per candidato (o l'intero
+# file se più corto), ripetuti _BENCH_RUNS volte tenendo il tempo migliore.
+_BENCH_SECONDS = 10.0
+_BENCH_RUNS = 2
+
+# Formati PCM non compressi: rileggerli dal file costa quanto (o meno di)
+# rileggerli dalla cache del PCM, che per loro non viene riempita.
+_UNCOMPRESSED = frozenset({'wav', 'aif', 'aiff', 'au', 'raw'})
+
+# Peso di un decode completo nella media mobile della velocità; i decode più
+# corti di _RECORD_MIN_SECONDS di audio non la aggiornano (troppo rumore).
+_RECORD_WEIGHT = 0.25
+_RECORD_MIN_SECONDS = 5.0
+
+# Frame mp3 decodificati e scartati prima del primo campione richiesto a
+# `_Mp3SpanDecoder`: riempiono la riserva di bit e lo stato del filtro di
+# sintesi, dopo i quali i campioni coincidono con quelli del decode
+# dall'inizio (verificato: differenza 0.0 anche con 10 frame).
+_MP3_PREROLL_FRAMES = 16
+# Il filtro di sintesi di mpg123 ruota il suo buffer ogni 32 campioni su 16
+# posizioni, e la posizione cambia l'ordine (quindi l'arrotondamento) delle
+# somme float: il decode deve partire da un frame in cui la rotazione è
+# nella stessa fase del decode dall'inizio, ogni 512 campioni; altrimenti
+# i campioni differiscono di ~1e-8.
+_MP3_SYNTH_PERIOD = 512
+
+
+def _mp3_first_read(file_name: str) -> int:
+    """Frame da leggere prima dei blocchi perché ogni lettura successiva
+    finisca su un bordo di frame mp3.
+
+    Con libsndfile 1.2.2 un mp3 VBR con tag LAME (decode gapless) restituisce
+    PCM sbagliato se una lettura termina a metà di un frame del decoder:
+    migliaia di campioni azzerati/alterati ad ogni bordo di blocco. Il primo
+    frame, dopo il trim di encoder delay + decoder delay, è parziale: basta
+    leggerne prima il resto e poi blocchi multipli di 1152.
+    Ritorna 0 per file non mp3 o senza tag LAME (nessun trim)."""
+    if not file_name.lower().endswith('.mp3'):
+        return 0
+    try:
+        with open(file_name, 'rb') as fh:
+            fh.seek(mp3probe.id3v2_size(fh.read(10)))
+            data = fh.read(4096)
+    except OSError:
+        return 0
+    sync = next((i for i in range(len(data) - 1)
+                 if data[i] == 0xFF and data[i + 1] & 0xE0 == 0xE0), -1)
+    if sync < 0:
+        return 0
+    frame = data[sync:sync + 400]
+    tag = max(frame.find(b'Xing'), frame.find(b'Info'))
+    if tag < 0 or len(frame) < tag + 8:
+        return 0
+    flags = int.from_bytes(frame[tag + 4:tag + 8], 'big')
+    lame = tag + 8 + 4 * bool(flags & 1) + 4 * bool(flags & 2) + 100 * bool(flags & 4) + 4 * bool(flags & 8)
+    if len(frame) < lame + 24:
+        return 0
+    delay = (frame[lame + 21] << 4) | (frame[lame + 22] >> 4)
+    samples_per_frame = 1152 if frame[1] & 0x18 == 0x18 else 576  # MPEG-1 vs 2/2.5
+    return -(delay + _MPG123_DECODER_DELAY) % samples_per_frame
+
+
+# ── decoder ──────────────────────────────────────────────────────────────────
+
+class _Decoder(ABC):
+    """Un file aperto da un decoder. Il costruttore apre il file (e solleva
+    eccezione se il decoder non lo gestisce); iterare l'oggetto produce i
+    blocchi float32 (frame, canali). `frames` è la lunghezza attesa (per il
+    progress: per alcuni formati è una stima), `position` i frame emessi
+    finora, `decode_seconds` il tempo passato dentro il decoder."""
+
+    MODULE = ''                       # libreria Python richiesta
+    FORMATS: frozenset | None = None  # estensioni gestite; None = prova con tutte
+    FALLBACK_ONLY = False             # solo dopo i decoder leggeri, mai nel benchmark
+    SEEKABLE = True                   # il costruttore accetta `start` (vedi open_at)
+
+    sample_rate: int
+    channels: int
+    frames: int
+
+    def __init__(self):
+        self.position = 0
+        self.decode_seconds = 0.0
+
+    @abstractmethod
+    def _blocks(self): ...
+
+    def close(self) -> None:
+        pass
+
+    def __iter__(self):
+        blocks = self._blocks()
+        while True:
+            t0 = time.perf_counter()
+            block = next(blocks, None)
+            self.decode_seconds += time.perf_counter() - t0
+            if block is None:
+                return
+            self.position += len(block)
+            yield block
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class _SoundfileDecoder(_Decoder):
+    MODULE = 'soundfile'
+
+    def __init__(self, file_name: str, start: int = 0):
+        import soundfile as sf
+        super().__init__()
+        self._file_name = file_name
+        self._f = sf.SoundFile(file_name)
+        self.sample_rate = self._f.samplerate
+        self.channels = self._f.channels
+        self.frames = max(0, len(self._f) - start)
+        if start:
+            self._f.seek(start)
+
+    def _blocks(self):
+        """Blocchi di `_STREAM_BLOCK_FRAMES` frame allineati ai frame mp3
+        (vedi _mp3_first_read)."""
+        first = _mp3_first_read(self._file_name)
+        if first and self._f.tell() == 0:
+            yield self._f.read(first, dtype='float32', always_2d=True)
+        yield from self._f.blocks(_STREAM_BLOCK_FRAMES, dtype='float32', always_2d=True)
+
+    def close(self) -> None:
+        self._f.close()
+
+
+class _MiniaudioDecoder(_Decoder):
+    MODULE = 'miniaudio'
+    # Niente mp3: dr_mp3 satura l'output float a ±1, mentre un mp3 può
+    # superare il fondo scala (peak > 1.0, che la normalizzazione deve vedere).
+    FORMATS = frozenset({'flac', 'wav', 'ogg'})
+
+    def __init__(self, file_name: str, start: int = 0):
+        import miniaudio
+        super().__init__()
+        self._miniaudio = miniaudio
+        self._file_name = file_name
+        self._start = start
+        info = miniaudio.get_file_info(file_name)
+        self.sample_rate = info.sample_rate
+        self.channels = info.nchannels
+        self.frames = max(0, info.num_frames - start)
+
+    def _blocks(self):
+        stream = self._miniaudio.stream_file(
+            self._file_name, output_format=self._miniaudio.SampleFormat.FLOAT32,
+            nchannels=self.channels, sample_rate=self.sample_rate,
+            frames_to_read=_STREAM_BLOCK_FRAMES, seek_frame=self._start)
+        for chunk in stream:
+            yield np.frombuffer(chunk, dtype=np.float32).reshape(-1, self.channels)
+
+
+class _LibrosaDecoder(_Decoder):
+    """Decode completo in memoria (audioread/ffmpeg), un solo blocco."""
+
+    MODULE = 'librosa'
+    FALLBACK_ONLY = True
+    SEEKABLE = False
+
+    def __init__(self, file_name: str):
+        import librosa  # lazy import — librosa is heavy
+        super().__init__()
+        t0 = time.perf_counter()
+        samples, sr = librosa.load(file_name, sr=None, mono=False)
+        self.decode_seconds = time.perf_counter() - t0
+        self._samples = np.atleast_2d(samples).T.astype(np.float32, copy=False)
+        self.sample_rate = int(sr)
+        self.channels = self._samples.shape[1]
+        self.frames = len(self._samples)
+
+    def _blocks(self):
+        yield self._samples
+
+
+# In ordine di preferenza a parità di velocità misurata.
+_DECODERS: dict[str, type[_Decoder]] = {
+    'soundfile': _SoundfileDecoder,
+    'miniaudio': _MiniaudioDecoder,
+    'librosa': _LibrosaDecoder,
+}
+
+
+def open_decoder(name: str, file_name: str) -> _Decoder:
+    """Apre file_name con il decoder `name` (una chiave di `_DECODERS`)."""
+    return _DECODERS[name](file_name)
+
+
+# ── decode da metà file ──────────────────────────────────────────────────────
+
+class _SplicedFile:
+    """File virtuale in sola lettura per soundfile: `head` seguito dai byte
+    [begin, end) del file aperto `fh`."""
+
+    def __init__(self, head: bytes, fh, begin: int, end: int):
+        self._head = head
+        self._fh = fh
+        self._begin = begin
+        self._size = len(head) + end - begin
+        self._pos = 0
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        base = {os.SEEK_SET: 0, os.SEEK_CUR: self._pos, os.SEEK_END: self._size}[whence]
+        self._pos = min(max(base + offset, 0), self._size)
+        return self._pos
+
+    def tell(self) -> int:
+        return self._pos
+
+    def read(self, size: int = -1) -> bytes:
+        if size < 0:
+            size = self._size - self._pos
+        size = min(size, self._size - self._pos)
+        data = b''
+        if self._pos < len(self._head):
+            data = self._head[self._pos:self._pos + size]
+        rest = size - len(data)
+        if rest > 0:
+            self._fh.seek(self._begin + self._pos + len(data) - len(self._head))
+            data += self._fh.read(rest)
+        self._pos += len(data)
+        return data
+
+
+class _Mp3SpanDecoder(_Decoder):
+    """Un mp3 con tag Xing/Info dal campione `start` del decode dall'inizio,
+    con gli stessi campioni, senza il seek di libsndfile (inesatto sui VBR).
+
+    Si decodificano da soli i frame di `span`, che parte
+    `_MP3_PREROLL_FRAMES` prima del frame che contiene `start`, preceduti da
+    un frame Xing sintetico con il loro numero: senza, libsndfile stimerebbe
+    la durata dal bitrate del primo frame, troncando o allungando l'uscita.
+    Il tag sintetico non ha encoder delay, quindi il decoder toglie solo il
+    proprio (529 campioni) e il campione j dell'uscita è il campione
+    `first * samples + j - delay` del decode dall'inizio; quelli prima di
+    `start` si scartano. Le letture finiscono sui bordi di frame come in
+    `_mp3_first_read`."""
+
+    MODULE = 'soundfile'
+
+    def __init__(self, file_name: str, span: mp3probe.FrameSpan, start: int):
+        import soundfile as sf
+        super().__init__()
+        self._fh = open(file_name, 'rb')
+        try:
+            source = _SplicedFile(mp3probe.xing_frame(span.header, span.frames),
+                                  self._fh, span.offset, span.end)
+            self._f = sf.SoundFile(source)
+        except Exception:
+            self._fh.close()
+            raise
+        self._skip = start + span.delay - span.first * span.samples
+        if self._skip < 0:
+            self.close()
+            raise ValueError(f"mp3 span starts after sample {start}")
+        self._samples_per_frame = span.samples
+        self.sample_rate = self._f.samplerate
+        self.channels = self._f.channels
+        self.frames = max(0, span.frames * span.samples - _MPG123_DECODER_DELAY - self._skip)
+
+    def _blocks(self):
+        skip = self._skip
+        first = -_MPG123_DECODER_DELAY % self._samples_per_frame
+        reads = self._f.blocks(_STREAM_BLOCK_FRAMES, dtype='float32', always_2d=True)
+        if first:
+            reads = itertools.chain([self._f.read(first, dtype='float32', always_2d=True)], reads)
+        for block in reads:
+            if skip >= len(block):
+                skip -= len(block)
+                continue
+            yield block[skip:]
+            skip = 0
+
+    def close(self) -> None:
+        self._f.close()
+        self._fh.close()
+
+
+def mp3_span(index: mp3probe.FrameIndex, start: int) -> mp3probe.FrameSpan:
+    """I frame di `index` da cui `_Mp3SpanDecoder` ricava il campione
+    `start` (del decode dall'inizio) e i seguenti."""
+    frame = (start + index.delay) // index.samples
+    first = max(0, min(frame, len(index) - 1) - _MP3_PREROLL_FRAMES)
+    return index.span(first - first % (_MP3_SYNTH_PERIOD // math.gcd(_MP3_SYNTH_PERIOD, index.samples)))
+
+
+def open_at(name: str, file_name: str, start: int,
+            span: mp3probe.FrameSpan | None = None) -> _Decoder:
+    """Apre file_name con il decoder `name` dal campione `start`: i blocchi
+    sono quelli del decode dall'inizio da `start` in poi. Gli mp3 richiedono
+    `span` (`mp3_span`) e soundfile. ValueError se il decoder non sa
+    partire da metà file."""
+    if span is not None:
+        if name != 'soundfile':
+            raise ValueError(f"{name} cannot decode an mp3 span")
+        return _Mp3SpanDecoder(file_name, span, start)
+    if not _DECODERS[name].SEEKABLE or _format_of(file_name) == 'mp3':
+        raise ValueError(f"{name} cannot seek exactly in {os.path.basename(file_name)}")
+    return _DECODERS[name](file_name, start)
+
+
+# ── cache del PCM ────────────────────────────────────────────────────────────
+
+# Nome con cui le letture dalla cache del PCM compaiono nel log e in
+# `record` (che non la confronta con i decoder veri).
+PCM_CACHE = 'pcm-cache'
+
+
+class _PcmDecoder(_Decoder):
+    """Una voce della cache del PCM: i blocchi sono fette della mappa,
+    convertite a float32 una alla volta."""
+
+    def __init__(self, entry: pcm_cache.PcmEntry, start: int = 0):
+        super().__init__()
+        self._entry = entry
+        self._start = start
+        self.sample_rate = entry.sample_rate
+        self.channels = entry.channels
+        self.frames = max(0, entry.frames - start)
+
+    def _blocks(self):
+        samples = self._entry.samples[self._start:]
+        for start in range(0, len(samples), _STREAM_BLOCK_FRAMES):
+            yield pcm_cache.as_float32(samples[start:start + _STREAM_BLOCK_FRAMES])
+
+
+class _CachingDecoder:
+    """Decoder che copia i blocchi del decoder avvolto in una voce della
+    cache del PCM, pubblicata solo se il decode arriva in fondo (un decode
+    interrotto o fallito la scarta in `close`)."""
+
+    def __init__(self, decoder: _Decoder, writer: pcm_cache.PcmWriter):
+        self._decoder = decoder
+        self._writer = writer
+        self._complete = False
+        self.sample_rate = decoder.sample_rate
+        self.channels = decoder.channels
+        self.frames = decoder.frames
+
+    @property
+    def position(self) -> int:
+        return self._decoder.position
+
+    @property
+    def decode_seconds(self) -> float:
+        return self._decoder.decode_seconds
+
+    def __iter__(self):
+        for block in self._decoder:
+            self._writer.write(block)
+            yield block
+        self._writer.commit()
+        self._complete = True
+
+    def close(self) -> None:
+        self._decoder.close()
+        if not self._complete:
+            self._writer.abort()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def worth_caching(file_name: str) -> bool:
+    """Il PCM di file_name merita la cache: il formato è compresso."""
+    return _format_of(file_name) not in _UNCOMPRESSED
+
+
+def open_pcm(entry: pcm_cache.PcmEntry, start: int = 0) -> _Decoder:
+    """Decoder che legge una voce della cache del PCM (dal frame `start`)."""
+    return _PcmDecoder(entry, start)
+
+
+def tee_to_cache(decoder: _Decoder, writer: pcm_cache.PcmWriter) -> _CachingDecoder:
+    """`decoder`, che mentre viene letto riempie la voce di `writer`."""
+    return _CachingDecoder(decoder, writer)
+
+
+# ── selezione ────────────────────────────────────────────────────────────────
+
+_available: dict[str, bool] = {}
+_stats: dict[str, dict[str, float]] | None = None
+_announced: set[str] = set()
+
+
+def _is_available(name: str) -> bool:
+    """Libreria del decoder installata; find_spec non la importa."""
+    if name not in _available:
+        _available[name] = importlib.util.find_spec(_DECODERS[name].MODULE) is not None
+    return _available[name]
+
+
+def _format_of(file_name: str) -> str:
+    return os.path.splitext(file_name)[1].lower().lstrip('.')
+
+
+def _load_stats() -> dict[str, dict[str, float]]:
+    try:
+        with open(_STATS_FILE, encoding='utf-8') as fh:
+            stats = json.load(fh)
+        return stats if isinstance(stats, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+
+def _speeds(fmt: str) -> dict[str, float]:
+    global _stats
+    if _stats is None:
+        _stats = _load_stats()
+    return _stats.get(fmt, {})
+
+
+def _save_speeds(fmt: str, speeds: dict[str, float]) -> None:
+    """Aggiorna le velocità di `fmt` nel file condiviso: rilegge quello su
+    disco (altri processi possono averlo aggiornato) e lo sostituisce in
+    modo atomico."""
+    global _stats
+    _stats = _load_stats()
+    _stats.setdefault(fmt, {}).update(speeds)
+    try:
+        os.makedirs(os.path.dirname(_STATS_FILE), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(_STATS_FILE), suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as fh:
+            json.dump(_stats, fh, indent=1, sort_keys=True)
+        os.replace(tmp, _STATS_FILE)
+    except OSError as exc:
+        logger.debug(f"decoder stats not saved: {exc}")
+
+
+def _micro_benchmark(file_name: str, names: list[str]) -> dict[str, float]:
+    """Velocità (secondi di audio per secondo) di ciascun decoder sui primi
+    `_BENCH_SECONDS` di file_name, apertura compresa. Un decoder che non
+    apre il file vale 0: resta in coda, ma viene comunque provato."""
+    speeds = {}
+    for name in names:
+        best = 0.0
+        try:
+            for _ in range(_BENCH_RUNS):
+                t0 = time.perf_counter()
+                with open_decoder(name, file_name) as decoder:
+                    limit = _BENCH_SECONDS * decoder.sample_rate
+                    for _block in decoder:
+                        if decoder.position >= limit:
+                            break
+                    audio = decoder.position / decoder.sample_rate
+                best = max(best, audio / max(time.perf_counter() - t0, 1e-6))
+        except Exception as exc:
+            logger.debug(f"decoder benchmark: {name} cannot open {file_name}: {exc}")
+        speeds[name] = best
+    return speeds
+
+
+def ranked(file_name: str) -> list[str]:
+    """Decoder disponibili per file_name, dal più veloce per il suo formato;
+    i decoder di solo ripiego (librosa) in fondo. Con `ANALYSIS_DECODER`
+    impostato quel decoder va in testa, senza benchmark."""
+    fmt = _format_of(file_name)
+    names = [name for name, cls in _DECODERS.items()
+             if (cls.FORMATS is None or fmt in cls.FORMATS) and _is_available(name)]
+    light = [name for name in names if not _DECODERS[name].FALLBACK_ONLY]
+    fallback = [name for name in names if _DECODERS[name].FALLBACK_ONLY]
+    if ANALYSIS_DECODER in names:
+        return [ANALYSIS_DECODER] + [name for name in light + fallback if name != ANALYSIS_DECODER]
+
+    speeds = _speeds(fmt)
+    missing = [name for name in light if name not in speeds]
+    if len(light) > 1 and missing:
+        measured = _micro_benchmark(file_name, missing)
+        _save_speeds(fmt, measured)
+        speeds = _speeds(fmt)
+        logger.info(f"decoder benchmark .{fmt}: "
+                    + ", ".join(f"{name} {speed:.0f}x" for name, speed in measured.items()))
+    light.sort(key=lambda name: -speeds.get(name, 0.0))
+    if fmt not in _announced and light:
+        _announced.add(fmt)
+        speed = speeds.get(light[0])
+        logger.info(f"decoder for .{fmt}: {light[0]}"
+                    + (f" ({speed:.0f}x realtime)" if speed else ""))
+    return light + fallback
+
+
+def record(file_name: str, name: str, decoder: _Decoder) -> None:
+    """Registra la velocità di un decode completo di file_name con `name`:
+    la logga e la media con quella salvata per il formato (non per le
+    letture dalla cache del PCM)."""
+    audio = decoder.position / max(decoder.sample_rate, 1)
+    if decoder.decode_seconds <= 0 or audio < _RECORD_MIN_SECONDS:
+        return
+    speed = audio / decoder.decode_seconds
+    logger.info(f"decoded {os.path.basename(file_name)} with {name}: "
+                f"{speed:.0f}x realtime ({audio:.0f} s in {decoder.decode_seconds:.2f} s)")
+    if name not in _DECODERS or _DECODERS[name].FALLBACK_ONLY:
+        return
+    fmt = _format_of(file_name)
+    previous = _speeds(fmt).get(name)
+    if previous:
+        speed = (1 - _RECORD_WEIGHT) * previous + _RECORD_WEIGHT * speed
+    _save_speeds(fmt, {name: speed})
@@ -0,0 +1,390 @@
+"""Guadagni di normalizzazione già presenti accanto all'audio: tag
+ReplayGain / R128 (frame TXXX ID3v2, commenti Vorbis di FLAC, Ogg Vorbis
+e Opus) e il sidecar `<file>.gain.json` scritto dall'app. Bastano una
+lettura dell'header del file e nessun decode; `write` salva le misure
+calcolate dall'analisi come tag o come sidecar, così i caricamenti
+successivi (anche su un'altra macchina o a cache svuotata) sono gratuiti.
+
+Nessuna dipendenza Qt né da librerie di tag: solo Python puro sui byte
+del file, come mp3probe. `read` e `write` girano come job dello scheduler.
+"""
+import json
+import logging
+import os
+import shutil
+import struct
+from dataclasses import dataclass
+import analysis
+import mp3probe
+
+logger = logging.getLogger(__name__)
+
+SIDECAR_SUFFIX = '.gain.json'
+
+# Chiavi dei tag (TXXX in ID3, commenti Vorbis): solo i valori di traccia,
+# quelli di album non servono a un player a tracce indipendenti.
+_RG_GAIN = 'REPLAYGAIN_TRACK_GAIN'
+_RG_PEAK = 'REPLAYGAIN_TRACK_PEAK'
+_RG_REFERENCE = 'REPLAYGAIN_REFERENCE_LOUDNESS'
+_R128_GAIN = 'R128_TRACK_GAIN'
+
+# ReplayGain 2.0 porta la traccia a -18 LUFS, equivalenti a 89 dB SPL di
+# REPLAYGAIN_REFERENCE_LOUDNESS; R128_TRACK_GAIN (Q7.8 dB, Opus) a -23 LUFS.
+_RG_REFERENCE_LUFS = -18.0
+_RG_REFERENCE_DB = 89.0
+_R128_REFERENCE_LUFS = -23.0
+
+# Valori fuori da questi limiti sono tag rotti o scritti male: si ignorano.
+_MAX_TAG_GAIN_DB = 51.0
+_MAX_TAG_PEAK = 20.0
+
+# Byte letti dall'inizio di un file Ogg per trovarne l'header dei commenti.
+_OGG_HEAD_BYTES = 256 * 1024
+
+# Padding del tag ID3 quando va riscritto da capo: le scritture successive
+# ci stanno dentro e non copiano più l'audio.
+_ID3_PADDING = 2048
+
+_ID3_ENCODINGS = {0: 'latin-1', 1: 'utf-16', 2: 'utf-16-be', 3: 'utf-8'}
+
+
+@dataclass(frozen=True)
+class StoredGain:
+    """Misure di un file lette da tag o sidecar (None dove mancano), o da
+    scrivere (vedi `from_result`). `source` serve ai log: 'sidecar', 'id3',
+    'vorbis', 'opus' o 'analysis'."""
+
+    source: str
+    peak: float | None = None
+    true_peak: float | None = None
+    loudness: float | None = None
+
+    @classmethod
+    def from_result(cls, result: analysis.AnalysisResult) -> 'StoredGain':
+        return cls('analysis', result.peak, result.true_peak, result.loudness)
+
+    def normalize_gain(self, mode: str) -> float | None:
+        """Gain per `mode` (vedi `analysis.gain_for`), o None se le misure
+        non bastano: i tag ReplayGain danno solo sample peak e loudness, le
+        modalità con true peak passano dall'analisi (o dal sidecar)."""
+        needed = ('peak',) if mode == 'peak' else analysis.required_measures(mode)
+        if any(getattr(self, measure) is None for measure in needed):
+            return None
+        return analysis.gain_for(mode, self.peak or 0.0, self.true_peak, self.loudness)
+
+
+# ── lettura ──────────────────────────────────────────────────────────────────
+
+def read(file_name: str, tags: bool = True, progress=None) -> StoredGain | None:
+    """Misure già disponibili per file_name senza decode: il sidecar, se
+    corrisponde al contenuto attuale del file (fingerprint, vedi
+    `analysis.file_key`), altrimenti i tag ReplayGain / R128 se `tags`.
+    None se non c'è niente di utilizzabile. Legge il tag intero (cover
+    comprese) e può calcolare il fingerprint: dall'app gira come job dello
+    scheduler."""
+    stored = _read_sidecar(file_name)
+    if stored is not None or not tags:
+        return stored
+    try:
+        with open(file_name, 'rb') as fh:
+            magic = fh.read(4)
+            fh.seek(0)
+            if magic[:3] == b'ID3':
+                fields, source = _id3_fields(fh), 'id3'
+            elif magic == b'fLaC':
+                fields, source = _flac_fields(fh), 'vorbis'
+            elif magic == b'OggS':
+                fields, source = _ogg_fields(fh)
+            else:
+                return None
+    except OSError as exc:
+        logger.debug(f"gain tags not readable for {file_name}: {exc}")
+        return None
+    except (ValueError, IndexError, struct.error) as exc:
+        logger.debug(f"malformed tags in {file_name}: {exc}")
+        return None
+    return _from_fields(fields, source)
+
+
+def _from_fields(fields: dict[str, str], source: str) -> StoredGain | None:
+    loudness = None
+    if _R128_GAIN in fields:
+        gain = _parse_number(fields[_R128_GAIN])
+        if gain is not None:
+            gain /= 256
+            loudness = _R128_REFERENCE_LUFS - gain if abs(gain) <= _MAX_TAG_GAIN_DB else None
+    if loudness is None and _RG_GAIN in fields:
+        gain = _parse_number(fields[_RG_GAIN])
+        reference = _parse_number(fields.get(_RG_REFERENCE, ''))
+        reference = _RG_REFERENCE_LUFS + (reference - _RG_REFERENCE_DB if reference is not None else 0.0)
+        if gain is not None and abs(gain) <= _MAX_TAG_GAIN_DB:
+            loudness = reference - gain
+    peak = _parse_number(fields.get(_RG_PEAK, ''))
+    if peak is not None and not 0.0 < peak <= _MAX_TAG_PEAK:
+        peak = None
+    if loudness is None and peak is None:
+        return None
+    return StoredGain(source, peak=peak, loudness=loudness)
+
+
+def _parse_number(value: str) -> float | None:
+    """'-6.54 dB', '0.988', '-1536' → float; None se non è un numero."""
+    value = value.strip()
+    if value[-2:].lower() == 'db':
+        value = value[:-2]
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def _syncsafe(data: bytes) -> int:
+    return (data[0] << 21) | (data[1] << 14) | (data[2] << 7) | data[3]
+
+
+def _id3_frames(body: bytes, version: int):
+    """Frame di un tag ID3v2.2/2.3/2.4 (corpo senza header né extended
+    header): yield di (id, flag, payload grezzo) fino al padding."""
+    id_len, header_len = (3, 6) if version == 2 else (4, 10)
+    pos = 0
+    while pos + header_len <= len(body) and body[pos] != 0:
+        frame_id = body[pos:pos + id_len]
+        if version == 2:
+            size = int.from_bytes(body[pos + 3:pos + 6], 'big')
+            flags = b''
+        else:
+            size_bytes = body[pos + 4:pos + 8]
+            size = _syncsafe(size_bytes) if version == 4 else int.from_bytes(size_bytes, 'big')
+            flags = body[pos + 8:pos + 10]
+        yield frame_id, flags, body[pos + header_len:pos + header_len + size]
+        pos += header_len + size
+
+
+def _txxx(version: int, flags: bytes, payload: bytes) -> tuple[str, str] | None:
+    """(descrizione, valore) di un frame TXXX/TXX; None se compresso o
+    cifrato."""
+    if version == 3 and flags[1] & 0xC0:
+        return None
+    if version == 4:
+        if flags[1] & 0x0C:
+            return None
+        if flags[1] & 0x02:
+            payload = payload.replace(b'\xff\x00', b'\xff')
+        if flags[1] & 0x01:  # data length indicator
+            payload = payload[4:]
+    if not payload or payload[0] not in _ID3_ENCODINGS:
+        return None
+    encoding, text = _ID3_ENCODINGS[payload[0]], payload[1:]
+    if payload[0] in (1, 2):
+        sep = next((i for i in range(0, len(text) - 1, 2) if text[i:i + 2] == b'\0\0'), len(text))
+        value = text[sep + 2:]
+    else:
+        sep = text.find(b'\0')
+        sep = len(text) if sep < 0 else sep
+        value = text[sep + 1:]
+    return (text[:sep].decode(encoding, 'replace'),
+            value.decode(encoding, 'replace').rstrip('\0'))
+
+
+def _id3_fields(fh) -> dict[str, str]:
+    """Frame TXXX del tag ID3v2 in testa al file, per descrizione."""
+    head = fh.read(10)
+    body = fh.read(mp3probe.id3v2_size(head) - 10 - (10 if head[5] & 0x10 else 0))
+    version, flags = head[3], head[5]
+    if flags & 0x80:  # unsynchronisation dell'intero tag
+        body = body.replace(b'\xff\x00', b'\xff')
+    if flags & 0x40 and version >= 3:  # extended header
+        body = body[4 + int.from_bytes(body[:4], 'big'):] if version == 3 else body[_syncsafe(body[:4]):]
+    fields = {}
+    for frame_id, frame_flags, payload in _id3_frames(body, version):
+        if frame_id in (b'TXXX', b'TXX'):
+            text = _txxx(version, frame_flags, payload)
+            if text is not None:
+                fields[text[0].upper()] = text[1]
+    return fields
+
+
+def _vorbis_comment(data: bytes, offset: int = 0) -> dict[str, str]:
+    """Campi di un blocco di commenti Vorbis (FLAC, Ogg Vorbis, OpusTags)."""
+    vendor = struct.unpack_from('<I', data, offset)[0]
+    offset += 4 + vendor
+    count = struct.unpack_from('<I', data, offset)[0]
+    offset += 4
+    fields = {}
+    for _ in range(count):
+        length = struct.unpack_from('<I', data, offset)[0]
+        key, _, value = data[offset + 4:offset + 4 + length].decode('utf-8', 'replace').partition('=')
+        fields[key.upper()] = value
+        offset += 4 + length
+    return fields
+
+
+def _flac_fields(fh) -> dict[str, str]:
+    """Commenti del blocco VORBIS_COMMENT di un FLAC."""
+    fh.read(4)
+    while True:
+        header = fh.read(4)
+        if len(header) < 4:
+            return {}
+        length = int.from_bytes(header[1:4], 'big')
+        if header[0] & 0x7F == 4:
+            return _vorbis_comment(fh.read(length))
+        if header[0] & 0x80:  # ultimo blocco di metadati
+            return {}
+        fh.seek(length, os.SEEK_CUR)
+
+
+def _ogg_fields(fh) -> tuple[dict[str, str], str]:
+    """Commenti del secondo pacchetto (header dei commenti) del primo
+    stream logico di un Ogg Vorbis o Opus, e la sorgente."""
+    data = fh.read(_OGG_HEAD_BYTES)
+    packets, current, serial, pos = [], [], None, 0
+    while len(packets) < 2 and data[pos:pos + 4] == b'OggS':
+        page_serial = data[pos + 14:pos + 18]
+        segments = data[pos + 26]
+        lacing = data[pos + 27:pos + 27 + segments]
+        offset = pos + 27 + segments
+        pos = offset + sum(lacing)
+        if serial is None:
+            serial = page_serial
+        elif page_serial != serial:
+            continue
+        for lace in lacing:
+            current.append(data[offset:offset + lace])
+            offset += lace
+            if lace < 255:
+                packets.append(b''.join(current))
+                current = []
+    if len(packets) < 2:
+        return {}, 'vorbis'
+    if packets[1].startswith(b'OpusTags'):
+        return _vorbis_comment(packets[1], 8), 'opus'
+    if packets[1].startswith(b'\x03vorbis'):
+        return _vorbis_comment(packets[1], 7), 'vorbis'
+    return {}, 'vorbis'
+
+
+def _read_sidecar(file_name: str) -> StoredGain | None:
+    try:
+        with open(file_name + SIDECAR_SUFFIX, encoding='utf-8') as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as exc:
+        logger.debug(f"gain sidecar for {file_name} not readable: {exc}")
+        return None
+    if not isinstance(data, dict) or data.get('fingerprint') != analysis.file_key(file_name):
+        logger.debug(f"gain sidecar for {file_name} is stale")
+        return None
+    return StoredGain('sidecar', data.get('peak'), data.get('true_peak'), data.get('loudness'))
+
+
+# ── scrittura ────────────────────────────────────────────────────────────────
+
+def write(file_name: str, stored: StoredGain, target: str, progress=None) -> bool:
+    """Salva le misure di `stored` per i caricamenti successivi.
+
+    `target` 'sidecar': `<file>.gain.json` con il fingerprint del contenuto
+    (vedi `read`), unito a un sidecar valido già presente. 'tags': frame
+    TXXX REPLAYGAIN_TRACK_GAIN/PEAK nel tag ID3v2.3/2.4 degli mp3 — se il
+    tag ha spazio la scrittura è in place, altrimenti il file viene
+    riscritto con un tag nuovo; l'analisi in cache passa alla nuova chiave
+    del contenuto. Per gli altri formati, per i tag ID3 che non si sanno
+    riscrivere o se la riscrittura del file fallisce (disco pieno, cartella
+    in sola lettura, su Windows il file aperto da un altro programma) e per
+    le misure senza loudness si ripiega sul sidecar. Solleva OSError se
+    fallisce anche quello."""
+    if target == 'tags' and stored.loudness is not None and file_name.lower().endswith('.mp3'):
+        cached = analysis.load_cached(file_name, measures=())
+        try:
+            written = _write_id3(file_name, stored)
+        except OSError as exc:
+            logger.warning(f"Writing ReplayGain tags to {file_name} failed ({exc}): using a sidecar")
+            written = False
+        if written:
+            if cached is not None:
+                analysis.seed_cache(file_name, analysis.file_key(file_name), cached)
+            logger.info(f"ReplayGain tags written to {file_name}")
+            return True
+    _write_sidecar(file_name, stored)
+    return True
+
+
+def _write_sidecar(file_name: str, stored: StoredGain) -> None:
+    previous = _read_sidecar(file_name)
+    data = {'fingerprint': analysis.file_key(file_name)}
+    for field in ('peak', 'true_peak', 'loudness'):
+        value = getattr(stored, field)
+        if value is None and previous is not None:
+            value = getattr(previous, field)
+        if value is not None:
+            data[field] = value
+    path = file_name + SIDECAR_SUFFIX
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=4)
+    os.replace(tmp, path)
+    logger.info(f"Gain sidecar written to {path}")
+
+
+def _id3_header(version: int, size: int) -> bytes:
+    return b'ID3' + bytes((version, 0, 0)) + bytes(((size >> 21) & 0x7F, (size >> 14) & 0x7F,
+                                                   (size >> 7) & 0x7F, size & 0x7F))
+
+
+def _id3_frame(version: int, frame_id: bytes, flags: bytes, payload: bytes) -> bytes:
+    size = len(payload)
+    if version == 4:
+        size_bytes = bytes(((size >> 21) & 0x7F, (size >> 14) & 0x7F, (size >> 7) & 0x7F, size & 0x7F))
+    else:
+        size_bytes = size.to_bytes(4, 'big')
+    return frame_id + size_bytes + flags + payload
+
+
+def _write_id3(file_name: str, stored: StoredGain) -> bool:
+    """Scrive i frame ReplayGain nel tag ID3v2 in testa al file (creandolo
+    v2.4 se manca). False, senza toccare il file, se il tag esistente usa
+    unsynchronisation, extended header o footer, o è v2.2. Il file si
+    riscrive sempre in una copia sostituita con os.replace: un crash o il
+    disco pieno a metà scrittura non lasciano un tag rotto sul file audio."""
+    values = {_RG_GAIN: f"{_RG_REFERENCE_LUFS - stored.loudness:+.2f} dB"}
+    if stored.peak is not None:
+        values[_RG_PEAK] = f"{stored.peak:.6f}"
+    with open(file_name, 'rb') as fh:
+        head = fh.read(10)
+        old_size = mp3probe.id3v2_size(head)
+        if old_size:
+            version = head[3]
+            if version not in (3, 4) or head[5] & 0xD0:
+                logger.info(f"ID3v2.{version} tag of {file_name} not rewritable: using a sidecar")
+                return False
+            frames = list(_id3_frames(fh.read(old_size - 10), version))
+        else:
+            version, frames = 4, []
+    kept = b''.join(
+        _id3_frame(version, frame_id, flags, payload) for frame_id, flags, payload in frames
+        if frame_id != b'TXXX' or (_txxx(version, flags, payload) or ('',))[0].upper() not in values)
+    added = b''.join(
+        _id3_frame(version, b'TXXX', b'\0\0', b'\0' + key.encode('latin-1') + b'\0' + value.encode('latin-1'))
+        for key, value in values.items())
+    frames_data = kept + added
+
+    if old_size and 10 + len(frames_data) <= old_size:
+        # Ci sta nel tag esistente: stessa dimensione, l'audio resta allo
+        # stesso offset.
+        tag_size = old_size - 10
+    else:
+        tag_size = len(frames_data) + _ID3_PADDING
+    tmp = file_name + '.tmp'
+    try:
+        with open(file_name, 'rb') as src, open(tmp, 'wb') as dst:
+            dst.write(_id3_header(version, tag_size) + frames_data + bytes(tag_size - len(frames_data)))
+            src.seek(old_size)
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+        shutil.copymode(file_name, tmp)
+        os.replace(tmp, file_name)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return True
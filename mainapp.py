@@ -1,14 +1,18 @@
 import sys
 import os
 import logging
-from PyQt5.QtWidgets import QApplication, QMainWindow, QFileDialog, QWidget, QGridLayout, QScrollArea, QMessageBox, QAction
+from PyQt5.QtWidgets import (QApplication, QMainWindow, QFileDialog, QWidget, QGridLayout, QScrollArea, QMessageBox,
+                             QAction, QActionGroup)
 from PyQt5.QtCore import Qt, QTimer
 from PyQt5.QtGui import QPainter, QColor, QPen
+import analysis
+import analysis_service
+import waveform_service
 from mp3file import Mp3File
 from mp3widget import Mp3Widget, WidgetLayout
-from project_manager import ProjectManager
+from project_manager import ProjectManager, seed_bundle_entry
 from grid_manager import GridManager
-from constants import POLL_INTERVAL_MS
+from constants import POLL_INTERVAL_MS, NORMALIZE_CEILING_DBTP, NORMALIZE_TARGET_LUFS
 
 logger = logging.getLogger(__name__)
 
@@ -111,6 +115,9 @@ class MainApp(QMainWindow):
         save_project_action = QAction("Save Project", self)
         save_project_action.triggered.connect(self.save_project)
         file_menu.addAction(save_project_action)
+        save_bundle_action = QAction("Save Project with Analysis", self)
+        save_bundle_action.triggered.connect(lambda: self.save_project(bundle=True))
+        file_menu.addAction(save_bundle_action)
         load_project_action = QAction("Load Project", self)
         load_project_action.triggered.connect(self.load_project)
         file_menu.addAction(load_project_action)
@@ -123,6 +130,18 @@ class MainApp(QMainWindow):
         normalize_all_action = QAction("Normalize All", self)
         normalize_all_action.triggered.connect(self.normalize_all)
         tools_menu.addAction(normalize_all_action)
+        normalize_mode_menu = tools_menu.addMenu("Normalize Mode")
+        normalize_mode_group = QActionGroup(self)
+        for mode, label in (
+                ('peak', "Peak"),
+                ('true_peak', "True Peak"),
+                ('lufs', f"Loudness ({NORMALIZE_TARGET_LUFS:g} LUFS)"),
+                ('lufs_tp', f"Loudness ({NORMALIZE_TARGET_LUFS:g} LUFS, max {NORMALIZE_CEILING_DBTP:g} dBTP)")):
+            mode_action = QAction(label, self, checkable=True)
+            mode_action.setChecked(mode == analysis.normalize_mode())
+            mode_action.triggered.connect(lambda checked, m=mode: analysis.set_normalize_mode(m))
+            normalize_mode_group.addAction(mode_action)
+            normalize_mode_menu.addAction(mode_action)
 
         self.container_widget = _DropContainer(
             self._on_container_drag_enter,
@@ -212,16 +231,18 @@ class MainApp(QMainWindow):
                 self.grid_layout.addWidget(mp3_widget, row, col)
                 self.grid_manager.update_column_stretches()
 
-    def save_project(self) -> bool:
+    def save_project(self, *, bundle: bool = False) -> bool:
         """Salva il progetto. Ritorna True solo a salvataggio riuscito
-        (False se l'utente annulla il dialog o il salvataggio fallisce)."""
+        (False se l'utente annulla il dialog o il salvataggio fallisce).
+        Con `bundle` salva accanto al progetto anche le analisi delle
+        tracce (waveform, peak, durata), per aprirlo altrove senza decode."""
         options = QFileDialog.Options()
         file_name, _ = QFileDialog.getSaveFileName(self, "Save Project", "", "Project Files (*.mpp)", options=options)
 
         if not file_name:
             return False
         try:
-            self.project_manager.save(self.mp3_widgets, self.grid_layout, self.geometry(), file_name)
+            self.project_manager.save(self.mp3_widgets, self.grid_layout, self.geometry(), file_name, bundle=bundle)
             logger.info(f"Project saved successfully to {file_name}")
             return True
         except Exception as e:
@@ -238,6 +259,12 @@ class MainApp(QMainWindow):
                 project_data = self.project_manager.load(file_name)
 
                 self.clear_layout()
+                # Le voci del bundle vanno in cache con job urgenti, in testa
+                # alla coda dello scheduler: i widget si creano subito e le
+                # loro analisi, accodate dopo, le trovano in cache invece di
+                # decodificare.
+                for args in self.project_manager.bundle_entries(project_data, file_name):
+                    analysis_service.scheduler().submit(seed_bundle_entry, *args, urgent=True)
 
                 if 'grid_state' in project_data:
                     rows = project_data['grid_state'].get('rows', self.initial_rows)
@@ -299,7 +326,10 @@ class MainApp(QMainWindow):
         self.setGeometry(x, y, w, h)
 
     def normalize_all(self):
-        """Avvia la normalizzazione RMS su tutti i widget aperti in parallelo."""
+        """Avvia la normalizzazione (nella modalità scelta in Strumenti →
+        Normalize Mode) su tutti i widget aperti. Le analisi finiscono nella
+        coda dello scheduler: al più ANALYSIS_MAX_WORKERS decode in
+        parallelo, gli altri attendono il loro turno."""
         for widget in self.mp3_widgets:
             widget.on_normalize_clicked()
 
@@ -331,6 +361,9 @@ class MainApp(QMainWindow):
         self._progress_timer.stop()
         for widget in list(self.mp3_widgets):
             widget.shutdown()
+        analysis_service.shutdown()
+        logger.info(f"Waveform pixmap cache: {waveform_service.pixmap_cache().stats()}")
+        logger.info(f"Analysis cache: {analysis.cache().stats()}")
         event.accept()
 
     def remove_widget(self, widget):
@@ -2,46 +2,19 @@ import logging
 import os
 import sys
 import time
-import numpy as np
-import soundfile as sf
 from abc import ABC, abstractmethod
 from enum import Enum, auto
 from PyQt5.QtCore import QObject, pyqtSignal, QTimer, QThread
-from constants import FADE_TICK_MS, FADE_STARTUP_DELAY_MS
+import analysis
+import gain_tags
+import mp3probe
+from analysis_service import AnalysisJob, scheduler
+from constants import FADE_TICK_MS, FADE_STARTUP_DELAY_MS, NORMALIZE_USE_TAGS, NORMALIZE_WRITE_GAINS
 from thread_registry import retain
 
 logger = logging.getLogger(__name__)
 
 
-def compute_peak_gain(file_path: str) -> float:
-    """Calcola il gain necessario per portare il picco massimo del file a 1.0."""
-    samples, _ = sf.read(file_path, dtype='float32', always_2d=False)
-    if samples.ndim > 1:
-        samples = samples.mean(axis=1)
-    peak = float(np.max(np.abs(samples)))
-    if peak < 1e-9:
-        return 1.0
-    return 1.0 / peak
-
-
-class PeakAnalyzerThread(QThread):
-    analysis_done = pyqtSignal(float)
-    analysis_failed = pyqtSignal(str)
-
-    def __init__(self, file_path: str):
-        super().__init__()
-        self._file_path = file_path
-
-    def run(self):
-        try:
-            gain = compute_peak_gain(self._file_path)
-        except Exception as e:
-            logger.error(f"Peak analysis failed for {self._file_path}: {e}")
-            self.analysis_failed.emit(str(e))
-            return
-        self.analysis_done.emit(gain)
-
-
 class FadeController(QObject):
     """Linear fade da `start_volume` a `end_volume` in `duration` secondi.
 
@@ -98,6 +71,12 @@ class PlaybackState(Enum):
 
 
 class _PlaybackBackend(ABC):
+    """Costruttore: `(file_name, duration_ms=0)`. `duration_ms` è la durata
+    già letta dagli header (mp3probe.probe): se > 0 il backend non deve
+    ricavarla, altrimenti la legge in modo asincrono e `get_duration_ms`
+    ritorna 0 finché non è nota. Il costruttore non deve mai bloccare in
+    attesa del media."""
+
     # Se True, dopo `play()` il backend perde il volume corrente e va riapplicato
     # con un piccolo delay. Specifico di VLC (vedi _VlcBackend).
     NEEDS_VOLUME_REAPPLY_ON_PLAY: bool = False
@@ -135,18 +114,21 @@ class _StubBackend(_PlaybackBackend):
     """In-memory backend that simulates playback by advancing a timer.
     Fallback used when a real backend library is unavailable."""
 
-    def __init__(self, name: str, file_name: str):
+    def __init__(self, name: str, file_name: str, duration_ms: int = 0):
         self._name = name
         self._file_name = file_name
         self._volume = 100
         self._state = PlaybackState.STOPPED
         self._position_ms = 0
         self._t_anchor = time.monotonic()
-        try:
-            size = os.path.getsize(file_name)
-            self._duration_ms = max(30_000, int(size / (128 * 1024 / 8) * 1000))
-        except OSError:
-            self._duration_ms = 60_000
+        if duration_ms > 0:
+            self._duration_ms = duration_ms
+        else:
+            try:
+                size = os.path.getsize(file_name)
+                self._duration_ms = max(30_000, int(size / (128 * 1024 / 8) * 1000))
+            except OSError:
+                self._duration_ms = 60_000
         logger.info("stub backend [%s] for %s (~%dms)", name, file_name, self._duration_ms)
 
     def _tick(self):
@@ -209,14 +191,16 @@ class _VlcBackend(_PlaybackBackend):
     # a volume massimo all'avvio.
     NEEDS_VOLUME_REAPPLY_ON_PLAY: bool = True
 
-    def __init__(self, file_name: str):
+    def __init__(self, file_name: str, duration_ms: int = 0):
         import vlc
         self._vlc = vlc
         self._player = vlc.MediaPlayer(file_name)
-        media = vlc.Media(file_name)
-        self._player.set_media(media)
-        media.parse()
-        self._duration_ms: int = media.get_duration()
+        self._media = vlc.Media(file_name)
+        self._player.set_media(self._media)
+        self._duration_ms: int = duration_ms
+        if duration_ms <= 0:
+            # Parse asincrono: la durata la rilegge get_duration_ms.
+            self._media.parse_with_options(vlc.MediaParseFlag.local, 0)
         if sys.platform == 'win32':
             # Con l'output di default (mmdevice) audio_set_volume agisce sul
             # volume della sessione audio di Windows, CONDIVISO da tutti i
@@ -254,6 +238,8 @@ class _VlcBackend(_PlaybackBackend):
         return self._player.get_time()
 
     def get_duration_ms(self) -> int:
+        if self._duration_ms <= 0:
+            self._duration_ms = max(0, self._media.get_duration())
         return self._duration_ms
 
     def set_position(self, position: float) -> None:
@@ -270,7 +256,7 @@ class _VlcBackend(_PlaybackBackend):
 
 
 class _GStreamerBackend(_PlaybackBackend):
-    def __init__(self, file_name: str):
+    def __init__(self, file_name: str, duration_ms: int = 0):
         import gi  # type: ignore[import]
         gi.require_version('Gst', '1.0')
         from gi.repository import Gst  # type: ignore[import]
@@ -289,14 +275,9 @@ class _GStreamerBackend(_PlaybackBackend):
         self._volume = 100
         self._player.set_property('volume', 1.0)
         self._eos = False
-
-        # Transition to PAUSED to resolve duration, then back to NULL
-        self._player.set_state(Gst.State.PAUSED)
-        self._player.get_state(Gst.CLOCK_TIME_NONE)
-        ok, self._duration_ns = self._player.query_duration(Gst.Format.TIME)
-        if not ok:
-            self._duration_ns = 0
-        self._player.set_state(Gst.State.NULL)
+        # Senza durata dagli header la si chiede alla pipeline quando è
+        # in PAUSED/PLAYING (vedi get_duration_ms): niente preroll qui.
+        self._duration_ns = duration_ms * 1_000_000
 
     def _check_eos(self) -> bool:
         bus = self._player.get_bus()
@@ -338,10 +319,14 @@ class _GStreamerBackend(_PlaybackBackend):
         return pos_ns // 1_000_000
 
     def get_duration_ms(self) -> int:
+        if self._duration_ns <= 0:
+            ok, duration_ns = self._player.query_duration(self._Gst.Format.TIME)
+            if ok and duration_ns > 0:
+                self._duration_ns = duration_ns
         return self._duration_ns // 1_000_000
 
     def set_position(self, position: float) -> None:
-        pos_ns = int(position * self._duration_ns)
+        pos_ns = int(position * self.get_duration_ms() * 1_000_000)
         self._player.seek_simple(
             self._Gst.Format.TIME,
             self._Gst.SeekFlags.FLUSH | self._Gst.SeekFlags.KEY_UNIT,
@@ -349,7 +334,7 @@ class _GStreamerBackend(_PlaybackBackend):
         )
 
     def get_position(self) -> float:
-        if self._duration_ns == 0:
+        if self.get_duration_ms() == 0:
             return 0.0
         ok, pos_ns = self._player.query_position(self._Gst.Format.TIME)
         if not ok or pos_ns < 0:
@@ -365,21 +350,16 @@ class _GStreamerBackend(_PlaybackBackend):
 
 
 class _MpvBackend(_PlaybackBackend):
-    def __init__(self, file_name: str):
+    def __init__(self, file_name: str, duration_ms: int = 0):
         import mpv  # type: ignore[import]
         self._file_name = file_name
         self._stopped = True
         self._player = mpv.MPV()
         self._player.pause = True
         self._player.play(file_name)
-        # Block briefly until duration is resolved (mpv runs its own event thread)
-        try:
-            self._player.wait_for_property('duration', lambda d: d is not None and d > 0, timeout=5)
-        except Exception:
-            deadline = time.monotonic() + 5.0
-            while self._player.duration is None and time.monotonic() < deadline:
-                time.sleep(0.05)
-        self._duration_ms = int((self._player.duration or 0.0) * 1000)
+        # mpv carica il file nel suo thread: senza durata dagli header la
+        # rilegge get_duration_ms.
+        self._duration_ms = duration_ms
 
     def play(self) -> None:
         if self._player.core_idle and not self._player.pause:
@@ -419,13 +399,15 @@ class _MpvBackend(_PlaybackBackend):
         return int(pos * 1000) if pos is not None else 0
 
     def get_duration_ms(self) -> int:
+        if self._duration_ms <= 0:
+            self._duration_ms = int((self._player.duration or 0.0) * 1000)
         return self._duration_ms
 
     def set_position(self, position: float) -> None:
-        self._player.seek(position * (self._duration_ms / 1000.0), reference='absolute')
+        self._player.seek(position * (self.get_duration_ms() / 1000.0), reference='absolute')
 
     def get_position(self) -> float:
-        if self._duration_ms == 0:
+        if self.get_duration_ms() == 0:
             return 0.0
         return self.get_time_ms() / self._duration_ms
 
@@ -443,7 +425,7 @@ class _QtBackend(_PlaybackBackend):
     A differenza dei backend C (vlc/mpv/gstreamer), QMediaPlayer è un QObject
     con affinità di thread: va creato sul main thread (REQUIRES_MAIN_THREAD).
     L'init non blocca: il media viene caricato in modo asincrono e la durata
-    arriva dopo — Mp3File.get_playback_info la rilegge finché non è nota.
+    arriva dopo; fino ad allora vale quella letta dagli header, se c'è.
 
     Il volume è software e per-player: indipendente per costruzione, senza
     i problemi di sessione dell'output mmdevice di VLC su Windows.
@@ -454,7 +436,7 @@ class _QtBackend(_PlaybackBackend):
 
     REQUIRES_MAIN_THREAD: bool = True
 
-    def __init__(self, file_name: str):
+    def __init__(self, file_name: str, duration_ms: int = 0):
         from PyQt5.QtCore import QUrl
         from PyQt5.QtMultimedia import QMediaPlayer, QMediaContent, QAudio
         self._QMediaPlayer = QMediaPlayer
@@ -464,6 +446,7 @@ class _QtBackend(_PlaybackBackend):
         self._player.setMedia(QMediaContent(QUrl.fromLocalFile(os.path.abspath(file_name))))
         self._volume = 100
         self._player.setVolume(100)
+        self._duration_hint_ms = duration_ms
 
     def play(self) -> None:
         # Dopo la fine del brano si riparte dall'inizio.
@@ -491,16 +474,18 @@ class _QtBackend(_PlaybackBackend):
         return int(self._player.position())
 
     def get_duration_ms(self) -> int:
-        # 0 finché il media non è caricato (arriva async via durationChanged).
-        return max(0, int(self._player.duration()))
+        # Quella del media appena caricato (arriva async via durationChanged),
+        # prima quella degli header.
+        duration = int(self._player.duration())
+        return duration if duration > 0 else self._duration_hint_ms
 
     def set_position(self, position: float) -> None:
-        duration = self._player.duration()
+        duration = self.get_duration_ms()
         if duration > 0:
             self._player.setPosition(int(max(0.0, min(1.0, position)) * duration))
 
     def get_position(self) -> float:
-        duration = self._player.duration()
+        duration = self.get_duration_ms()
         if duration <= 0:
             return 0.0
         return self._player.position() / duration
@@ -521,12 +506,28 @@ class _QtBackend(_PlaybackBackend):
         self._player.deleteLater()
 
 
-class _BackendLoader(QThread):
-    """Istanzia il backend in background. Se la libreria reale non è
-    disponibile ripiega su _StubBackend (UI funzionante, nessun audio);
-    `error` scatta solo se anche lo stub fallisce."""
+def _probe(file_name: str) -> mp3probe.StreamInfo | None:
+    """Durata e formato dagli header del file (mp3probe.probe); None se non
+    è un mp3 o non si legge: il backend ricaverà la durata da sé."""
+    try:
+        return mp3probe.probe(file_name)
+    except OSError as exc:
+        logger.debug(f"probe failed for {file_name}: {exc}")
+        return None
 
-    ready = pyqtSignal(object)
+
+class _BackendLoader(QThread):
+    """Legge gli header del file (`_probe`) e istanzia il backend in
+    background. Se la libreria reale non è disponibile ripiega su
+    _StubBackend (UI funzionante, nessun audio); `error` scatta solo se
+    anche lo stub fallisce. `ready` porta il backend e lo StreamInfo (o
+    None). I backend REQUIRES_MAIN_THREAD non si creano qui: `probed`
+    porta nome, classe e StreamInfo al thread della GUI, che crea il
+    backend (vedi `_create_backend`). Il probe resta comunque fuori dalla
+    GUI: un mp3 VBR senza tag Xing/VBRI richiede la scansione del file."""
+
+    ready = pyqtSignal(object, object)
+    probed = pyqtSignal(str, object, object)
     error = pyqtSignal(str)
 
     def __init__(self, name: str, cls, file_name: str):
@@ -536,16 +537,28 @@ class _BackendLoader(QThread):
         self._file_name = file_name
 
     def run(self):
+        info = _probe(self._file_name)
+        if self._cls.REQUIRES_MAIN_THREAD:
+            self.probed.emit(self._name, self._cls, info)
+            return
         try:
-            backend = self._cls(self._file_name)
-        except Exception as exc:
-            logger.warning("%s unavailable, using stub: %s", self._name, exc)
-            try:
-                backend = _StubBackend(self._name, self._file_name)
-            except Exception as e:
-                self.error.emit(str(e))
-                return
-        self.ready.emit(backend)
+            backend = _create_backend(self._name, self._cls, self._file_name, info)
+        except Exception as e:
+            self.error.emit(str(e))
+            return
+        self.ready.emit(backend, info)
+
+
+def _create_backend(name: str, cls, file_name: str,
+                    info: mp3probe.StreamInfo | None) -> _PlaybackBackend:
+    """Istanzia il backend con la durata dagli header, se c'è; se la
+    libreria reale non è disponibile ripiega su _StubBackend."""
+    duration_ms = info.duration_ms if info is not None else 0
+    try:
+        return cls(file_name, duration_ms)
+    except Exception as exc:
+        logger.warning("%s unavailable, using stub: %s", name, exc)
+        return _StubBackend(name, file_name, duration_ms)
 
 
 _BACKENDS = {
@@ -586,9 +599,10 @@ class Mp3File(QObject):
         self.file_name = file_name
         self._backend: _PlaybackBackend | None = None
         self.mp3_total_duration = 0
+        self.stream_info: mp3probe.StreamInfo | None = None  # dagli header, al load
         self.actual_volume = 100
         self.gain: float = 1.0
-        self._peak_thread: PeakAnalyzerThread | None = None
+        self._peak_job: AnalysisJob | None = None
         self._fade_restore_volume: int | None = None
         self._closed = False
 
@@ -601,31 +615,34 @@ class Mp3File(QObject):
             )
 
         cls = _BACKENDS[backend_key]
-        if cls.REQUIRES_MAIN_THREAD:
-            # Backend Qt (QObject): va creato nel thread della GUI. L'init
-            # non blocca; loaded viene emesso al prossimo giro di event loop
-            # così i connect del widget avvengono prima del segnale.
+        self._loader = _BackendLoader(backend_key, cls, file_name)
+        self._loader.ready.connect(self._on_backend_ready)
+        self._loader.probed.connect(self._on_probed)
+        self._loader.error.connect(self._on_backend_error)
+        retain(self._loader)
+        self._loader.start()
+
+    def _on_probed(self, name: str, cls, info: mp3probe.StreamInfo | None):
+        """Backend Qt (QObject): va creato nel thread della GUI, qui, dopo
+        il probe degli header fatto nel loader. L'init non blocca."""
+        if self._closed:
             self._loader = None
-            try:
-                backend = cls(file_name)
-            except Exception as exc:
-                logger.warning("%s unavailable, using stub: %s", backend_key, exc)
-                backend = _StubBackend(backend_key, file_name)
-            QTimer.singleShot(0, lambda: self._on_backend_ready(backend))
-        else:
-            self._loader = _BackendLoader(backend_key, cls, file_name)
-            self._loader.ready.connect(self._on_backend_ready)
-            self._loader.error.connect(self._on_backend_error)
-            retain(self._loader)
-            self._loader.start()
+            return
+        try:
+            backend = _create_backend(name, cls, self.file_name, info)
+        except Exception as e:
+            self._on_backend_error(str(e))
+            return
+        self._on_backend_ready(backend, info)
 
-    def _on_backend_ready(self, backend: _PlaybackBackend):
+    def _on_backend_ready(self, backend: _PlaybackBackend, info: mp3probe.StreamInfo | None):
         self._loader = None
         if self._closed:
             # cleanup() è già passato: rilascia subito senza attivare nulla.
             backend.release()
             return
         self._backend = backend
+        self.stream_info = info
         self.mp3_total_duration = self._backend.get_duration_ms()
         self._backend.set_volume(self._effective_volume())
         self.loaded.emit()
@@ -645,8 +662,8 @@ class Mp3File(QObject):
         if self._backend is None:
             return None
         if self.mp3_total_duration <= 0:
-            # Alcuni backend (QMediaPlayer) comunicano la durata solo dopo il
-            # caricamento asincrono del media: rileggila finché non è nota.
+            # Senza durata dagli header i backend la ricavano in modo
+            # asincrono dal media: rileggila finché non è nota.
             self.mp3_total_duration = self._backend.get_duration_ms()
         state = self._backend.get_state()
         if state not in (PlaybackState.PLAYING, PlaybackState.PAUSED):
@@ -803,16 +820,63 @@ class Mp3File(QObject):
         logger.debug(f"set_gain: {self.gain:.3f}  actual: {self.actual_volume}  effective: {self._effective_volume()}")
 
     def normalize(self) -> None:
-        """Avvia l'analisi peak in background; emette normalize_ready(gain)
-        quando pronta, normalize_failed(msg) se l'analisi fallisce."""
-        if self._peak_thread is not None and self._peak_thread.isRunning():
+        """Emette normalize_ready(gain) con il gain di normalizzazione della
+        modalità attuale (`analysis.normalize_mode`: peak, true peak, LUFS,
+        LUFS con tetto di true peak), normalize_failed(msg) se l'analisi
+        fallisce.
+
+        Senza decode, nell'ordine: le misure del sidecar o dei tag
+        ReplayGain / R128 del file (`gain_tags.read`, con
+        NORMALIZE_USE_TAGS, in un job urgente dello scheduler: legge il tag
+        in testa al file e il fingerprint del sidecar, niente sul main
+        thread), poi l'analisi in cache se ha le misure che servono (es. la
+        waveform è già visibile). Altrimenti l'analisi viene accodata allo
+        scheduler, condividendo il job con una generazione di waveform
+        eventualmente in corso sullo stesso file."""
+        if self._peak_job is not None:
             return
-        self._peak_thread = PeakAnalyzerThread(self.file_name)
-        self._peak_thread.analysis_done.connect(self.normalize_ready)
-        self._peak_thread.analysis_failed.connect(self.normalize_failed)
-        self._peak_thread.finished.connect(lambda: setattr(self, '_peak_thread', None))
-        retain(self._peak_thread)
-        self._peak_thread.start()
+        mode = analysis.normalize_mode()
+        self._peak_job = scheduler().submit(gain_tags.read, self.file_name, NORMALIZE_USE_TAGS, urgent=True)
+        self._peak_job.done.connect(lambda stored: self._on_stored_gain(stored, mode))
+        self._peak_job.failed.connect(self._on_peak_failed)
+
+    def _on_stored_gain(self, stored: gain_tags.StoredGain | None, mode: str):
+        self._peak_job = None
+        gain = stored.normalize_gain(mode) if stored is not None else None
+        if gain is not None:
+            logger.info(f"Normalize gain for {self.file_name} from {stored.source}: {gain:.3f}")
+            self.normalize_ready.emit(gain)
+            return
+        measures = analysis.required_measures(mode)
+        cached = analysis.load_cached(self.file_name, with_levels=False, measures=measures,
+                                      known_only=True)
+        if cached is not None:
+            self._store_gain(cached)
+            self.normalize_ready.emit(cached.normalize_gain(mode))
+            return
+        self._peak_job = scheduler().submit(analysis.analyze, self.file_name, measures)
+        self._peak_job.done.connect(lambda result: self._on_peak_done(result, mode))
+        self._peak_job.failed.connect(self._on_peak_failed)
+
+    def _on_peak_done(self, result: analysis.AnalysisResult, mode: str):
+        self._peak_job = None
+        self._store_gain(result)
+        self.normalize_ready.emit(result.normalize_gain(mode))
+
+    def _store_gain(self, result: analysis.AnalysisResult) -> None:
+        """Con NORMALIZE_WRITE_GAINS salva le misure dell'analisi come tag o
+        sidecar (`gain_tags.write`, in un job dello scheduler: può riscrivere
+        il file)."""
+        if not NORMALIZE_WRITE_GAINS:
+            return
+        job = scheduler().submit(gain_tags.write, self.file_name,
+                                 gain_tags.StoredGain.from_result(result), NORMALIZE_WRITE_GAINS)
+        job.failed.connect(lambda message: logger.warning(f"Writing gains for {self.file_name} failed: {message}"))
+
+    def _on_peak_failed(self, message: str):
+        logger.error(f"Peak analysis failed for {self.file_name}: {message}")
+        self._peak_job = None
+        self.normalize_failed.emit(message)
 
     def get_volume(self):
         return self.actual_volume
@@ -828,18 +892,15 @@ class Mp3File(QObject):
 
     def cleanup(self):
         """Rilascia il backend e scollega i task in background, senza mai
-        bloccare: i thread ancora in volo restano vivi nel thread_registry
-        e i loro risultati vengono ignorati grazie a `_closed`."""
+        bloccare: il loader ancora in volo resta vivo nel thread_registry e
+        il suo risultato viene ignorato grazie a `_closed`; l'analisi peak
+        viene cancellata (lo scheduler non emette più nulla per quel job)."""
         self._closed = True
         self._stop_active_fade()
         self._loader = None  # se sta ancora girando, _on_backend_ready rilascerà il backend
-        if self._peak_thread is not None:
-            for sig in (self._peak_thread.analysis_done, self._peak_thread.analysis_failed):
-                try:
-                    sig.disconnect()
-                except (TypeError, RuntimeError):
-                    pass
-            self._peak_thread = None
+        if self._peak_job is not None:
+            self._peak_job.cancel()
+            self._peak_job = None
         if self._backend is not None:
             self.stop()
             self._backend.release()
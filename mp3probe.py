@@ -0,0 +1,366 @@
+"""Lettura degli header dei frame MP3 (MPEG-1/2/2.5 Layer III) senza
+decodificare: solo Python puro sui byte del file.
+
+Nessuna dipendenza Qt né da librerie audio, quindi usabile sia dai worker
+di analisi sia dal main thread.
+"""
+import mmap
+import os
+from array import array
+from dataclasses import dataclass
+
+# Bitrate Layer III in kbps per indice, MPEG-1 e MPEG-2/2.5.
+_BITRATES_KBPS = {
+    1: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 0),
+    2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160, 0),
+}
+# Samplerate per indice, per i bit di versione (3 = MPEG-1, 2 = MPEG-2, 0 = MPEG-2.5).
+_SAMPLE_RATES = {
+    3: (44100, 48000, 32000),
+    2: (22050, 24000, 16000),
+    0: (11025, 12000, 8000),
+}
+
+
+@dataclass(frozen=True)
+class FrameHeader:
+    """Header di un frame Layer III."""
+
+    version: int        # bit di versione: 3 = MPEG-1, 2 = MPEG-2, 0 = MPEG-2.5
+    sample_rate: int
+    bitrate_kbps: int
+    channels: int
+    length: int         # byte del frame, header incluso
+    samples: int        # campioni per canale decodificati dal frame
+
+
+def id3v2_size(head: bytes) -> int:
+    """Byte occupati dal tag ID3v2 all'inizio del file (footer incluso),
+    dati i primi 10 byte; 0 se il tag non c'è. L'audio inizia lì."""
+    if len(head) < 10 or head[:3] != b'ID3':
+        return 0
+    size = 10 + ((head[6] << 21) | (head[7] << 14) | (head[8] << 7) | head[9])
+    if head[5] & 0x10:  # footer presente
+        size += 10
+    return size
+
+
+def parse_frame_header(data: bytes, offset: int = 0) -> FrameHeader | None:
+    """Header del frame che inizia a `offset`, o None se lì non c'è un
+    header Layer III valido (sync, versione, bitrate e samplerate)."""
+    if offset < 0 or offset + 4 > len(data):
+        return None
+    b1, b2, b3 = data[offset + 1], data[offset + 2], data[offset + 3]
+    if data[offset] != 0xFF or b1 & 0xE0 != 0xE0:
+        return None
+    version = (b1 >> 3) & 3
+    if version == 1 or (b1 >> 1) & 3 != 1:  # versione riservata / non Layer III
+        return None
+    bitrate_index, rate_index = b2 >> 4, (b2 >> 2) & 3
+    if bitrate_index in (0, 15) or rate_index == 3:  # free format / riservati
+        return None
+    bitrate = _BITRATES_KBPS[1 if version == 3 else 2][bitrate_index]
+    sample_rate = _SAMPLE_RATES[version][rate_index]
+    samples = 1152 if version == 3 else 576
+    padding = (b2 >> 1) & 1
+    return FrameHeader(
+        version=version,
+        sample_rate=sample_rate,
+        bitrate_kbps=bitrate,
+        channels=1 if b3 >> 6 == 3 else 2,
+        length=samples // 8 * bitrate * 1000 // sample_rate + padding,
+        samples=samples,
+    )
+
+
+def find_frame(data: bytes, start: int = 0) -> int:
+    """Offset del primo frame da `start` in poi, confermato dal frame
+    successivo con stessa versione e samplerate (un byte 0xFF casuale nei
+    dati audio non basta). -1 se non trovato."""
+    pos = data.find(b'\xff', start)
+    while 0 <= pos:
+        header = parse_frame_header(data, pos)
+        if header is not None:
+            following = parse_frame_header(data, pos + header.length)
+            if (following is not None and following.version == header.version
+                    and following.sample_rate == header.sample_rate):
+                return pos
+        pos = data.find(b'\xff', pos + 1)
+    return -1
+
+
+def frame_run_end(data: bytes, start: int, count: int) -> int:
+    """Offset di fine dei `count` frame consecutivi che iniziano a `start`,
+    o -1 se i dati finiscono o la catena di header si interrompe prima."""
+    pos = start
+    for _ in range(count):
+        header = parse_frame_header(data, pos)
+        if header is None or pos + header.length > len(data):
+            return -1
+        pos += header.length
+    return pos
+
+
+# ── durata e formato ─────────────────────────────────────────────────────────
+
+# Byte letti dopo il tag ID3v2 per trovare il primo frame e il suo header
+# Xing/Info/VBRI.
+_PROBE_HEAD_BYTES = 16 * 1024
+# Finestre (frazioni del file) in cui si controlla il bitrate di tutti i
+# frame per decidere se un file senza header VBR è CBR; altrimenti si
+# contano tutti i frame.
+_CBR_CHECKS = (0.0, 0.125, 0.25, 0.375, 0.5, 0.625, 0.75, 0.875)
+_CBR_CHECK_BYTES = 8 * 1024
+_SCAN_CHUNK = 1024 * 1024
+
+
+@dataclass(frozen=True)
+class StreamInfo:
+    """Durata e formato di un mp3, ricavati dagli header senza decode."""
+
+    duration_ms: int
+    sample_rate: int
+    channels: int
+    bitrate_kbps: int   # medio sull'intero stream audio
+    vbr: bool
+    source: str         # 'xing', 'info' (CBR di LAME), 'vbri', 'cbr' o 'scan'
+
+
+def _side_info_end(header: FrameHeader) -> int:
+    """Offset dal frame in cui finisce la side info: lì sta il tag Xing/Info."""
+    if header.version == 3:
+        return 4 + (17 if header.channels == 1 else 32)
+    return 4 + (9 if header.channels == 1 else 17)
+
+
+def _vbr_header(frame: bytes, header: FrameHeader) -> tuple[str, int, int, int, int] | None:
+    """(sorgente, frame audio, byte audio, encoder delay, padding) dal tag
+    Xing/Info (delay e padding dal tag LAME, 0 senza) o VBRI del primo
+    frame; None se non c'è o non dà il numero di frame. Byte 0 = non
+    indicati."""
+    tag = _side_info_end(header)
+    if frame[tag:tag + 4] in (b'Xing', b'Info'):
+        flags = int.from_bytes(frame[tag + 4:tag + 8], 'big')
+        if not flags & 1:
+            return None
+        pos = tag + 8
+        frames = int.from_bytes(frame[pos:pos + 4], 'big')
+        pos += 4
+        size = int.from_bytes(frame[pos:pos + 4], 'big') if flags & 2 else 0
+        pos += 4 * bool(flags & 2) + 100 * bool(flags & 4) + 4 * bool(flags & 8)
+        delay = padding = 0
+        if frame[pos:pos + 4] in (b'LAME', b'Lavf', b'Lavc') and len(frame) >= pos + 24:
+            delay = (frame[pos + 21] << 4) | (frame[pos + 22] >> 4)
+            padding = ((frame[pos + 22] & 0x0F) << 8) | frame[pos + 23]
+        source = 'xing' if frame[tag:tag + 4] == b'Xing' else 'info'
+        return source, frames, size, delay, padding
+    if frame[36:40] == b'VBRI':
+        return 'vbri', int.from_bytes(frame[50:54], 'big'), int.from_bytes(frame[46:50], 'big'), 0, 0
+    return None
+
+
+def _audio_end(fh, size: int) -> int:
+    """Fine dello stream audio: prima di un eventuale tag ID3v1 e di un
+    APEv2 in coda."""
+    end = size
+    if size >= 128:
+        fh.seek(size - 128)
+        if fh.read(3) == b'TAG':
+            end -= 128
+    if end >= 32:
+        fh.seek(end - 32)
+        footer = fh.read(32)
+        if footer[:8] == b'APETAGEX':
+            end -= int.from_bytes(footer[12:16], 'little') + (32 if footer[23] & 0x80 else 0)
+    return end
+
+
+def _is_cbr(fh, first: FrameHeader, start: int, end: int) -> bool:
+    """True se tutti i frame delle finestre a _CBR_CHECKS del file hanno
+    il bitrate del primo."""
+    for fraction in _CBR_CHECKS:
+        fh.seek(start + int((end - start) * fraction))
+        data = fh.read(_CBR_CHECK_BYTES)
+        pos = find_frame(data)
+        header = parse_frame_header(data, pos) if pos >= 0 else None
+        if header is None:
+            return False
+        while header is not None and pos + header.length <= len(data):
+            if header.bitrate_kbps != first.bitrate_kbps:
+                return False
+            pos += header.length
+            header = parse_frame_header(data, pos)
+    return True
+
+
+def _count_frames(fh, first: FrameHeader, start: int, end: int) -> tuple[int, int]:
+    """(frame, byte audio) contando gli header da `start` a `end`, a
+    blocchi da _SCAN_CHUNK; si risincronizza sui byte che non sono un
+    frame con la versione e il samplerate del primo."""
+    frames = total = 0
+    fh.seek(start)
+    remaining = end - start
+    buffer = b''
+    pos = 0
+    while True:
+        chunk = fh.read(min(_SCAN_CHUNK, remaining))
+        remaining -= len(chunk)
+        buffer = buffer[pos:] + chunk
+        pos = 0
+        while pos + 4 <= len(buffer):
+            header = parse_frame_header(buffer, pos)
+            if header is None or header.version != first.version or header.sample_rate != first.sample_rate:
+                pos = buffer.find(b'\xff', pos + 1)
+                if pos < 0:
+                    pos = len(buffer)
+                continue
+            if pos + header.length > len(buffer) and chunk:
+                break
+            frames += 1
+            total += header.length
+            pos += header.length
+        if not chunk:
+            return frames, total
+
+
+def probe(file_name: str) -> StreamInfo | None:
+    """Durata esatta, samplerate, canali e bitrate medio di un mp3 leggendo
+    solo gli header: il tag Xing/Info (con il ritardo e il padding del tag
+    LAME, come il decode gapless) o VBRI del primo frame; senza tag un file
+    il cui bitrate non cambia nei punti campionati è CBR e la durata
+    viene dai byte; altrimenti si contano tutti i frame (VBR senza header,
+    ~0.6 s per un'ora di audio). None se il file non è un mp3 Layer III.
+    Solleva OSError se il file non si legge."""
+    with open(file_name, 'rb') as fh:
+        size = os.fstat(fh.fileno()).st_size
+        start = id3v2_size(fh.read(10))
+        fh.seek(start)
+        head = fh.read(_PROBE_HEAD_BYTES)
+        pos = find_frame(head)
+        if pos < 0:
+            return None
+        first = parse_frame_header(head, pos)
+        start += pos
+        end = max(start, _audio_end(fh, size))
+        tag = _vbr_header(head[pos:pos + first.length], first)
+        if tag is not None:
+            source, frames, audio_bytes, delay, padding = tag
+            samples = max(0, frames * first.samples - delay - padding)
+            audio_bytes = audio_bytes or end - start - first.length
+            vbr = source != 'info'
+        elif _is_cbr(fh, first, start, end):
+            source, vbr, audio_bytes = 'cbr', False, end - start
+            samples = audio_bytes * 8 * first.sample_rate // (first.bitrate_kbps * 1000)
+        else:
+            source, vbr = 'scan', True
+            frames, audio_bytes = _count_frames(fh, first, start, end)
+            samples = frames * first.samples
+    duration_ms = round(samples * 1000 / first.sample_rate)
+    return StreamInfo(
+        duration_ms=duration_ms,
+        sample_rate=first.sample_rate,
+        channels=first.channels,
+        bitrate_kbps=round(audio_bytes * 8 / duration_ms) if duration_ms else first.bitrate_kbps,
+        vbr=vbr,
+        source=source,
+    )
+
+
+# ── indice dei frame ─────────────────────────────────────────────────────────
+
+@dataclass(frozen=True)
+class FrameSpan:
+    """I frame audio di un mp3 dal `first`-esimo (contando da 0 il primo
+    dopo il frame del tag) alla fine dello stream: iniziano a `offset`, lo
+    stream finisce a `end`."""
+
+    first: int
+    frames: int
+    offset: int
+    end: int
+    header: bytes       # i 4 byte dell'header del primo frame audio
+    samples: int        # campioni per frame
+    delay: int          # encoder delay del tag LAME (0 senza)
+
+
+@dataclass(frozen=True)
+class FrameIndex:
+    """Offset di tutti i frame audio di un mp3 con tag Xing/Info (`frame_index`)."""
+
+    offsets: array
+    end: int
+    header: bytes
+    samples: int
+    delay: int
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def span(self, first: int) -> FrameSpan:
+        return FrameSpan(first, len(self.offsets) - first, self.offsets[first], self.end,
+                         self.header, self.samples, self.delay)
+
+
+def _length_table(first: FrameHeader) -> list[int]:
+    """Lunghezza del frame per i byte 1-2 dell'header (65536 voci), 0 per
+    gli header non validi o con versione/samplerate diversi dal primo."""
+    table = [0] * 65536
+    for b1 in range(0xE0, 0x100):
+        for b2 in range(256):
+            header = parse_frame_header(bytes((0xFF, b1, b2, 0)))
+            if header is not None and header.version == first.version \
+                    and header.sample_rate == first.sample_rate:
+                table[b1 << 8 | b2] = header.length
+    return table
+
+
+def frame_index(file_name: str) -> FrameIndex | None:
+    """Indice dei frame audio di un mp3 con tag Xing/Info (il frame del tag
+    escluso), per decodificarne una parte partendo da un frame qualsiasi.
+    Come `_count_frames` si risincronizza sui byte che non sono un frame,
+    ma con una tabella delle lunghezze al posto del parse di ogni header
+    (~0.1 s per un'ora di audio). None se il file non è un mp3 Layer III o
+    non ha il tag. Solleva OSError se il file non si legge."""
+    with open(file_name, 'rb') as fh:
+        size = os.fstat(fh.fileno()).st_size
+        start = id3v2_size(fh.read(10))
+        fh.seek(start)
+        head = fh.read(_PROBE_HEAD_BYTES)
+        pos = find_frame(head)
+        if pos < 0:
+            return None
+        first = parse_frame_header(head, pos)
+        tag = _vbr_header(head[pos:pos + first.length], first)
+        if tag is None or tag[0] == 'vbri':
+            return None
+        end = _audio_end(fh, size)
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            table = _length_table(first)
+            offsets = array('q')
+            pos += start + first.length
+            while pos + 4 <= end:
+                length = table[data[pos + 1] << 8 | data[pos + 2]] if data[pos] == 0xFF else 0
+                if not length:
+                    pos = data.find(b'\xff', pos + 1, end)
+                    if pos < 0:
+                        break
+                    continue
+                if pos + length > end:
+                    break
+                offsets.append(pos)
+                pos += length
+            header = data[offsets[0]:offsets[0] + 4] if offsets else head[pos:pos + 4]
+    return FrameIndex(offsets, end, bytes(header), first.samples, tag[3])
+
+
+def xing_frame(header: bytes, frames: int) -> bytes:
+    """Frame vuoto con un tag Xing che dichiara `frames` frame, con
+    versione, samplerate e canali dell'header (4 byte) dato: messo davanti
+    a una sequenza di frame, dice al decoder quanti sono."""
+    header = bytes((header[0], header[1], header[2] & ~0x02, header[3]))  # senza padding
+    parsed = parse_frame_header(header)
+    frame = bytearray(parsed.length)
+    frame[:4] = header
+    tag = _side_info_end(parsed)
+    frame[tag:tag + 12] = b'Xing' + (1).to_bytes(4, 'big') + frames.to_bytes(4, 'big')
+    return bytes(frame)
@@ -6,7 +6,7 @@ from PyQt5.QtCore import Qt, pyqtSignal, QPoint, QMimeData
 from PyQt5.QtGui import QIcon, QDrag, QPixmap, QPainter, QColor
 from mp3file import Mp3File
 from waveform_service import WaveformService
-from constants import PROGRESS_BAR_HEIGHT
+from constants import PROGRESS_BAR_HEIGHT, WAVEFORM_SPLIT_STEREO
 
 logger = logging.getLogger(__name__)
 
@@ -24,20 +24,56 @@ def seconds_to_min_sec(seconds: int) -> str:
 
 class ClickableProgressBar(QProgressBar):
     clicked = pyqtSignal(float)
+    # Dimensione logica e devicePixelRatio della barra: la waveform va
+    # renderizzata a questa dimensione (vedi WaveformService.set_target_size).
+    render_size_changed = pyqtSignal(int, int, float)
+    # Vista stereo separata scelta dal menu contestuale.
+    split_stereo_toggled = pyqtSignal(bool)
 
     def __init__(self, parent=None):
         super().__init__(parent)
         self._waveform: QPixmap | None = None
+        self._reported_size: tuple[int, int, float] | None = None
+        self._split_stereo = False
+
+    def set_split_stereo(self, enabled: bool):
+        """Stato della voce del menu contestuale (non emette segnali)."""
+        self._split_stereo = enabled
+
+    def contextMenuEvent(self, event):
+        menu = QMenu(self)
+        action = menu.addAction("Split Stereo (L/R)")
+        action.setCheckable(True)
+        action.setChecked(self._split_stereo)
+        action.toggled.connect(self.split_stereo_toggled.emit)
+        menu.exec_(event.globalPos())
 
     def set_waveform(self, pixmap: QPixmap):
         self._waveform = pixmap
         self.update()
 
+    def _report_render_size(self):
+        size = (self.width(), self.height(), self.devicePixelRatioF())
+        if size != self._reported_size:
+            self._reported_size = size
+            self.render_size_changed.emit(*size)
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self._report_render_size()
+
     def paintEvent(self, event):
+        # Il devicePixelRatio cambia senza resize quando la finestra passa
+        # su uno schermo con scala diversa.
+        self._report_render_size()
         painter = QPainter(self)
         rect = self.rect()
         if self._waveform is not None and not self._waveform.isNull():
-            painter.drawPixmap(rect, self._waveform)
+            if self._waveform.size() / self._waveform.devicePixelRatioF() == rect.size():
+                painter.drawPixmap(rect.topLeft(), self._waveform)  # 1:1, nessuno scaling
+            else:
+                # Render alla dimensione giusta in arrivo (debounce del resize).
+                painter.drawPixmap(rect, self._waveform)
         else:
             painter.fillRect(rect, QColor('#4A5662'))
         if self.maximum() > 0 and self.value() > 0:
@@ -85,6 +121,8 @@ class Mp3Widget(QWidget):
         self._drag_armed = False
         self._waveform_service = WaveformService(self)
         self._waveform_service.waveform_upgraded.connect(self._set_progress_bar_background)
+        self._split_stereo = WAVEFORM_SPLIT_STEREO
+        self._waveform_service.set_split_stereo(self._split_stereo)
 
         self.create_ui_elements()
         self.apply_layout()
@@ -424,9 +462,15 @@ class Mp3Widget(QWidget):
         self.changeButtonStyle(self.btnFadeIn, "")
 
     def _on_loaded(self):
-        """Il backend è pronto: la durata reale è ora disponibile."""
+        """Il backend è pronto: la durata (dagli header del file, se letti)
+        è ora disponibile."""
         self.lblRemainingTime.setText(
             f"Remaining Time: {seconds_to_min_sec(round(self.mp3file.mp3_total_duration / 1000))}")
+        info = self.mp3file.stream_info
+        if info is not None:
+            mode = "VBR" if info.vbr else "CBR"
+            self.filename_label.setToolTip(
+                f"{info.sample_rate} Hz, {info.channels} ch, {info.bitrate_kbps} kbps {mode}")
 
     def _on_load_error(self, message: str):
         """Backend non inizializzabile: disabilita i controlli e segnala l'errore."""
@@ -476,6 +520,12 @@ class Mp3Widget(QWidget):
         """Public API: set gain via the spinbox so the change handler propagates."""
         self.spinboxGain.setValue(gain)  # triggers _on_gain_changed via valueChanged
 
+    def set_split_stereo(self, enabled: bool):
+        """Public API: vista stereo separata della waveform (L sopra, R sotto)."""
+        self._split_stereo = enabled
+        self.progress_bar.set_split_stereo(enabled)
+        self._waveform_service.set_split_stereo(enabled)
+
     def to_state(self) -> dict:
         """Serialize the widget state to a JSON-friendly dict."""
         return {
@@ -484,6 +534,7 @@ class Mp3Widget(QWidget):
             "fade_time": float(self.fade_time),
             "gain": float(self.mp3file.gain),
             "layout": self.widgetLayout.name,
+            "split_stereo": self._split_stereo,
         }
 
     def apply_state(self, state: dict) -> None:
@@ -504,6 +555,8 @@ class Mp3Widget(QWidget):
                 self.set_layout(WidgetLayout[state["layout"]])
             except KeyError:
                 pass
+        if "split_stereo" in state:
+            self.set_split_stereo(bool(state["split_stereo"]))
 
     def update_volume(self):
         volume = self.slidVolume.value()
@@ -566,6 +619,9 @@ class Mp3Widget(QWidget):
         self.progress_bar.setFixedHeight(PROGRESS_BAR_HEIGHT)
         self.progress_bar.setMaximum(1000)
         self.progress_bar.clicked.connect(self.update_playback_position)
+        self.progress_bar.render_size_changed.connect(self._waveform_service.set_target_size)
+        self.progress_bar.set_split_stereo(self._split_stereo)
+        self.progress_bar.split_stereo_toggled.connect(self.set_split_stereo)
         # La waveform arriva in background via waveform_upgraded; fino ad
         # allora la barra dipinge il fondo piatto.
         self._waveform_service.generate(self.mp3file.file_name)
@@ -0,0 +1,217 @@
+"""Cache su disco del PCM decodificato, opt-in (`PCM_CACHE_MAX_MB`).
+
+Un file per voce (`<chiave>.pcm`): un header di `_HEADER_SIZE` byte con
+formato, samplerate, canali e frame, poi i campioni interleaved int16 o
+float16, letti con `numpy.memmap` come array (frame, canali) senza copie.
+Chi rianalizza un file in cache (per una misura in più, dopo l'eviction
+della cache delle analisi, ...) legge alla velocità del disco invece che
+a quella del decoder.
+
+- scrittura: i blocchi vanno in un file temporaneo nella stessa directory,
+  che a decode completo riceve l'header definitivo e viene rinominato in
+  modo atomico; chi legge vede solo voci complete, e una voce la cui
+  dimensione non torna con l'header (scrittura interrotta) viene scartata;
+- eviction LRU: la lettura aggiorna l'mtime del file; dopo ogni scrittura,
+  oltre il limite di dimensione si cancellano le voci con l'mtime più
+  vecchio. Una mappa già aperta resta valida anche se il file viene
+  cancellato (su Windows la cancellazione fallisce e la voce resta fino
+  al giro successivo).
+
+Con int16 i campioni oltre il fondo scala (mp3 con picchi > 1.0) vengono
+saturati: float16 li conserva, con un rumore di quantizzazione di ~-66 dB
+invece di -96 dB, ininfluente per envelope, picco e loudness.
+
+Nessuna dipendenza Qt.
+"""
+import logging
+import os
+import struct
+import tempfile
+import time
+from dataclasses import dataclass
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+_SUFFIX = '.pcm'
+_MAGIC = b'MPPCM'
+_VERSION = 1
+# magic, versione, dtype ('h' int16, 'e' float16), samplerate, canali, frame;
+# il resto dell'header è padding (campioni allineati).
+_HEADER = struct.Struct('<5sBcxIHxxQ')
+_HEADER_SIZE = 64
+_DTYPES = {b'h': np.dtype('<i2'), b'e': np.dtype('<f2')}
+# Scala dell'int16: ±1.0 ↔ ±32767.
+_INT16_SCALE = 32767
+# Un temporaneo più vecchio di così è una scrittura interrotta.
+_ORPHAN_GRACE_S = 3600
+
+
+def as_float32(values: np.ndarray) -> np.ndarray:
+    """Campioni della cache (int16 o float16) come float32 in [-1, 1]. Da
+    applicare a fette limitate (un blocco), non all'intera mappa."""
+    if values.dtype == np.int16:
+        return values * np.float32(1 / _INT16_SCALE)
+    return values.astype(np.float32)
+
+
+@dataclass(frozen=True)
+class PcmEntry:
+    """Una voce della cache: `samples` è la mappa (frame, canali) in sola
+    lettura, int16 o float16 (vedi `as_float32`)."""
+
+    samples: np.ndarray
+    sample_rate: int
+
+    @property
+    def channels(self) -> int:
+        return self.samples.shape[1]
+
+    @property
+    def frames(self) -> int:
+        return self.samples.shape[0]
+
+
+class PcmWriter:
+    """Scrittura di una voce a blocchi float32 (frame, canali). `commit`
+    pubblica la voce, `abort` la scarta; oltre `max_bytes` la scrittura si
+    interrompe da sola e il commit non pubblica nulla."""
+
+    def __init__(self, cache: 'PcmCache', key: str, sample_rate: int, channels: int):
+        self._cache = cache
+        self._key = key
+        self._sample_rate = sample_rate
+        self._channels = channels
+        self._frames = 0
+        fd, self._tmp = tempfile.mkstemp(dir=cache.directory, suffix='.tmp')
+        self._fh = os.fdopen(fd, 'wb')
+        self._fh.write(bytes(_HEADER_SIZE))
+
+    def write(self, block: np.ndarray) -> None:
+        if self._fh is None:
+            return
+        if self._cache.dtype == np.int16:
+            values = np.rint(np.clip(block, -1.0, 1.0) * _INT16_SCALE).astype('<i2')
+        else:
+            values = block.astype('<f2')
+        self._frames += len(values)
+        if _HEADER_SIZE + self._frames * self._channels * 2 > self._cache.max_bytes:
+            logger.debug(f"PCM of {self._key} exceeds the cache size, not cached")
+            self.abort()
+            return
+        try:
+            values.tofile(self._fh)
+        except OSError as exc:
+            logger.warning(f"PCM cache write failed: {exc}")
+            self.abort()
+
+    def commit(self) -> None:
+        if self._fh is None:
+            return
+        code = b'h' if self._cache.dtype == np.int16 else b'e'
+        try:
+            self._fh.seek(0)
+            self._fh.write(_HEADER.pack(_MAGIC, _VERSION, code, self._sample_rate,
+                                        self._channels, self._frames))
+            self._fh.close()
+            self._fh = None
+            os.replace(self._tmp, self._cache.path(self._key))
+        except OSError as exc:
+            logger.warning(f"PCM cache write failed: {exc}")
+            self.abort()
+            return
+        self._cache.evict(keep=self._key)
+
+    def abort(self) -> None:
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+        try:
+            os.remove(self._tmp)
+        except OSError:
+            pass
+
+
+class PcmCache:
+    """La cache in `directory`, al più `max_bytes`; le voci nuove sono
+    scritte in `dtype` ('float16' o 'int16'), quelle lette possono essere
+    dell'uno o dell'altro."""
+
+    def __init__(self, directory: str, max_bytes: int, dtype: str = 'float16'):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.dtype = np.dtype(dtype)
+        if self.dtype not in (np.int16, np.float16):
+            raise ValueError(f"unsupported PCM cache dtype: {dtype}")
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key + _SUFFIX)
+
+    def get(self, key: str) -> PcmEntry | None:
+        """Voce di `key` mappata in memoria, None se assente o non valida."""
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as fh:
+                header = fh.read(_HEADER.size)
+                size = os.fstat(fh.fileno()).st_size
+        except OSError:
+            return None
+        try:
+            magic, version, code, sample_rate, channels, frames = _HEADER.unpack(header)
+        except struct.error:
+            magic = None
+        if (magic != _MAGIC or version != _VERSION or code not in _DTYPES or channels < 1
+                or size != _HEADER_SIZE + frames * channels * _DTYPES[code].itemsize):
+            logger.debug(f"discarding invalid PCM cache entry {path}")
+            self._remove(path)
+            return None
+        if frames == 0:
+            samples = np.empty((0, channels), _DTYPES[code])
+        else:
+            samples = np.memmap(path, dtype=_DTYPES[code], mode='r', offset=_HEADER_SIZE,
+                                shape=(frames, channels))
+        try:
+            os.utime(path)  # ultimo accesso, per l'LRU
+        except OSError:
+            pass
+        return PcmEntry(samples, sample_rate)
+
+    def writer(self, key: str, sample_rate: int, channels: int) -> PcmWriter:
+        return PcmWriter(self, key, sample_rate, channels)
+
+    def evict(self, keep: str | None = None) -> None:
+        """Cancella le voci usate meno di recente finché la cache sta nel
+        limite (mai `keep`), più i temporanei di scritture interrotte."""
+        entries = []
+        now = time.time()
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if name.endswith('.tmp'):
+                if now - st.st_mtime > _ORPHAN_GRACE_S:
+                    self._remove(path)
+            elif name.endswith(_SUFFIX):
+                entries.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        keep_path = self.path(keep) if keep is not None else None
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path != keep_path and self._remove(path):
+                total -= size
+
+    @staticmethod
+    def _remove(path: str) -> bool:
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
@@ -0,0 +1,119 @@
+"""Pre-analisi headless di intere cartelle: riempie la cache delle analisi
+(piramide dell'envelope, peak, durata; true peak e loudness se la
+modalità di normalizzazione li richiede) che l'app legge all'apertura dei
+progetti, così sulla macchina dello show il primo caricamento non
+decodifica niente.
+
+Nessuna dipendenza Qt: gira anche su server senza display. I file vengono
+analizzati in parallelo su tutti i core; quelli già in cache si saltano
+con una stat e una query sull'indice (vedi `analysis.file_key`), quindi
+rilanciarlo su una cartella già elaborata riprende in pochi istanti.
+
+Uso:
+    python prewarm.py CARTELLA_O_FILE [...] [-j N] [--ext .wav] [--mode lufs]
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import analysis
+
+# Estensioni analizzate di default: quelle che l'app apre.
+DEFAULT_EXTENSIONS = ('.mp3',)
+
+
+def _collect(paths: list[str], extensions: tuple[str, ...]) -> list[str]:
+    """File audio sotto `paths` (cartelle visitate ricorsivamente), senza
+    duplicati, nell'ordine in cui si incontrano."""
+    found = {}
+    for path in paths:
+        if os.path.isfile(path):
+            found.setdefault(os.path.abspath(path), None)
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                if name.lower().endswith(extensions):
+                    found.setdefault(os.path.abspath(os.path.join(root, name)), None)
+    return list(found)
+
+
+def _analyze(file_name: str, measures: tuple[str, ...]) -> float:
+    """Entry point nel worker: analizza (e mette in cache) il file e ne
+    ritorna la durata. Solo la durata torna indietro, non la piramide."""
+    return analysis.analyze(file_name, measures).duration
+
+
+def _size(file_name: str) -> int:
+    try:
+        return os.path.getsize(file_name)
+    except OSError:
+        return 0
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Analizza in anticipo i file audio delle cartelle "
+                                                 "indicate e ne riempie la cache delle analisi.")
+    parser.add_argument('paths', nargs='+', help="cartelle (visitate ricorsivamente) o singoli file")
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help="processi di analisi in parallelo (default: tutti i core)")
+    parser.add_argument('--ext', action='append', default=None, metavar='EXT',
+                        help="estensione da includere, ripetibile (default: .mp3)")
+    parser.add_argument('--mode', choices=analysis.NORMALIZE_MODES, default=analysis.normalize_mode(),
+                        help="modalità di normalizzazione di cui precalcolare le misure "
+                             "(default: NORMALIZE_MODE, %(default)s)")
+    args = parser.parse_args(argv)
+    measures = analysis.required_measures(args.mode)
+    extensions = tuple(e.lower() if e.startswith('.') else f'.{e.lower()}'
+                       for e in (args.ext or DEFAULT_EXTENSIONS))
+
+    t0 = time.perf_counter()
+    files = _collect(args.paths, extensions)
+    todo = [f for f in files if not analysis.is_cached(f, measures)]
+    print(f"{len(files)} file trovati, {len(files) - len(todo)} già in cache "
+          f"({time.perf_counter() - t0:.2f}s)")
+    if not todo:
+        return 0
+
+    # I file più grandi per primi: gli ultimi a finire sono quelli brevi e
+    # i core restano occupati fino alla fine.
+    todo.sort(key=_size, reverse=True)
+    jobs = max(1, min(args.jobs, len(todo)))
+    failed = 0
+    audio_s = 0.0
+    t0 = time.perf_counter()
+    # Spawn, non fork: il processo padre ha già aperto la connessione sqlite
+    # della cache (is_cached), che non deve passare ai figli.
+    with ProcessPoolExecutor(jobs, mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = {executor.submit(_analyze, f, measures): f for f in todo}
+        try:
+            for done, future in enumerate(as_completed(futures), 1):
+                file_name = futures[future]
+                try:
+                    duration = future.result()
+                except Exception as exc:
+                    failed += 1
+                    print(f"[{done}/{len(todo)}] ERRORE {file_name}: {exc}", file=sys.stderr)
+                    continue
+                audio_s += duration
+                print(f"[{done}/{len(todo)}] {duration / 60:6.1f} min  {file_name}")
+        except KeyboardInterrupt:
+            executor.shutdown(wait=False, cancel_futures=True)
+            print("Interrotto: i file già completati restano in cache.", file=sys.stderr)
+            return 130
+    elapsed = time.perf_counter() - t0
+
+    analyzed = len(todo) - failed
+    print(f"{analyzed} file analizzati in {elapsed:.1f}s con {jobs} processi: "
+          f"{analyzed / elapsed:.2f} file/s, {audio_s / 3600 / elapsed:.3f} ore audio/s"
+          + (f", {failed} errori" if failed else ""))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    sys.exit(main())
@@ -1,10 +1,23 @@
 import json
 import logging
+import os
 from datetime import datetime
+import numpy as np
+import analysis
 
 logger = logging.getLogger(__name__)
 
-CURRENT_VERSION = '1.2'
+CURRENT_VERSION = '1.5'
+# Dalla 1.3 un progetto può avere un bundle delle analisi: un sidecar .npz
+# (BUNDLE_SUFFIX, accanto al .mpp) con la piramide di ogni traccia, e per
+# ogni file una chiave 'analysis' con fingerprint, peak e durata. Dalla 1.4
+# la piramide può avere in coda quella per canale (`analysis.level_arrays`,
+# 'channel_levels' nella chiave 'analysis') e un file la chiave
+# 'split_stereo' (vista stereo separata della waveform). Dalla 1.5 tra la
+# piramide del downmix e quella per canale ci sono i livelli RMS del
+# downmix ('rms_levels').
+_BUNDLE_VERSION = (1, 3)
+BUNDLE_SUFFIX = '.mpa'
 
 
 def _version_tuple(version: str) -> tuple[int, ...]:
@@ -17,7 +30,10 @@ def _version_tuple(version: str) -> tuple[int, ...]:
 
 
 class ProjectManager:
-    def save(self, widgets: list, grid_layout, window_geometry, path: str) -> None:
+    def save(self, widgets: list, grid_layout, window_geometry, path: str, bundle: bool = False) -> None:
+        """Salva il progetto in `path` (JSON). Con `bundle` scrive anche il
+        sidecar con le analisi in cache delle tracce (vedi `_write_bundle`),
+        così su un'altra macchina l'apertura non decodifica niente."""
         if not path.endswith('.mpp'):
             path += '.mpp'
 
@@ -51,6 +67,8 @@ class ProjectManager:
             },
             'files': files,
         }
+        if bundle:
+            project_data['analysis_bundle'] = self._write_bundle(files, path)
 
         with open(path, 'w') as f:
             json.dump(project_data, f, indent=4)
@@ -72,5 +90,106 @@ class ProjectManager:
                 f"Loading project version '{version}'; "
                 f"current is '{CURRENT_VERSION}' — loading best-effort."
             )
+            if _version_tuple(version) < _BUNDLE_VERSION:
+                project_data.pop('analysis_bundle', None)
             project_data['version'] = CURRENT_VERSION
         return project_data
+
+    def bundle_entries(self, project_data: dict, path: str) -> list[tuple[str, str, str]]:
+        """Argomenti di `seed_bundle_entry` per le tracce del progetto
+        salvato in `path` che hanno un'analisi nel bundle: (path del
+        bundle, path della traccia, chiave 'analysis' in JSON). Lista vuota
+        se il progetto non ha un bundle o il bundle non c'è. Solo una stat:
+        la lettura del bundle e la scrittura in cache girano nei job."""
+        name = project_data.get('analysis_bundle')
+        if not name:
+            return []
+        bundle_path = os.path.join(os.path.dirname(os.path.abspath(path)), name)
+        if not os.path.exists(bundle_path):
+            logger.warning(f"Analysis bundle {bundle_path} not found")
+            return []
+        return [(bundle_path, entry['file_path'], json.dumps(entry['analysis']))
+                for entry in project_data['files']
+                if entry.get('analysis') and entry.get('file_path')]
+
+    @staticmethod
+    def _write_bundle(files: list[dict], path: str) -> str:
+        """Scrive il sidecar con le piramidi in cache delle tracce e aggiunge
+        a ogni voce di `files` la chiave 'analysis' (fingerprint, peak,
+        durata, ...). Le tracce non ancora analizzate restano fuori dal
+        bundle e verranno analizzate all'apertura. Ritorna il nome del
+        sidecar, relativo alla cartella del progetto."""
+        bundle_path = os.path.splitext(path)[0] + BUNDLE_SUFFIX
+        arrays = {}
+        bundled = 0
+        for entry in files:
+            file_path = entry['file_path']
+            result = analysis.load_cached(file_path, measures=())
+            if result is None:
+                logger.warning(f"No cached analysis for {file_path}: not included in the bundle")
+                continue
+            fingerprint = analysis.file_key(file_path)
+            levels = analysis.level_arrays(result)
+            for i, values in enumerate(levels):
+                arrays[f"{fingerprint}_{i}"] = values
+            entry['analysis'] = {
+                'fingerprint': fingerprint,
+                'duration': result.duration,
+                'peak': result.peak,
+                'true_peak': result.true_peak,
+                'loudness': result.loudness,
+                'rms': result.rms,
+                'frames': result.frames,
+                'sample_rate': result.sample_rate,
+                'channels': result.channels,
+                'arrays': len(levels),
+                'channel_levels': len(result.channel_levels or ()),
+                'rms_levels': len(result.rms_levels or ()),
+            }
+            bundled += 1
+        # Scrittura atomica: un bundle a metà non deve sostituire quello buono.
+        tmp = bundle_path + '.tmp'
+        with open(tmp, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp, bundle_path)
+        logger.info(f"Analysis bundle saved to {bundle_path} ({bundled}/{len(files)} tracks)")
+        return os.path.basename(bundle_path)
+
+
+def seed_bundle_entry(bundle_path: str, file_path: str, info: str, progress=None) -> bool:
+    """Job dello scheduler (vedi `ProjectManager.bundle_entries`): copia
+    nella cache delle analisi la voce del bundle per `file_path`, se il
+    contenuto della traccia corrisponde ancora al fingerprint salvato.
+    `info` è la chiave 'analysis' della traccia in JSON (gli argomenti di
+    un job devono essere hashable). True se l'analisi è ora in cache; un
+    bundle illeggibile o una traccia sparita non sono errori."""
+    if not os.path.exists(file_path) or analysis.is_cached(file_path):
+        return False
+    try:
+        info = json.loads(info)
+        with np.load(bundle_path) as data:
+            arrays = [data[f"{info['fingerprint']}_{i}"] for i in range(info['arrays'])]
+        levels, rms_levels, channel_levels = analysis.levels_from_arrays(
+            arrays, info.get('channel_levels', 0), info['channels'], info.get('rms_levels', 0))
+        result = analysis.AnalysisResult(
+            levels=levels,
+            rms_levels=rms_levels,
+            channel_levels=channel_levels,
+            peak=info['peak'],
+            rms=info['rms'],
+            frames=info['frames'],
+            sample_rate=info['sample_rate'],
+            channels=info['channels'],
+            true_peak=info.get('true_peak'),
+            loudness=info.get('loudness'),
+        )
+    except OSError as exc:
+        logger.warning(f"Analysis bundle {bundle_path} not readable: {exc}")
+        return False
+    except (KeyError, TypeError, ValueError) as exc:
+        logger.warning(f"Analysis bundle entry for {file_path} is invalid: {exc}")
+        return False
+    if not analysis.seed_cache(file_path, info['fingerprint'], result):
+        logger.info(f"{file_path} changed since the bundle was saved: it will be analyzed again")
+        return False
+    return True
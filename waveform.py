@@ -1,117 +1,220 @@
 import io
-import os
-import hashlib
 import logging
-import tempfile
 import numpy as np
-import soundfile as sf
 from PIL import Image
+import analysis
 from constants import WAVEFORM_WIDTH, WAVEFORM_HEIGHT
 
 logger = logging.getLogger(__name__)
 
-_WAVEFORM_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'mp3player_waveforms')
-
-
-def _envelope_cache_path(file_name: str, width: int = WAVEFORM_WIDTH) -> str:
-    """Return a unique, stable cache path for the envelope of file_name
-    at the given width. The key includes mtime and size so the cache is
-    invalidated when the file is replaced with different content.
-    """
-    os.makedirs(_WAVEFORM_CACHE_DIR, exist_ok=True)
-    try:
-        st = os.stat(file_name)
-        stamp = f"{st.st_mtime_ns}_{st.st_size}"
-    except OSError:
-        stamp = "0_0"
-    h = hashlib.md5(f"{os.path.abspath(file_name)}|{stamp}".encode()).hexdigest()
-    return os.path.join(_WAVEFORM_CACHE_DIR, f"{h}_{width}.npz")
-
-
-def _decode_mono(file_name: str) -> np.ndarray:
-    """Decodifica il file in float32 mono. Prova soundfile (veloce, nativo);
-    fallback su librosa (audioread/ffmpeg) per i formati che libsndfile non
-    gestisce — AAC/M4A, WMA, ALAC, ecc. L'import di librosa è lazy perché
-    costa ~1s di startup."""
-    try:
-        samples, _ = sf.read(file_name, dtype='float32', always_2d=False)
-        if samples.ndim > 1:
-            samples = samples.mean(axis=1)
-        return samples
-    except Exception as exc:
-        logger.debug(f"soundfile decode failed ({exc}); falling back to librosa")
-        import librosa  # lazy import — librosa is heavy
-        samples, _ = librosa.load(file_name, sr=None, mono=True)
-        return samples
-
-
-def _envelope_from_samples(samples: np.ndarray, width: int) -> tuple[np.ndarray, np.ndarray]:
-    """Envelope min/max per colonna. Al più `width` colonne: se il file ha
-    meno campioni di `width`, l'envelope ha una colonna per campione (il
-    rendering viene poi scalato dalla UI)."""
-    n_cols = min(width, len(samples))
-    if n_cols == 0:
-        zero = np.zeros(1, dtype=np.float32)
-        return zero, zero
-    step = len(samples) // n_cols
-    cols = samples[: step * n_cols].reshape(-1, step)
-    return cols.min(axis=1), cols.max(axis=1)
-
-
-def compute_envelope(file_name: str, width: int = WAVEFORM_WIDTH) -> tuple[np.ndarray, np.ndarray]:
-    """Ritorna (min_vals, max_vals) dell'envelope, cachato su disco.
-
-    Il decode è la parte costosa: l'envelope (2×width float) viene salvato
-    in un .npz così i re-render (es. cambio gain) non ridecodificano nulla.
-    """
-    cache = _envelope_cache_path(file_name, width)
-    if os.path.isfile(cache):
-        try:
-            data = np.load(cache)
-            return data['min'], data['max']
-        except Exception as exc:
-            logger.debug(f"cache read failed, regenerating: {exc}")
-
-    samples = _decode_mono(file_name)
-    min_vals, max_vals = _envelope_from_samples(samples, width)
 
-    try:
-        np.savez(cache, min=min_vals, max=max_vals)
-    except OSError as exc:
-        logger.warning(f"cache write failed: {exc}")
-    return min_vals, max_vals
-
-
-def render_envelope(min_vals: np.ndarray, max_vals: np.ndarray,
-                    height: int = WAVEFORM_HEIGHT, gain: float = 1.0) -> bytes:
-    """Disegna l'envelope (scalato per `gain`) e ritorna JPEG bytes.
-    Il canvas è largo len(min_vals): il loop è limitato dalla lunghezza
-    reale degli array, quindi file più corti della width richiesta non
-    possono causare accessi fuori range."""
-    width = len(min_vals)
-    canvas = np.ones((height, width, 3), dtype=np.uint8) * 255
+def _interp_edges(values: np.ndarray, width: int) -> np.ndarray:
+    """Zoom sotto il valore (meno valori che colonne): la colonna k copre il
+    tratto [k, k+1] * (len-1) / width della spezzata che interpola
+    linearmente `values` lungo il primo asse. Ritorna i valori interpolati
+    ai `width + 1` bordi delle colonne."""
+    n = len(values)
+    edges = np.arange(width + 1, dtype=np.float64) * ((n - 1) / width)
+    left = np.minimum(edges.astype(np.int64), max(n - 2, 0))
+    right = np.minimum(left + 1, n - 1)
+    frac = (edges - left).reshape(-1, *([1] * (values.ndim - 1)))
+    return (values[left] * (1 - frac) + values[right] * frac).astype(values.dtype, copy=False)
+
+
+def _zoom_min_max(lo: np.ndarray, hi: np.ndarray, width: int) -> tuple[np.ndarray, np.ndarray]:
+    """Min e max a `width` colonne di meno valori (`lo`, `hi`) che colonne,
+    lungo il primo asse (vedi `_interp_edges`): quelli dei due estremi del
+    tratto e dell'eventuale valore interno (al più uno), così la waveform
+    resta una linea continua invece di gradini."""
+    lo_at, hi_at = _interp_edges(lo, width), _interp_edges(hi, width)
+    out_lo = np.minimum(lo_at[:-1], lo_at[1:])
+    out_hi = np.maximum(hi_at[:-1], hi_at[1:])
+    edges = np.arange(width + 1, dtype=np.float64) * ((len(lo) - 1) / width)
+    inner = np.floor(edges[1:]).astype(np.int64)
+    has_inner = inner > edges[:-1]
+    out_lo[has_inner] = np.minimum(out_lo[has_inner], lo[inner[has_inner]])
+    out_hi[has_inner] = np.maximum(out_hi[has_inner], hi[inner[has_inner]])
+    return out_lo, out_hi
+
+
+def _zoom_rms(values: np.ndarray, width: int) -> np.ndarray:
+    """RMS a `width` colonne di meno valori che colonne (campioni o RMS):
+    la media quadratica dei due estremi interpolati del tratto."""
+    squares = np.square(_interp_edges(values, width))
+    return np.sqrt((squares[:-1] + squares[1:]) * 0.5)
+
+
+def _envelope_from_samples(samples: np.ndarray,
+                           width: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Envelope (min, max, RMS) a `width` colonne di `samples` (mono).
+
+    Con almeno un campione per colonna i bordi delle colonne sono frazionari
+    (`k * len / width`, arrotondati per difetto) e un reduceat assegna ogni
+    campione a esattamente una colonna: niente resto scartato in coda, e le
+    colonne differiscono al più di un campione. L'RMS è la somma dei
+    quadrati sugli stessi bordi, divisa per i campioni della colonna.
+
+    Con meno campioni che colonne (zoom sotto il campione) min, max e RMS
+    vengono dalla forma d'onda interpolata linearmente tra i campioni (vedi
+    `_zoom_min_max`, `_zoom_rms`)."""
+    n = len(samples)
+    if n == 0 or width <= 0:
+        zero = np.zeros(1, dtype=np.float32)
+        return zero, zero, zero
+    if n >= width:
+        idx = (np.arange(width, dtype=np.int64) * n) // width
+        counts = np.diff(np.append(idx, n))
+        rms = np.sqrt(np.add.reduceat(np.square(samples), idx) / counts).astype(samples.dtype)
+        return np.minimum.reduceat(samples, idx), np.maximum.reduceat(samples, idx), rms
+    return (*_zoom_min_max(samples, samples, width), _zoom_rms(samples, width))
+
+
+def envelope_from_pyramid(levels: list[tuple[np.ndarray, np.ndarray]],
+                          width: int = WAVEFORM_WIDTH) -> tuple[np.ndarray, np.ndarray]:
+    """Envelope (min_vals, max_vals) a `width` colonne, ricavato dal livello
+    più grezzo che ha ancora almeno `width` colonne (riduzione < 2:1).
+    Ogni colonna del livello finisce in esattamente una colonna di output:
+    niente resto scartato. Se anche il livello base ha meno di `width`
+    colonne (file corti) lo zoom interpola tra le sue colonne come
+    `_envelope_from_samples` tra i campioni (`_zoom_min_max`): l'output ha
+    comunque `width` colonne, senza gradini, e la UI non deve scalare. I
+    livelli possono essere quantizzati (vedi `analysis.dequantize`):
+    l'output è float32."""
+    for lo, hi in reversed(levels):
+        if len(lo) >= width:
+            break
+    if len(lo) < width:
+        return _zoom_min_max(analysis.dequantize(lo), analysis.dequantize(hi), width)
+    idx = (np.arange(width, dtype=np.int64) * len(lo)) // width
+    return (analysis.dequantize(np.minimum.reduceat(lo, idx)),
+            analysis.dequantize(np.maximum.reduceat(hi, idx)))
+
+
+def rms_from_pyramid(rms_levels: list[np.ndarray], width: int = WAVEFORM_WIDTH) -> np.ndarray:
+    """RMS del downmix a `width` colonne dai livelli RMS
+    (`AnalysisResult.rms_levels`), sulle stesse colonne di
+    `envelope_from_pyramid`: la radice della media dei quadrati degli RMS
+    che ogni colonna raccoglie; con meno colonne di `width` lo zoom
+    interpolato di `_zoom_rms`."""
+    for level in reversed(rms_levels):
+        if len(level) >= width:
+            break
+    if len(level) < width:
+        return _zoom_rms(analysis.dequantize(level), width)
+    idx = (np.arange(width, dtype=np.int64) * len(level)) // width
+    counts = np.maximum(np.diff(np.append(idx, len(level))), 1)
+    squares = np.square(analysis.dequantize(level))
+    return np.sqrt(np.add.reduceat(squares, idx) / counts).astype(np.float32)
+
+
+def channel_envelope_from_pyramid(channel_levels: list[np.ndarray],
+                                  width: int = WAVEFORM_WIDTH) -> np.ndarray:
+    """Envelope per canale (width, canali, 3) con min, max e RMS, dalla
+    piramide per canale (`AnalysisResult.channel_levels`) come
+    `envelope_from_pyramid`: l'RMS di una colonna è la radice della media
+    dei quadrati degli RMS che raccoglie. Con meno colonne di `width` lo
+    zoom interpolato, per canale, di `_zoom_min_max` e `_zoom_rms`."""
+    for level in reversed(channel_levels):
+        if len(level) >= width:
+            break
+    envelope = np.empty((width, level.shape[1], 3), np.float32)
+    if len(level) < width:
+        values = analysis.dequantize(level)
+        envelope[:, :, 0], envelope[:, :, 1] = _zoom_min_max(values[:, :, 0], values[:, :, 1], width)
+        envelope[:, :, 2] = _zoom_rms(values[:, :, 2], width)
+        return envelope
+    idx = (np.arange(width, dtype=np.int64) * len(level)) // width
+    counts = np.maximum(np.diff(np.append(idx, len(level))), 1)
+    envelope[:, :, 0] = analysis.dequantize(np.minimum.reduceat(level[:, :, 0], idx, axis=0))
+    envelope[:, :, 1] = analysis.dequantize(np.maximum.reduceat(level[:, :, 1], idx, axis=0))
+    squares = np.square(analysis.dequantize(level[:, :, 2]))
+    envelope[:, :, 2] = np.sqrt(np.add.reduceat(squares, idx, axis=0) / counts[:, None])
+    return envelope
+
+
+def compute_envelope(file_name: str, width: int = WAVEFORM_WIDTH,
+                     workers: int | None = None) -> tuple[np.ndarray, np.ndarray, np.ndarray | None]:
+    """Ritorna (min_vals, max_vals, rms_vals) dell'envelope a `width`
+    colonne; rms_vals è None per le voci in cache senza livelli RMS.
+    Qualsiasi larghezza riusa la stessa piramide cachata da
+    `analysis.analyze`: cambiare `width` non causa un nuovo decode, e con
+    la piramide già in cache la riduzione lavora direttamente sul file
+    dati mappato. `workers`: processi per il decode di un file lungo (vedi
+    `analysis.analyze`)."""
+    result = analysis.analyze(file_name, workers=workers)
+    min_vals, max_vals = envelope_from_pyramid(result.levels, width)
+    rms_vals = rms_from_pyramid(result.rms_levels, width) if result.rms_levels else None
+    return min_vals, max_vals, rms_vals
+
+
+# Palette dell'immagine rasterizzata: indice 0 = sfondo, 1 = waveform,
+# 2 = corpo RMS (più scuro, dentro la waveform). Condivisa dal render JPEG
+# qui sotto e dalla QImage Indexed8 della UI.
+PALETTE = np.array([[255, 255, 255], [0, 0, 255], [0, 0, 140]], dtype=np.uint8)
+
+
+def rasterize_envelope(min_vals: np.ndarray, max_vals: np.ndarray,
+                       height: int = WAVEFORM_HEIGHT, gain: float = 1.0,
+                       rms_vals: np.ndarray | None = None) -> np.ndarray:
+    """Rasterizza l'envelope (scalato per `gain`) in un'immagine indicizzata
+    uint8 (height, len(min_vals)): 1 dove c'è la waveform, 0 sullo sfondo
+    (vedi `PALETTE`); con `rms_vals` 2 nella fascia ±RMS attorno al centro,
+    limitata alla waveform.
+
+    Ogni colonna x è piena tra le righe di min e max inclusi, come il
+    vecchio loop per colonna; il tutto è un solo confronto broadcast tra la
+    griglia degli indici di riga e gli estremi delle colonne:
+    `lo <= y <= hi` diventa `(y - lo) <= (hi - lo)` in aritmetica unsigned,
+    dove y < lo va in overflow e risulta fuori."""
     center = height // 2
     ys1 = np.clip((center + (min_vals * gain * center)).astype(np.int32), 0, height - 1)
     ys2 = np.clip((center + (max_vals * gain * center)).astype(np.int32), 0, height - 1)
+    lo = np.minimum(ys1, ys2)
+    span = np.abs(ys1 - ys2).view(np.uint32)
+    rows = np.arange(height, dtype=np.int32)[:, None]
+    indexed = ((rows - lo).view(np.uint32) <= span).view(np.uint8)
+    if rms_vals is not None:
+        radius = np.clip((rms_vals * gain * center).astype(np.int32), 0, center)
+        body = (rows - (center - radius)).view(np.uint32) <= (2 * radius).view(np.uint32)
+        indexed += body.view(np.uint8) & indexed
+    return indexed
+
+
+def rasterize_split(envelope: np.ndarray, height: int = WAVEFORM_HEIGHT,
+                    gain: float = 1.0) -> np.ndarray:
+    """Vista stereo separata: il canale sinistro nella metà superiore, il
+    destro in quella inferiore, ciascuno rasterizzato come
+    `rasterize_envelope` nella propria metà. `envelope`: l'envelope per
+    canale di `channel_envelope_from_pyramid` (almeno due canali)."""
+    top = height // 2
+    return np.vstack((
+        rasterize_envelope(envelope[:, 0, 0], envelope[:, 0, 1], top, gain, envelope[:, 0, 2]),
+        rasterize_envelope(envelope[:, 1, 0], envelope[:, 1, 1], height - top, gain,
+                           envelope[:, 1, 2]),
+    ))
 
-    blue = np.array([0, 0, 255], dtype=np.uint8)
-    for x in range(width):
-        y1, y2 = ys1[x], ys2[x]
-        if y1 <= y2:
-            canvas[y1:y2 + 1, x] = blue
-        else:
-            canvas[y2:y1 + 1, x] = blue
 
+def render_envelope(min_vals: np.ndarray, max_vals: np.ndarray,
+                    height: int = WAVEFORM_HEIGHT, gain: float = 1.0,
+                    rms_vals: np.ndarray | None = None) -> bytes:
+    """Disegna l'envelope (scalato per `gain`), con `rms_vals` il corpo RMS
+    come fascia più scura, e ritorna JPEG bytes.
+    Il canvas è largo len(min_vals), quindi file più corti della width
+    richiesta producono semplicemente un'immagine più stretta.
+    Solo per chi ha bisogno di bytes (benchmark, export): la UI usa
+    direttamente `rasterize_envelope`, senza encode/decode lossy."""
+    image = Image.fromarray(rasterize_envelope(min_vals, max_vals, height, gain, rms_vals), 'P')
+    image.putpalette(PALETTE.ravel().tolist())
     buf = io.BytesIO()
-    Image.fromarray(canvas).save(buf, 'JPEG')
+    image.convert('RGB').save(buf, 'JPEG')
     return buf.getvalue()
 
 
 def generate_waveform_mem(file_name, width=WAVEFORM_WIDTH,
                           height=WAVEFORM_HEIGHT, gain=1.0) -> bytes:
     """Decode (con cache envelope) + render in un colpo solo."""
-    min_vals, max_vals = compute_envelope(file_name, width)
-    return render_envelope(min_vals, max_vals, height, gain)
+    min_vals, max_vals, rms_vals = compute_envelope(file_name, width)
+    return render_envelope(min_vals, max_vals, height, gain, rms_vals)
 
 
 def generate_waveform_librosa(file_name, width=WAVEFORM_WIDTH,
@@ -120,5 +223,5 @@ def generate_waveform_librosa(file_name, width=WAVEFORM_WIDTH,
     Mantenuta per i benchmark (bench_envelope.py) e come utilità di confronto."""
     import librosa  # lazy import — librosa is heavy
     samples, _ = librosa.load(file_name, sr=None, mono=True)
-    min_vals, max_vals = _envelope_from_samples(samples, width)
-    return render_envelope(min_vals, max_vals, height, gain)
+    min_vals, max_vals, rms_vals = _envelope_from_samples(samples, width)
+    return render_envelope(min_vals, max_vals, height, gain, rms_vals)
@@ -1,56 +1,171 @@
 import logging
+import os
+from collections import OrderedDict
+import numpy as np
+import analysis
 import waveform as wf
-from PyQt5.QtCore import QObject, pyqtSignal, QThread, QTimer
-from PyQt5.QtGui import QPixmap
-from constants import WAVEFORM_DEBOUNCE_MS, WAVEFORM_WIDTH
-from thread_registry import retain
+from PyQt5.QtCore import QObject, pyqtSignal, QTimer
+from PyQt5.QtGui import QImage, QPixmap, qRgb
+from analysis_service import AnalysisJob, scheduler
+from constants import (WAVEFORM_DEBOUNCE_MS, WAVEFORM_RESIZE_DEBOUNCE_MS, WAVEFORM_WIDTH,
+                       WAVEFORM_HEIGHT, WAVEFORM_GAIN_QUANTUM, WAVEFORM_PIXMAP_CACHE_MB,
+                       WAVEFORM_SPARSE_MIN_BYTES)
 
 logger = logging.getLogger(__name__)
 
 
-def _bytes_to_pixmap(data: bytes) -> QPixmap:
-    pixmap = QPixmap()
-    pixmap.loadFromData(data)
+_COLOR_TABLE = [qRgb(int(r), int(g), int(b)) for r, g, b in wf.PALETTE]
+
+
+def _indexed_to_pixmap(indexed, dpr: float = 1.0) -> QPixmap:
+    """QPixmap da un'immagine indicizzata uint8 (H, W) di `wf.rasterize_envelope`.
+    La QImage punta direttamente al buffer numpy (nessuna copia né encode);
+    `QPixmap.fromImage` fa l'unica conversione, mentre `indexed` è ancora vivo.
+    `dpr`: device pixel ratio dei pixel di `indexed` (dimensione logica =
+    fisica / dpr), così il painter la disegna 1:1 sugli schermi HiDPI."""
+    height, width = indexed.shape
+    image = QImage(indexed.data, width, height, indexed.strides[0], QImage.Format_Indexed8)
+    image.setColorTable(_COLOR_TABLE)
+    pixmap = QPixmap.fromImage(image)
+    pixmap.setDevicePixelRatio(dpr)
     return pixmap
 
 
-class EnvelopeThread(QThread):
-    """Decodifica il file e calcola l'envelope in background (parte costosa)."""
+def _quantize_gain(gain: float) -> float:
+    """Gain arrotondato al passo di rendering: gain che differiscono meno di
+    WAVEFORM_GAIN_QUANTUM producono la stessa pixmap (e la stessa chiave)."""
+    return round(round(gain / WAVEFORM_GAIN_QUANTUM) * WAVEFORM_GAIN_QUANTUM, 6)
 
-    envelope_ready = pyqtSignal(object, object, int)  # min_vals, max_vals, seq
 
-    def __init__(self, file_path: str, width: int = WAVEFORM_WIDTH, seq: int = 0):
-        super().__init__()
-        self._file_path = file_path
-        self._width = width
-        self._seq = seq
-        self._cancelled = False
+def _stat_key(file_path: str) -> tuple:
+    """Identità provvisoria del file per le pixmap finché il fingerprint
+    non è noto: (path, mtime_ns, size), una stat e nessuna lettura."""
+    path = os.path.abspath(file_path)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return (path, 0, 0)
+    return (path, st.st_mtime_ns, st.st_size)
 
-    def cancel(self):
-        self._cancelled = True
 
-    def run(self):
-        if self._cancelled:
+class PixmapCache:
+    """Cache LRU di processo delle waveform renderizzate, condivisa da tutti
+    i WaveformService.
+
+    Chiave: (identità dell'envelope, gain quantizzato, larghezza, altezza,
+    device pixel ratio). L'identità è `analysis.file_key` (o, finché non è
+    noto, la stat del file: `_stat_key`), quindi un file sostituito su
+    disco non riusa le pixmap vecchie. La memoria occupata è
+    stimata dai pixel della pixmap; oltre il budget si scartano le voci
+    usate meno di recente. Da usare solo dal main thread.
+    """
+
+    def __init__(self, budget_bytes: int = WAVEFORM_PIXMAP_CACHE_MB * 1024 * 1024):
+        self._budget = budget_bytes
+        self._entries: OrderedDict[tuple, QPixmap] = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _cost(pixmap: QPixmap) -> int:
+        return pixmap.width() * pixmap.height() * max(1, pixmap.depth()) // 8
+
+    def __contains__(self, key: tuple) -> bool:
+        return key in self._entries
+
+    def get(self, key: tuple) -> QPixmap | None:
+        pixmap = self._entries.get(key)
+        if pixmap is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return pixmap
+
+    def put(self, key: tuple, pixmap: QPixmap) -> None:
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= self._cost(old)
+        cost = self._cost(pixmap)
+        if cost > self._budget:
             return
-        try:
-            min_vals, max_vals = wf.compute_envelope(self._file_path, self._width)
-            if not self._cancelled:
-                self.envelope_ready.emit(min_vals, max_vals, self._seq)
-        except Exception as e:
-            logger.warning(f"Waveform envelope failed for {self._file_path}: {e}")
+        self._entries[key] = pixmap
+        self._bytes += cost
+        while self._bytes > self._budget:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= self._cost(evicted)
+
+    def set_budget(self, budget_bytes: int) -> None:
+        self._budget = budget_bytes
+        while self._entries and self._bytes > self._budget:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= self._cost(evicted)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._bytes = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'entries': len(self._entries),
+            'bytes': self._bytes,
+            'budget': self._budget,
+        }
+
+
+_pixmap_cache: PixmapCache | None = None
+
+
+def pixmap_cache() -> PixmapCache:
+    """Cache delle pixmap di processo, creata al primo uso."""
+    global _pixmap_cache
+    if _pixmap_cache is None:
+        _pixmap_cache = PixmapCache()
+    return _pixmap_cache
 
 
 class WaveformService(QObject):
     """Fornisce la waveform come QPixmap, sempre in modo asincrono.
 
-    - `generate(path)`: avvia decode+envelope in un thread; emette
-      `waveform_upgraded` quando pronta. Nel frattempo la progress bar
-      mostra il fondo piatto — il main thread non decodifica mai.
+    - `generate(path)`: se l'analisi è già in cache legge la piramide
+      direttamente dal file dati mappato, senza job; altrimenti accoda
+      `analysis.analyze` allo scheduler di analisi (pool di processi).
+      Emette `waveform_upgraded` quando pronta. Durante
+      il decode emette le anteprime parziali del worker, che riempiono la
+      waveform da sinistra a destra — il main thread non decodifica mai.
+      Per i file grandi (WAVEFORM_SPARSE_MIN_BYTES) non ancora analizzati
+      parte prima, in testa alla coda, `analysis.sparse_preview`: in poche
+      decine di ms un'anteprima approssimata dell'intero file, su cui le
+      anteprime del decode sovrascrivono via via la parte esatta.
+      Le anteprime non entrano nella cache delle pixmap; il render finale
+      è identico a quello senza anteprime.
     - `refresh(gain)`: il gain è solo un fattore applicato all'envelope già
-      in memoria, quindi il re-render è sincrono e costa millisecondi.
+      in memoria, quindi il re-render è sincrono: rasterizzazione numpy e
+      QImage indicizzata sullo stesso buffer, meno di un millisecondo.
       Debounced per assorbire raffiche dello spinbox.
-    - `cancel()`: non blocca. Il thread vive nel thread_registry finché
-      non ha finito; i risultati superati vengono scartati via `seq`.
+    - Ogni render passa prima da `pixmap_cache()`: tornare a un gain già
+      visto, o ricreare la barra per lo stesso file (cambio layout), non
+      rasterizza di nuovo. In quest'ultimo caso la pixmap in cache viene
+      mostrata subito, prima che arrivi l'analisi.
+    - `set_target_size(w, h, dpr)`: la waveform viene renderizzata alla
+      dimensione fisica della barra (logica × devicePixelRatio), così il
+      paint la disegna 1:1 senza scalare. Debounced durante il resize;
+      l'envelope alla nuova larghezza esce dalla piramide già in memoria,
+      senza un nuovo decode.
+    - `set_split_stereo(enabled)`: vista stereo separata (L sopra, R sotto)
+      dalla piramide per canale dell'analisi; i file mono, o analizzati
+      senza piramide per canale, restano con il downmix. Anteprime sempre
+      sul downmix.
+    - Il corpo RMS (dai livelli RMS dell'analisi, calcolati nello stesso
+      decode) è una fascia più scura dentro la waveform, anche nella vista
+      separata; manca nelle anteprime e per le voci in cache senza RMS.
+    - `cancel()`: non blocca. Il job viene tolto dalla coda o interrotto al
+      blocco successivo; i risultati superati vengono scartati via `seq`.
     """
 
     waveform_upgraded = pyqtSignal(QPixmap)
@@ -58,53 +173,224 @@ class WaveformService(QObject):
     def __init__(self, parent=None):
         super().__init__(parent)
         self._seq = 0
-        self._thread: EnvelopeThread | None = None
+        self._job: AnalysisJob | None = None
+        self._sparse_job: AnalysisJob | None = None
         self._file_path: str = ''
         self._gain: float = 1.0
-        self._envelope: tuple | None = None  # (min_vals, max_vals)
+        self._levels: list | None = None     # piramide di analysis.analyze
+        self._rms_levels: list | None = None  # RMS del downmix, se c'è
+        self._channel_levels: list | None = None  # piramide per canale, se c'è
+        self._split = False                  # vista stereo separata richiesta
+        # (min_vals, max_vals, rms_vals|None) a _size[0] colonne, o nella
+        # vista stereo separata l'envelope per canale
+        # (wf.channel_envelope_from_pyramid).
+        self._envelope: tuple | np.ndarray | None = None
+        # analysis.file_key del file, o finché il fingerprint non è noto la
+        # sua stat (vedi _stat_key).
+        self._envelope_key: str | tuple | None = None
+        # Anteprime (min, max, colonne valide) mostrate finché manca l'envelope.
+        self._sparse: tuple | None = None
+        self._partial: tuple | None = None
+        # Dimensione fisica (px) e device pixel ratio del render; finché la
+        # barra non si è dimensionata vale il default di constants.
+        self._size: tuple[int, int] = (WAVEFORM_WIDTH, WAVEFORM_HEIGHT)
+        self._dpr: float = 1.0
+        self._pending_target: tuple[int, int, float] | None = None
         self._debounce = QTimer(self)
         self._debounce.setSingleShot(True)
         self._debounce.setInterval(WAVEFORM_DEBOUNCE_MS)
         self._debounce.timeout.connect(self._render_current)
+        self._resize_debounce = QTimer(self)
+        self._resize_debounce.setSingleShot(True)
+        self._resize_debounce.setInterval(WAVEFORM_RESIZE_DEBOUNCE_MS)
+        self._resize_debounce.timeout.connect(self._apply_target)
 
     def generate(self, file_path: str, gain: float = 1.0) -> None:
         """Avvia il calcolo della waveform; il risultato arriva via
         `waveform_upgraded`."""
         self._file_path = file_path
         self._gain = gain
+        self._levels = None
+        self._rms_levels = None
+        self._channel_levels = None
         self._envelope = None
-        if self._thread is not None:
-            self._thread.cancel()
+        self._sparse = None
+        self._partial = None
+        # Niente fingerprint sul main thread: se non è ancora noto lo calcola
+        # il job, e fino ad allora le pixmap si cercano per stat del file.
+        self._envelope_key = analysis.file_key(file_path, known_only=True) or _stat_key(file_path)
+        self._cancel_jobs()
         self._seq += 1
-        self._thread = EnvelopeThread(file_path, seq=self._seq)
-        self._thread.envelope_ready.connect(self._on_envelope_ready)
-        retain(self._thread)
-        self._thread.start()
+        seq = self._seq
+        result = analysis.load_cached(file_path, measures=(), known_only=True)
+        if result is not None:
+            # Piramide già in cache (viste sul file dati mappato): nessun
+            # job; _render_current trova la pixmap in cache, se c'è.
+            # Consegna asincrona come per il percorso normale.
+            QTimer.singleShot(0, lambda: self._on_analysis_ready(result, seq))
+            return
+        cached = pixmap_cache().get(self._cache_key())
+        if cached is not None:
+            QTimer.singleShot(0, lambda: self._emit_if_current(cached, seq))
+        elif self._wants_sparse_preview(file_path):
+            self._sparse_job = scheduler().submit(analysis.sparse_preview, file_path, urgent=True)
+            self._sparse_job.done.connect(lambda preview: self._on_sparse_preview(preview, seq))
+        # Con le misure della normalizzazione: il job è lo stesso di un
+        # normalize() sul file e la voce in cache serve a entrambi.
+        self._job = scheduler().submit(analysis.analyze, file_path, analysis.required_measures())
+        self._job.partial.connect(lambda preview: self._on_partial(preview, seq))
+        self._job.done.connect(lambda result: self._on_analysis_ready(result, seq))
+        self._job.failed.connect(
+            lambda msg: logger.warning(f"Waveform envelope failed for {file_path}: {msg}"))
 
     def refresh(self, gain: float) -> None:
-        """Debounced: re-renderizza la waveform con il nuovo gain."""
+        """Debounced: re-renderizza la waveform con il nuovo gain. Se la
+        pixmap per questo gain è già in cache viene mostrata subito."""
         self._gain = gain
         if self._envelope is None:
-            # L'envelope non è ancora arrivato: _on_envelope_ready userà
+            # L'envelope non è ancora arrivato: _on_analysis_ready userà
             # comunque il gain più recente.
             return
+        if self._cache_key() in pixmap_cache():
+            self._debounce.stop()
+            self._render_current()
+            return
         self._debounce.start()  # riavvia il timer ad ogni chiamata
 
-    def _on_envelope_ready(self, min_vals, max_vals, seq: int):
+    def set_split_stereo(self, enabled: bool) -> None:
+        """Attiva o disattiva la vista stereo separata; con l'envelope già
+        arrivato il re-render è immediato (nessun decode)."""
+        if enabled == self._split:
+            return
+        self._split = enabled
+        if self._levels is not None:
+            self._update_envelope()
+            self._render_current()
+
+    def set_target_size(self, width: int, height: int, dpr: float) -> None:
+        """Dimensione logica della barra e suo devicePixelRatio. Prima che
+        l'envelope sia arrivato si applica subito (nessun render da
+        rifare), poi con debounce per non rasterizzare ad ogni passo del
+        resize."""
+        if width <= 0 or height <= 0:
+            return
+        self._pending_target = (width, height, dpr)
+        if self._envelope is None:
+            self._apply_target()
+        else:
+            self._resize_debounce.start()
+
+    def _apply_target(self):
+        if self._pending_target is None:
+            return
+        width, height, dpr = self._pending_target
+        self._pending_target = None
+        size = (max(1, round(width * dpr)), max(1, round(height * dpr)))
+        if size == self._size and dpr == self._dpr:
+            return
+        resized = size[0] != self._size[0]
+        self._size, self._dpr = size, dpr
+        if self._levels is not None:
+            if resized:
+                self._update_envelope()
+            self._render_current()
+
+    @staticmethod
+    def _wants_sparse_preview(file_path: str) -> bool:
+        try:
+            large = os.path.getsize(file_path) >= WAVEFORM_SPARSE_MIN_BYTES
+        except OSError:
+            return False
+        return large and not analysis.is_cached(file_path, measures=())
+
+    def _on_sparse_preview(self, preview: tuple, seq: int):
+        if seq != self._seq:
+            return
+        self._sparse_job = None
+        self._sparse = preview
+        self._render_preview()
+
+    def _on_partial(self, preview: tuple, seq: int):
+        if seq != self._seq:
+            return
+        self._partial = preview
+        self._render_preview()
+
+    def _render_preview(self):
+        """Anteprima sparsa come fondo, con sopra le colonne già esatte
+        dell'anteprima progressiva. Mai in cache: è provvisoria."""
+        if self._envelope is not None:
+            return
+        width = self._size[0]
+        lo = np.zeros(width, dtype=np.float32)
+        hi = np.zeros(width, dtype=np.float32)
+        for preview in (self._sparse, self._partial):
+            if preview is None:
+                continue
+            p_lo, p_hi, filled = preview
+            cols = filled * width // len(p_lo)
+            env_lo, env_hi = wf.envelope_from_pyramid([(p_lo, p_hi)], width)
+            lo[:cols], hi[:cols] = env_lo[:cols], env_hi[:cols]
+        indexed = wf.rasterize_envelope(lo, hi, self._size[1], _quantize_gain(self._gain))
+        self.waveform_upgraded.emit(_indexed_to_pixmap(indexed, self._dpr))
+
+    def _on_analysis_ready(self, result: analysis.AnalysisResult, seq: int):
         if seq != self._seq:  # risultato di un generate()/cancel() superato
             return
-        self._envelope = (min_vals, max_vals)
+        self._job = None
+        if self._sparse_job is not None:  # anteprima ormai inutile
+            self._sparse_job.cancel()
+            self._sparse_job = None
+        self._sparse = self._partial = None
+        if isinstance(self._envelope_key, tuple):
+            # Il job ha registrato il fingerprint nell'indice.
+            self._envelope_key = analysis.file_key(self._file_path, known_only=True) or self._envelope_key
+        self._levels = result.levels
+        self._rms_levels = result.rms_levels
+        self._channel_levels = result.channel_levels
+        self._update_envelope()
         self._render_current()
 
+    def _update_envelope(self):
+        """Envelope dalla piramide alla larghezza attuale: per canale nella
+        vista stereo separata, se l'analisi l'ha calcolata."""
+        if self._split and self._channel_levels is not None:
+            self._envelope = wf.channel_envelope_from_pyramid(self._channel_levels, self._size[0])
+        else:
+            rms = (wf.rms_from_pyramid(self._rms_levels, self._size[0])
+                   if self._rms_levels else None)
+            self._envelope = (*wf.envelope_from_pyramid(self._levels, self._size[0]), rms)
+
+    def _cache_key(self) -> tuple:
+        return (self._envelope_key, _quantize_gain(self._gain), *self._size, self._dpr, self._split)
+
+    def _emit_if_current(self, pixmap: QPixmap, seq: int):
+        if seq == self._seq and self._envelope is None:
+            self.waveform_upgraded.emit(pixmap)
+
     def _render_current(self):
         if self._envelope is None:
             return
-        data = wf.render_envelope(self._envelope[0], self._envelope[1], gain=self._gain)
-        self.waveform_upgraded.emit(_bytes_to_pixmap(data))
+        key = self._cache_key()
+        pixmap = pixmap_cache().get(key)
+        if pixmap is None:
+            if isinstance(self._envelope, np.ndarray):
+                indexed = wf.rasterize_split(self._envelope, self._size[1], key[1])
+            else:
+                indexed = wf.rasterize_envelope(self._envelope[0], self._envelope[1],
+                                                self._size[1], key[1], self._envelope[2])
+            pixmap = _indexed_to_pixmap(indexed, self._dpr)
+            pixmap_cache().put(key, pixmap)
+        self.waveform_upgraded.emit(pixmap)
 
     def cancel(self):
         self._debounce.stop()
+        self._resize_debounce.stop()
         self._seq += 1  # invalida qualsiasi risultato in arrivo
-        if self._thread is not None:
-            self._thread.cancel()
-            self._thread = None
+        self._cancel_jobs()
+
+    def _cancel_jobs(self):
+        for job in (self._job, self._sparse_job):
+            if job is not None:
+                job.cancel()
+        self._job = self._sparse_job = None